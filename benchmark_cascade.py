@@ -0,0 +1,47 @@
+""" Latency and AP of the IGNet v0.8 inference cascade as the number of kept seeds K varies.
+    For every K, runs inference_multimodal.py with --cascade_k K into <dump_dir>_k<K> and eval.py on
+    the dump, then reports the network + decode time per frame and AP / AP0.8 / AP0.4.
+    Arguments not listed below are passed to inference_multimodal.py as is.
+
+    python benchmark_cascade.py --cascade_ks 0 512 256 128 --dump_dir ignet_v0.8.0 --split test_seen \
+        --network_ver v0.8.0 --ckpt_epoch 48
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--cascade_ks', type=int, nargs='+', default=[0, 512, 256, 128], help='Seeds kept per instance, 0 for all [default: 0 512 256 128]')
+parser.add_argument('--dump_dir', type=str, default='ignet_v0.8.0', help='Base dump dir, one <dump_dir>_k<K> per K [default: ignet_v0.8.0]')
+parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet', help='Where dataset is')
+parser.add_argument('--camera', default='realsense', help='Camera to use [kinect | realsense]')
+parser.add_argument('--split', default='test_seen', help='Dataset split [default: test_seen]')
+parser.add_argument('--num_workers', type=int, default=20, help='Number of workers used in evaluation [default: 20]')
+parser.add_argument('--skip_inference', action='store_true', help='Only evaluate existing dumps [default: False]')
+cfgs, inference_args = parser.parse_known_args()
+
+
+def run_k(k):
+    dump_dir = '{}_k{}'.format(cfgs.dump_dir, k)
+    common_args = ['--dump_dir', dump_dir, '--dataset_root', cfgs.dataset_root, '--camera', cfgs.camera, '--split', cfgs.split]
+    if not cfgs.skip_inference:
+        subprocess.run([sys.executable, os.path.join(ROOT_DIR, 'inference_multimodal.py'), '--cascade_k', str(k)] +
+                       common_args + inference_args, check=True)
+    subprocess.run([sys.executable, os.path.join(ROOT_DIR, 'eval.py'), '--num_workers', str(cfgs.num_workers)] + common_args, check=True)
+
+    net_times = np.load(os.path.join('experiment', dump_dir, 'net_time_{}_{}.npy'.format(cfgs.split, cfgs.camera)))
+    res = np.load(os.path.join('experiment', dump_dir, 'ap_{}_{}.npy'.format(cfgs.split, cfgs.camera)))
+    # res: (scenes, frames, top-k, friction coefficients 0.2 ... 1.2)
+    return np.mean(net_times[1:]), 100 * np.mean(res), 100 * np.mean(res[..., 3]), 100 * np.mean(res[..., 1])
+
+
+if __name__ == '__main__':
+    results = [(k,) + run_k(k) for k in cfgs.cascade_ks]
+    print('{:>6} {:>12} {:>7} {:>7} {:>7}'.format('K', 'net ms', 'AP', 'AP0.8', 'AP0.4'))
+    for k, net_time, ap, ap_08, ap_04 in results:
+        print('{:>6} {:>12.2f} {:>7.2f} {:>7.2f} {:>7.2f}'.format('all' if k == 0 else k, net_time, ap, ap_08, ap_04))
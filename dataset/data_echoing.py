@@ -0,0 +1,58 @@
+""" Data echoing for input-bound training.
+    Every batch produced by the DataLoader is emitted echo_factor times through a shuffle
+    buffer, the training loop gives every echo a fresh augmentation and point/grasp subset.
+    Ref: Choi et al., Faster Neural Network Training with Data Echoing.
+"""
+
+import random
+
+
+class DataEchoing():
+    """ Iterable over (batch, echo_idx) pairs, echo_idx is 0 for the first emission of a batch.
+
+        Input:
+            dataloader: [torch.utils.data.DataLoader]
+            echo_factor: [int]
+                number of times every loaded batch is emitted
+            buffer_size: [int]
+                number of (batch, echo) items the shuffle buffer holds before emitting,
+                it only references collated CPU batches, nothing is copied
+            seed: [int]
+    """
+    def __init__(self, dataloader, echo_factor=1, buffer_size=8, seed=0):
+        if echo_factor < 1:
+            raise ValueError('echo_factor should be a positive integer, got {}'.format(echo_factor))
+        self.dataloader = dataloader
+        self.echo_factor = echo_factor
+        self.buffer_size = max(buffer_size, 1) if echo_factor > 1 else 1
+        self.seed = seed
+        self.epoch = 0
+        self.num_loaded = 0
+        self.num_emitted = 0
+
+    def __len__(self):
+        return len(self.dataloader) * self.echo_factor
+
+    def effective_echo_factor(self):
+        return self.num_emitted / max(self.num_loaded, 1)
+
+    def _copy(self, batch):
+        # the training loop replaces entries in place when moving them to the device
+        return {key: [list(v) for v in value] if isinstance(value, list) else value for key, value in batch.items()}
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+        buffer = []
+        for batch in self.dataloader:
+            self.num_loaded += 1
+            for echo_idx in range(self.echo_factor):
+                buffer.append((batch, echo_idx))
+            while len(buffer) >= self.buffer_size:
+                batch_, echo_idx = buffer.pop(rng.randrange(len(buffer)))
+                self.num_emitted += 1
+                yield self._copy(batch_), echo_idx
+        while len(buffer) > 0:
+            batch_, echo_idx = buffer.pop(rng.randrange(len(buffer)))
+            self.num_emitted += 1
+            yield self._copy(batch_), echo_idx
@@ -0,0 +1,114 @@
+""" Pose-keyed lookup table of the grasp label alignment.
+    The label (view, angle) every template (view, angle) maps to depends only on the object rotation
+    (models/grasp_label_utils.py batch_label_alignment), i.e. on (scene, frame, object) without
+    augmentation. label_align_lut/scene_xxxx/<camera>.npy holds them as int16 (256, O, V*A), objects
+    in the order of the frame meta, so training replaces the kNN alignment with a lookup
+    (GraspNetDataset(label_align_lut=True)).
+
+    python dataset/generate_alignment_lut.py --dataset_root /data/graspnet --camera realsense --device cuda
+    python dataset/generate_alignment_lut.py --dataset_root /data/graspnet --camera realsense --report
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import scipy.io as scio
+import torch
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from models.grasp_label_utils import batch_label_alignment
+from utils.data_utils import save_atomic
+
+NUM_FRAMES = 256
+
+
+def get_lut_path(root, scene, camera):
+    return os.path.join(root, 'label_align_lut', scene, '{}.npy'.format(camera))
+
+
+def load_scene_rotations(root, scene, camera):
+    """ Object rotations of all frames of a scene, (256, O, 3, 3), objects in meta order. """
+    rotations = []
+    for frame_id in range(NUM_FRAMES):
+        meta = scio.loadmat(os.path.join(root, 'scenes', scene, camera, 'meta', str(frame_id).zfill(4) + '.mat'))
+        rotations.append(np.transpose(meta['poses'][:3, :3, :], (2, 0, 1)))
+    return np.stack(rotations).astype(np.float32)
+
+
+def generate_scene(scene_id, cfgs):
+    scene = 'scene_' + str(scene_id).zfill(4)
+    save_path = get_lut_path(cfgs.dataset_root, scene, cfgs.camera)
+    if os.path.exists(save_path) and not cfgs.overwrite:
+        return scene_id, 0, 0.0, None
+
+    tic = time.time()
+    rotations = load_scene_rotations(cfgs.dataset_root, scene, cfgs.camera)
+    num_frames, num_objects = rotations.shape[:2]
+    rotations = torch.from_numpy(rotations.reshape(-1, 3, 3)).to(cfgs.device)
+    label_inds = []
+    with torch.no_grad():
+        for start in range(0, len(rotations), cfgs.poses_per_call):
+            label_inds.append(batch_label_alignment(rotations[start:start + cfgs.poses_per_call]).cpu().numpy())
+    label_inds = np.concatenate(label_inds).astype(np.int16).reshape(num_frames, num_objects, -1)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    save_atomic(save_path, label_inds)
+    # an alignment table keyed by the alignment itself would only hit for repeated rows
+    num_distinct = len(np.unique(label_inds.reshape(num_frames * num_objects, -1), axis=0))
+    return scene_id, num_frames * num_objects, time.time() - tic, num_distinct
+
+
+def generate_scene_star(args):
+    return generate_scene(*args)
+
+
+def parallel_generate(scene_ids, cfgs, proc = 2):
+    ctx_in_main = multiprocessing.get_context('forkserver')
+    with ctx_in_main.Pool(processes = proc) as p:
+        for scene_id, num_poses, elapsed, num_distinct in p.imap_unordered(generate_scene_star, [(x, cfgs) for x in scene_ids]):
+            message = 'scene: {} poses: {} time: {:.1f}s'.format(scene_id, num_poses, elapsed)
+            if num_distinct is not None:
+                message += ' distinct alignments: {}'.format(num_distinct)
+            print(message)
+
+
+def lut_report(scene_ids, cfgs):
+    """ Share of the (scene, frame, object) keys of the scenes that the tables cover, i.e. the
+        expected lookup hit rate of un-augmented training.
+    """
+    num_keys, num_hits, missing = 0, 0, []
+    for scene_id in scene_ids:
+        scene = 'scene_' + str(scene_id).zfill(4)
+        meta = scio.loadmat(os.path.join(cfgs.dataset_root, 'scenes', scene, cfgs.camera, 'meta', '0000.mat'))
+        scene_keys = NUM_FRAMES * meta['poses'].shape[2]
+        num_keys += scene_keys
+        lut_path = get_lut_path(cfgs.dataset_root, scene, cfgs.camera)
+        if os.path.exists(lut_path) and np.load(lut_path, mmap_mode='r').shape[:2] == (NUM_FRAMES, meta['poses'].shape[2]):
+            num_hits += scene_keys
+        else:
+            missing.append(scene)
+    print('keys: {} covered: {} ({:.1%})'.format(num_keys, num_hits, num_hits / max(num_keys, 1)))
+    if len(missing) > 0:
+        print('scenes without a valid table: {}'.format(' '.join(missing)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet')
+    parser.add_argument('--camera', default='realsense', help='Camera split [realsense/kinect]')
+    parser.add_argument('--scene_start', type=int, default=0, help='First scene [default: 0]')
+    parser.add_argument('--scene_end', type=int, default=190, help='Last scene (exclusive) [default: 190]')
+    parser.add_argument('--device', default='cpu', help='Device of the alignment kNN [default: cpu]')
+    parser.add_argument('--poses_per_call', type=int, default=64, help='Object poses aligned per call [default: 64]')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of scenes processed in parallel [default: 4]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate scenes whose table exists [default: False]')
+    parser.add_argument('--report', action='store_true', help='Only report the coverage of the existing tables [default: False]')
+    cfgs = parser.parse_args()
+
+    scene_ids = list(range(cfgs.scene_start, cfgs.scene_end))
+    if cfgs.report:
+        lut_report(scene_ids, cfgs)
+    else:
+        parallel_generate(scene_ids, cfgs=cfgs, proc = cfgs.num_workers)
@@ -0,0 +1,177 @@
+""" Collision label generation on a voxelized scene.
+    Writes <save_name>/scene_xxxx/collision_labels.npz (collision_label_voxel by default, next to the
+    released collision_label) with one (Np, V, A, D) bool array per object (arr_i, in the order of
+    the scene annotation), the layout of the released labels, so labels for another gripper,
+    GRASP_MAX_WIDTH or new objects can be produced offline.
+
+    python dataset/generate_collision_label.py --dataset_root /data/graspnet --save_name collision_label_gripper2 \
+        --finger_width 0.012 --max_width 0.085
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import open3d as o3d
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from utils.collision_detector import VoxelCollisionDetector
+from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, GRASP_MAX_WIDTH, NUM_VIEW
+
+from graspnetAPI.utils.xmlhandler import xmlReader
+from graspnetAPI.utils.utils import get_obj_pose_list, transform_points
+
+
+def load_scene_models(dataset_root, scene_dir, camera_type, voxel_size):
+    """ Object models of a scene placed with the poses of frame 0.
+
+        Output:
+            obj_list: [list of int]
+            pose_list: [list of np.ndarray, (4,4)]
+                object poses in the frame 0 camera frame
+            scene_points: [np.ndarray, (N,3), np.float32]
+            table_trans: [np.ndarray, (4,4)]
+                camera to table transformation
+    """
+    camera_poses = np.load(os.path.join(scene_dir, 'camera_poses.npy'))
+    align_mat = np.load(os.path.join(scene_dir, 'cam0_wrt_table.npy'))
+    scene_reader = xmlReader(os.path.join(scene_dir, 'annotations', '0000.xml'))
+    obj_list, pose_list = get_obj_pose_list(camera_poses[0], scene_reader.getposevectorlist())
+    pose_list = [np.dot(np.linalg.inv(camera_poses[0]), pose) for pose in pose_list]
+
+    scene_points = []
+    for obj_idx, pose in zip(obj_list, pose_list):
+        model = o3d.io.read_point_cloud(os.path.join(dataset_root, 'models', '%03d' % obj_idx, 'nontextured.ply'))
+        model = model.voxel_down_sample(voxel_size / 2)
+        scene_points.append(transform_points(np.asarray(model.points), pose))
+    table_trans = np.dot(align_mat, camera_poses[0])
+    return obj_list, pose_list, np.vstack(scene_points).astype(np.float32), table_trans
+
+
+def object_collision_labels(detector, points, offsets, scores, pose, grasp_views, cfgs):
+    """ Collision labels of all grasps of one object.
+
+        Input:
+            points: [np.ndarray, (Np,3)]
+                object-frame grasp points
+            offsets: [np.ndarray, (Np,V,A,D,3)]
+                in-plane angle, depth and width of every grasp
+            scores: [np.ndarray, (Np,V,A,D)]
+                friction coefficients, grasps with score <= 0 are not checked unless cfgs.all_grasps
+            pose: [np.ndarray, (4,4)]
+            grasp_views: [torch.FloatTensor, (V,3)]
+
+        Output:
+            collision: [np.ndarray, (Np,V,A,D), np.bool]
+    """
+    collision = np.zeros(scores.shape, dtype=bool)
+    check_mask = np.ones(scores.shape, dtype=bool) if cfgs.all_grasps else (scores > 0)
+    point_inds, view_inds, angle_inds, depth_inds = np.nonzero(check_mask)
+    centers = transform_points(points, pose).astype(np.float32)
+    for start in range(0, len(point_inds), cfgs.grasps_per_call):
+        p = point_inds[start:start + cfgs.grasps_per_call]
+        v = view_inds[start:start + cfgs.grasps_per_call]
+        a = angle_inds[start:start + cfgs.grasps_per_call]
+        d = depth_inds[start:start + cfgs.grasps_per_call]
+        grasp_offsets = offsets[p, v, a, d]
+        rotations = batch_viewpoint_params_to_matrix(-grasp_views[v], torch.from_numpy(grasp_offsets[:, 0]).float())
+        rotations = np.matmul(pose[:3, :3].astype(np.float32), rotations.numpy())
+        collision[p, v, a, d] = detector.detect(centers[p], rotations, grasp_offsets[:, 1], grasp_offsets[:, 2],
+                                                collision_thresh=cfgs.collision_thresh)
+    return collision
+
+
+def save_npz_atomic(path, arrays):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, *arrays)
+    os.replace(tmp_path, path)
+
+
+def generate_scene(scene_id, cfgs):
+    scene_name = 'scene_' + str(scene_id).zfill(4)
+    scene_dir = os.path.join(cfgs.dataset_root, 'scenes', scene_name, cfgs.camera_type)
+    save_path = os.path.join(cfgs.dataset_root, cfgs.save_name, scene_name, 'collision_labels.npz')
+    if os.path.exists(save_path) and not cfgs.overwrite:
+        return scene_id, 0, 0.0, None
+
+    tic = time.time()
+    obj_list, pose_list, scene_points, table_trans = load_scene_models(cfgs.dataset_root, scene_dir, cfgs.camera_type,
+                                                                       cfgs.voxel_size)
+    detector = VoxelCollisionDetector(scene_points, voxel_size=cfgs.voxel_size,
+                                      table_trans=table_trans if cfgs.table else None, max_width=cfgs.max_width,
+                                      finger_width=cfgs.finger_width, finger_length=cfgs.finger_length,
+                                      height=cfgs.height, approach_dist=cfgs.approach_dist)
+    grasp_views = generate_grasp_views(NUM_VIEW)
+    labels = []
+    for obj_idx, pose in zip(obj_list, pose_list):
+        label = np.load(os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(str(obj_idx).zfill(3))))
+        labels.append(object_collision_labels(detector, label['points'], label['offsets'], label['scores'], pose,
+                                              grasp_views, cfgs))
+
+    agreement = None
+    reference_path = os.path.join(cfgs.dataset_root, cfgs.reference_name, scene_name, 'collision_labels.npz')
+    if cfgs.reference_name and os.path.exists(reference_path) \
+            and os.path.abspath(reference_path) != os.path.abspath(save_path):
+        agreement = compare_labels(labels, np.load(reference_path), obj_list, cfgs.dataset_root)
+
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    save_npz_atomic(save_path, labels)
+    return scene_id, len(obj_list), time.time() - tic, agreement
+
+
+def compare_labels(labels, reference, obj_list, dataset_root):
+    """ Agreement, and reference collision recall, over the grasps with a positive score. """
+    num_agree, num_valid, num_ref_collision, num_recalled = 0, 0, 0, 0
+    for i, obj_idx in enumerate(obj_list):
+        scores = np.load(os.path.join(dataset_root, 'grasp_label', '{}_labels.npz'.format(str(obj_idx).zfill(3))))['scores']
+        valid = scores > 0
+        ref = reference['arr_{}'.format(i)][valid]
+        pred = labels[i][valid]
+        num_agree += np.sum(ref == pred)
+        num_valid += valid.sum()
+        num_ref_collision += ref.sum()
+        num_recalled += np.sum(ref & pred)
+    return num_agree / max(num_valid, 1), num_recalled / max(num_ref_collision, 1)
+
+
+def generate_scene_star(args):
+    return generate_scene(*args)
+
+
+def parallel_generate(scene_ids, cfgs, proc = 2):
+    ctx_in_main = multiprocessing.get_context('forkserver')
+    with ctx_in_main.Pool(processes = proc) as p:
+        for scene_id, num_objects, elapsed, agreement in p.imap_unordered(generate_scene_star, [(x, cfgs) for x in scene_ids]):
+            message = 'scene: {} objects: {} time: {:.1f}s'.format(scene_id, num_objects, elapsed)
+            if agreement is not None:
+                message += ' reference agreement: {:.4f} collision recall: {:.4f}'.format(*agreement)
+            print(message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet')
+    parser.add_argument('--camera_type', default='realsense', help='Camera split whose frame 0 annotation gives the object poses [default: realsense]')
+    parser.add_argument('--save_name', default='collision_label_voxel', help='Output directory under dataset_root, collision_label replaces the released labels [default: collision_label_voxel]')
+    parser.add_argument('--reference_name', default='collision_label', help='Labels to report agreement with when writing elsewhere, empty to skip [default: collision_label]')
+    parser.add_argument('--scene_start', type=int, default=0, help='First scene [default: 0]')
+    parser.add_argument('--scene_end', type=int, default=190, help='Last scene (exclusive) [default: 190]')
+    parser.add_argument('--voxel_size', type=float, default=0.005, help='Occupancy grid resolution and gripper sample spacing [default: 0.005]')
+    parser.add_argument('--max_width', type=float, default=GRASP_MAX_WIDTH, help='Grasps wider than this are collisions [default: GRASP_MAX_WIDTH]')
+    parser.add_argument('--finger_width', type=float, default=0.01, help='Finger thickness [default: 0.01]')
+    parser.add_argument('--finger_length', type=float, default=0.06, help='Finger length [default: 0.06]')
+    parser.add_argument('--height', type=float, default=0.02, help='Gripper height [default: 0.02]')
+    parser.add_argument('--approach_dist', type=float, default=0.05, help='Free space required behind the gripper bottom [default: 0.05]')
+    parser.add_argument('--collision_thresh', type=float, default=0.0, help='Occupied fraction of gripper samples above which a grasp collides [default: 0.0]')
+    parser.add_argument('--no_table', dest='table', action='store_false', help='Ignore the table plane [default: False]')
+    parser.add_argument('--all_grasps', action='store_true', help='Also check grasps with a non-positive score [default: False]')
+    parser.add_argument('--grasps_per_call', type=int, default=65536, help='Grasps transformed per call [default: 65536]')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of scenes processed in parallel [default: 8]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate scenes whose label file exists [default: False]')
+    cfgs = parser.parse_args()
+
+    parallel_generate(list(range(cfgs.scene_start, cfgs.scene_end)), cfgs=cfgs, proc = cfgs.num_workers)
@@ -0,0 +1,79 @@
+""" Farthest point orderings of the grasp points of every object.
+    grasp_label_fps/xxx_order.npy holds several permutations (R,Np) of the simplified label points,
+    FPS runs from different start points, so every prefix is a nested FPS subset. The dataset
+    (fps_grasp_order=True) takes the first K entries of a randomly chosen one instead of K uniformly
+    random points, which covers the object at smaller K. A cyclic shift of a single ordering is not
+    used: its windows are made of late, gap-filling FPS points and cover no better than random.
+
+    python dataset/generate_fps_order.py --dataset_root /data/graspnet --coverage_k 350
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from utils.data_utils import farthest_point_order, save_atomic
+
+
+def get_order_path(root, obj_idx):
+    return os.path.join(root, 'grasp_label_fps', '{}_order.npy'.format(str(obj_idx).zfill(3)))
+
+
+def coverage_radius(points, subset_idxs):
+    """ Largest distance from a grasp point to the nearest selected point. """
+    dists, _ = cKDTree(points[subset_idxs]).query(points, k=1)
+    return dists.max()
+
+
+def generate_object(obj_idx, cfgs):
+    order_path = get_order_path(cfgs.dataset_root, obj_idx)
+    points = None
+    tic = time.time()
+    if cfgs.overwrite or not os.path.exists(order_path):
+        points = np.load(os.path.join(cfgs.dataset_root, 'grasp_label_simplified', '{}_labels.npz'.format(str(obj_idx).zfill(3))))['points']
+        os.makedirs(os.path.dirname(order_path), exist_ok=True)
+        # first run from the point farthest from the centroid, the others from random points
+        start_idxs = [None] + list(np.random.RandomState(obj_idx).choice(len(points), cfgs.num_orders - 1))
+        save_atomic(order_path, np.stack([farthest_point_order(points, start_idx) for start_idx in start_idxs]))
+    elapsed = time.time() - tic
+
+    coverage = None
+    if cfgs.coverage_k > 0:
+        if points is None:
+            points = np.load(os.path.join(cfgs.dataset_root, 'grasp_label_simplified', '{}_labels.npz'.format(str(obj_idx).zfill(3))))['points']
+        orders = np.load(order_path)
+        k = min(cfgs.coverage_k, len(points))
+        coverage = (coverage_radius(points, np.random.choice(len(points), k, replace=False)),
+                    coverage_radius(points, orders[np.random.randint(len(orders))][:k]))
+    return obj_idx, elapsed, coverage
+
+
+def generate_object_star(args):
+    return generate_object(*args)
+
+
+def parallel_generate(obj_idxs, cfgs, proc = 2):
+    ctx_in_main = multiprocessing.get_context('forkserver')
+    with ctx_in_main.Pool(processes = proc) as p:
+        for obj_idx, elapsed, coverage in p.imap_unordered(generate_object_star, [(x, cfgs) for x in obj_idxs]):
+            message = 'object: {} time: {:.1f}s'.format(obj_idx, elapsed)
+            if coverage is not None:
+                message += ' coverage radius at K={}: random {:.4f} fps {:.4f}'.format(cfgs.coverage_k, *coverage)
+            print(message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of objects processed in parallel [default: 8]')
+    parser.add_argument('--num_orders', type=int, default=16, help='FPS orderings per object, from different start points [default: 16]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate objects whose order file exists [default: False]')
+    parser.add_argument('--coverage_k', type=int, default=0, help='Report the coverage radius of K random vs K FPS points, 0 to skip [default: 0]')
+    cfgs = parser.parse_args()
+
+    parallel_generate(list(range(88)), cfgs=cfgs, proc = cfgs.num_workers)
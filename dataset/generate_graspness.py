@@ -4,12 +4,14 @@ os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 import numpy as np
 from PIL import Image
 import scipy.io as scio
+from scipy.spatial import cKDTree
 import sys
+import time
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(ROOT_DIR)
-from utils.data_utils import get_workspace_mask, CameraInfo, create_point_cloud_from_depth_image
-# from knn.knn_modules import knn
-from pytorch3d.ops.knn import knn_points
+from utils.data_utils import get_workspace_mask, CameraInfo, create_point_cloud_from_depth_image, \
+                             save_atomic, get_scene_array_paths, consolidate_scene_frames
+from utils.work_queue import run_queue_workers
 import multiprocessing
 
 import torch
@@ -17,26 +19,75 @@ from graspnetAPI.utils.xmlhandler import xmlReader
 from graspnetAPI.utils.utils import get_obj_pose_list, transform_points
 import argparse
 
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-torch.cuda.set_device(device)
+num_views, num_angles, num_depths = 300, 12, 4
+fric_coef_thresh = 0.6
+point_grasp_num = num_views * num_angles * num_depths
+
+
+def load_scene_labels(dataset_root, scene_name, obj_list):
+    """ Grasp points and per-point graspness of every object in a scene, computed once for all frames.
+
+        Output:
+            scene_labels: [list of (np.ndarray (Np,3), np.ndarray (Np,1))]
+                object-frame grasp points and graspness, in the order of obj_list which is
+                also the order of the scene collision labels
+    """
+    collision_labels = np.load(os.path.join(dataset_root, 'collision_label', scene_name, 'collision_labels.npz'))
+    scene_labels = []
+    for i, obj_idx in enumerate(obj_list):
+        label = np.load(os.path.join(dataset_root, 'grasp_label', '{}_labels.npz'.format(str(obj_idx).zfill(3))))
+        sampled_points = label['points'].astype(np.float32)
+        fric_coefs = label['scores'].astype(np.float32)
+        collision = collision_labels['arr_{}'.format(i)]  # Npoints * num_views * num_angles * num_depths
+        num_points = sampled_points.shape[0]
+
+        valid_grasp_mask = ((fric_coefs <= fric_coef_thresh) & (fric_coefs > 0) & ~collision)
+        valid_grasp_mask = valid_grasp_mask.reshape(num_points, -1)
+        graspness = np.sum(valid_grasp_mask, axis=1) / point_grasp_num
+        scene_labels.append((sampled_points, graspness.reshape(num_points, 1)))
+    return scene_labels
+
+
+def nearest_graspness(cloud_masked, grasp_points, grasp_points_graspness, backend):
+    if backend == 'kdtree':
+        _, nn_inds = cKDTree(grasp_points).query(cloud_masked, k=1)
+        return grasp_points_graspness[nn_inds]
+    from pytorch3d.ops.knn import knn_points
+    grasp_points = torch.from_numpy(grasp_points).cuda().contiguous().unsqueeze(0)
+    cloud_masked = torch.from_numpy(cloud_masked).cuda().contiguous().unsqueeze(0)
+    _, nn_inds, _ = knn_points(cloud_masked, grasp_points, K=1)
+    nn_inds = nn_inds.squeeze(-1).squeeze(0).cpu().numpy()
+    return grasp_points_graspness[nn_inds]
 
 
 def generate_scene(scene_id, cfgs):
     dataset_root = cfgs.dataset_root   # set dataset root
     camera_type = cfgs.camera_type   # kinect / realsense
     save_path_root = os.path.join(dataset_root, 'graspness')
-    num_views, num_angles, num_depths = 300, 12, 4
-    fric_coef_thresh = 0.6
-    point_grasp_num = num_views * num_angles * num_depths
-    for ann_id in range(256):
+    scene_name = 'scene_' + str(scene_id).zfill(4)
+    scene_dir = os.path.join(dataset_root, 'scenes', scene_name, camera_type)
+    save_path = os.path.join(save_path_root, scene_name, camera_type)
+    os.makedirs(save_path, exist_ok=True)
+    frame_paths = [os.path.join(save_path, str(ann_id).zfill(4) + '.npy') for ann_id in range(256)]
+    scene_graspness_path, scene_offsets_path = get_scene_array_paths(dataset_root, 'graspness', scene_name, camera_type)
+    if cfgs.backend == 'cuda':
+        torch.cuda.set_device(torch.device('cuda:0'))
+
+    tic = time.time()
+    num_generated = 0
+    scene_done = os.path.exists(scene_offsets_path) or not cfgs.consolidate
+    todo_ann_ids = [ann_id for ann_id in range(256) if cfgs.overwrite or not os.path.exists(frame_paths[ann_id])]
+    if len(todo_ann_ids) == 0 and scene_done:
+        return scene_id, 0, 0.0
+
+    camera_poses = np.load(os.path.join(scene_dir, 'camera_poses.npy'))
+    align_mat = np.load(os.path.join(scene_dir, 'cam0_wrt_table.npy'))
+    scene_labels, scene_obj_list = None, None
+    for ann_id in todo_ann_ids:
         # get scene point cloud
-        print('generating scene: {} ann: {}'.format(scene_id, ann_id))
-        depth = np.array(Image.open(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                                    camera_type, 'depth', str(ann_id).zfill(4) + '.png')))
-        seg = np.array(Image.open(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                                camera_type, 'label', str(ann_id).zfill(4) + '.png')))
-        meta = scio.loadmat(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                            camera_type, 'meta', str(ann_id).zfill(4) + '.mat'))
+        depth = np.array(Image.open(os.path.join(scene_dir, 'depth', str(ann_id).zfill(4) + '.png')))
+        seg = np.array(Image.open(os.path.join(scene_dir, 'label', str(ann_id).zfill(4) + '.png')))
+        meta = scio.loadmat(os.path.join(scene_dir, 'meta', str(ann_id).zfill(4) + '.mat'))
         intrinsic = meta['intrinsic_matrix']
         factor_depth = meta['factor_depth']
         camera = CameraInfo(1280.0, 720.0, intrinsic[0][0], intrinsic[1][1], intrinsic[0][2], intrinsic[1][2],
@@ -45,105 +96,71 @@ def generate_scene(scene_id, cfgs):
 
         # remove outlier and get objectness label
         depth_mask = (depth > 0)
-        camera_poses = np.load(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                            camera_type, 'camera_poses.npy'))
         camera_pose = camera_poses[ann_id]
-        align_mat = np.load(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                            camera_type, 'cam0_wrt_table.npy'))
         trans = np.dot(align_mat, camera_pose)
         workspace_mask = get_workspace_mask(cloud, seg, trans=trans, organized=True, outlier=0.02)
         mask = (depth_mask & workspace_mask)
         cloud_masked = cloud[mask]
-        objectness_label = seg[mask]
 
         # get scene object and grasp info
-        scene_reader = xmlReader(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                                camera_type, 'annotations', '%04d.xml' % ann_id))
+        scene_reader = xmlReader(os.path.join(scene_dir, 'annotations', '%04d.xml' % ann_id))
         pose_vectors = scene_reader.getposevectorlist()
         obj_list, pose_list = get_obj_pose_list(camera_pose, pose_vectors)
-        # print(obj_list)
-        grasp_labels = {}
-        for i in obj_list:
-            file = np.load(os.path.join(dataset_root, 'grasp_label', '{}_labels.npz'.format(str(i).zfill(3))))
-            grasp_labels[i] = (file['points'].astype(np.float32), file['offsets'].astype(np.float32),
-                                file['scores'].astype(np.float32))
-
-        labels = np.load(
-            os.path.join(dataset_root, 'collision_label', 'scene_' + str(scene_id).zfill(4), 'collision_labels.npz'))
-        collision_dump = []
-        for j in range(len(labels)):
-            collision_dump.append(labels['arr_{}'.format(j)])
+        if scene_labels is None or obj_list != scene_obj_list:
+            scene_labels = load_scene_labels(dataset_root, scene_name, obj_list)
+            scene_obj_list = obj_list
         grasp_points = []
         grasp_points_graspness = []
-        for i, (obj_idx, trans_) in enumerate(zip(obj_list, pose_list)):
-            sampled_points, offsets, fric_coefs = grasp_labels[obj_idx]
-            collision = collision_dump[i]  # Npoints * num_views * num_angles * num_depths
-            num_points = sampled_points.shape[0]
-
-            valid_grasp_mask = ((fric_coefs <= fric_coef_thresh) & (fric_coefs > 0) & ~collision)
-            valid_grasp_mask = valid_grasp_mask.reshape(num_points, -1)
-            graspness = np.sum(valid_grasp_mask, axis=1) / point_grasp_num
+        for (sampled_points, graspness), trans_ in zip(scene_labels, pose_list):
             target_points = transform_points(sampled_points, trans_)
             target_points = transform_points(target_points, np.linalg.inv(camera_pose))  # fix bug
             grasp_points.append(target_points)
-            grasp_points_graspness.append(graspness.reshape(num_points, 1))
-        grasp_points = np.vstack(grasp_points)
+            grasp_points_graspness.append(graspness)
+        grasp_points = np.vstack(grasp_points).astype(np.float32)
         grasp_points_graspness = np.vstack(grasp_points_graspness)
 
-        grasp_points = torch.from_numpy(grasp_points).cuda()
-        grasp_points_graspness = torch.from_numpy(grasp_points_graspness).cuda()
-        # grasp_points = grasp_points.transpose(0, 1).contiguous().unsqueeze(0)
-
-        # masked_points_num = cloud_masked.shape[0]
-        # cloud_masked_graspness = np.zeros((masked_points_num, 1))
-        # part_num = int(masked_points_num / partition_num)
-        # for i in range(1, part_num + 2):   # lack of cuda memory
-        #     if i == part_num + 1:
-        #         cloud_masked_partial = cloud_masked[partition_num * part_num:]
-        #         if len(cloud_masked_partial) == 0:
-        #             break
-        #     else:
-        #         cloud_masked_partial = cloud_masked[partition_num * (i - 1):(i * partition_num)]
-        #     cloud_masked_partial = torch.from_numpy(cloud_masked_partial).cuda()
-        #     # cloud_masked_partial = cloud_masked_partial.transpose(0, 1).contiguous().unsqueeze(0)
-        #     # nn_inds = knn(grasp_points, cloud_masked_partial, k=1).squeeze() - 1
-        #     cloud_masked_partial = cloud_masked_partial.contiguous().unsqueeze(0)
-        #     _, nn_inds, _ = knn_points(cloud_masked_partial, grasp_points, K=1)
-        #     nn_inds = nn_inds.squeeze(-1).squeeze(0)
-    
-        #     cloud_masked_graspness[partition_num * (i - 1):(i * partition_num)] = torch.index_select(
-        #         grasp_points_graspness, 0, nn_inds).cpu().numpy()
-
-        cloud_masked = torch.from_numpy(cloud_masked).cuda()
-        grasp_points = grasp_points.contiguous().unsqueeze(0)
-        cloud_masked = cloud_masked.contiguous().unsqueeze(0)
-        _, nn_inds, _ = knn_points(cloud_masked, grasp_points, K=1)
-        nn_inds = nn_inds.squeeze(-1).squeeze(0)
-            
-        cloud_masked_graspness = torch.index_select(grasp_points_graspness, 0, nn_inds).cpu().numpy()
+        cloud_masked_graspness = nearest_graspness(cloud_masked.astype(np.float32), grasp_points,
+                                                   grasp_points_graspness, cfgs.backend)
         max_graspness = np.max(cloud_masked_graspness)
         min_graspness = np.min(cloud_masked_graspness)
         cloud_masked_graspness = (cloud_masked_graspness - min_graspness) / (max_graspness - min_graspness)
-        save_path = os.path.join(save_path_root, 'scene_' + str(scene_id).zfill(4), camera_type)
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-        np.save(os.path.join(save_path, str(ann_id).zfill(4) + '.npy'), cloud_masked_graspness)
+        save_atomic(frame_paths[ann_id], cloud_masked_graspness)
+        num_generated += 1
+
+    if cfgs.consolidate and (num_generated > 0 or not scene_done):
+        consolidate_scene_frames(frame_paths, scene_graspness_path, scene_offsets_path)
+    return scene_id, num_generated, time.time() - tic
 
 
 def parallel_generate(scene_ids, cfgs, proc = 2):
     # from multiprocessing import Pool
     ctx_in_main = multiprocessing.get_context('forkserver')
-    p = ctx_in_main.Pool(processes = proc)
-    for scene_id in scene_ids:
-        p.apply_async(generate_scene, (scene_id, cfgs))
-    p.close()
-    p.join()
+    with ctx_in_main.Pool(processes = proc) as p:
+        for scene_id, num_generated, elapsed in p.imap_unordered(generate_scene_star, [(x, cfgs) for x in scene_ids]):
+            print('scene: {} generated frames: {} time: {:.1f}s'.format(scene_id, num_generated, elapsed))
+
+
+def generate_scene_star(args):
+    return generate_scene(*args)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet')
     parser.add_argument('--camera_type', default='realsense', help='Camera split [realsense/kinect]')
+    parser.add_argument('--backend', default='kdtree', choices=['kdtree', 'cuda'], help='Nearest neighbor search, CPU KD-tree or pytorch3d knn_points [default: kdtree]')
+    parser.add_argument('--num_workers', type=int, default=12, help='Number of scenes processed in parallel [default: 12]')
+    parser.add_argument('--consolidate', action='store_true', help='Also write one float16 graspness file per scene [default: False]')
+    parser.add_argument('--queue_dir', default=None, help='Shared work queue directory, scenes are claimed by workers on any host instead of a static split [default: None]')
+    parser.add_argument('--lease', type=float, default=1800, help='Seconds a queue claim is valid without renewal [default: 1800]')
+    parser.add_argument('--poll_interval', type=float, default=60, help='Seconds between checks for expired claims of other workers once nothing is left to claim, 0 to exit right away [default: 60]')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Queue attempts per scene before it is marked failed [default: 3]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate frames whose graspness file exists [default: False]')
     cfgs = parser.parse_args()
-    
-    parallel_generate(list(range(130)), cfgs=cfgs, proc = 12)
\ No newline at end of file
+
+    if cfgs.queue_dir:
+        run_queue_workers(cfgs.queue_dir, {'scene_' + str(x).zfill(4): (x, cfgs) for x in range(130)}, generate_scene,
+                          num_workers=cfgs.num_workers, lease=cfgs.lease, max_attempts=cfgs.max_attempts,
+                          poll_interval=cfgs.poll_interval)
+    else:
+        parallel_generate(list(range(130)), cfgs=cfgs, proc = cfgs.num_workers)
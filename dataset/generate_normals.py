@@ -3,75 +3,97 @@ import os
 from PIL import Image
 import scipy.io as scio
 import sys
+import time
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(ROOT_DIR)
-from utils.data_utils import get_workspace_mask, CameraInfo, create_point_cloud_from_depth_image
+from utils.data_utils import get_workspace_mask, CameraInfo, create_point_cloud_from_depth_image, save_atomic, \
+                             get_scene_array_paths, consolidate_scene_frames
+from utils.normal_utils import estimate_normals
 import argparse
-import open3d as o3d
+from utils.work_queue import run_queue_workers
 import multiprocessing
 
 
+def load_masked_cloud(scene_dir, ann_id, camera_poses, align_mat):
+    depth = np.array(Image.open(os.path.join(scene_dir, 'depth', str(ann_id).zfill(4) + '.png')))
+    seg = np.array(Image.open(os.path.join(scene_dir, 'label', str(ann_id).zfill(4) + '.png')))
+    meta = scio.loadmat(os.path.join(scene_dir, 'meta', str(ann_id).zfill(4) + '.mat'))
+    intrinsic = meta['intrinsic_matrix']
+    factor_depth = meta['factor_depth']
+    camera = CameraInfo(1280.0, 720.0, intrinsic[0][0], intrinsic[1][1], intrinsic[0][2], intrinsic[1][2],
+                        factor_depth)
+    cloud = create_point_cloud_from_depth_image(depth, camera, organized=True)
+
+    # remove outlier and get objectness label
+    depth_mask = (depth > 0)
+    trans = np.dot(align_mat, camera_poses[ann_id])
+    workspace_mask = get_workspace_mask(cloud, seg, trans=trans, organized=True, outlier=0.02)
+    mask = (depth_mask & workspace_mask)
+    return cloud[mask].reshape(-1, 3)
+
+
 def generate_scene(scene_id, cfgs):
     dataset_root = cfgs.dataset_root   # set dataset root
     camera_type = cfgs.camera_type   # kinect / realsense
     save_path_root = os.path.join(dataset_root, 'normals')
-    for ann_id in range(256):
-        print('generating scene: {} ann: {}'.format(scene_id, ann_id))
-        depth = np.array(Image.open(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                                    camera_type, 'depth', str(ann_id).zfill(4) + '.png')))
-        seg = np.array(Image.open(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                                camera_type, 'label', str(ann_id).zfill(4) + '.png')))
-        meta = scio.loadmat(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                            camera_type, 'meta', str(ann_id).zfill(4) + '.mat'))
-        # rgb = np.array(Image.open(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-        #                                          camera_type, 'rgb', str(ann_id).zfill(4) + '.png'))) /255.0
-        intrinsic = meta['intrinsic_matrix']
-        factor_depth = meta['factor_depth']
-        camera = CameraInfo(1280.0, 720.0, intrinsic[0][0], intrinsic[1][1], intrinsic[0][2], intrinsic[1][2],
-                            factor_depth)
-        cloud = create_point_cloud_from_depth_image(depth, camera, organized=True)
+    scene_name = 'scene_' + str(scene_id).zfill(4)
+    scene_dir = os.path.join(dataset_root, 'scenes', scene_name, camera_type)
+    save_path = os.path.join(save_path_root, scene_name, camera_type)
+    os.makedirs(save_path, exist_ok=True)
+    frame_paths = [os.path.join(save_path, str(ann_id).zfill(4) + '.npy') for ann_id in range(256)]
+    scene_normal_path, scene_offsets_path = get_scene_array_paths(dataset_root, 'normals', scene_name, camera_type)
 
-        # remove outlier and get objectness label
-        depth_mask = (depth > 0)
-        camera_poses = np.load(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                            camera_type, 'camera_poses.npy'))
-        camera_pose = camera_poses[ann_id]
-        align_mat = np.load(os.path.join(dataset_root, 'scenes', 'scene_' + str(scene_id).zfill(4),
-                                            camera_type, 'cam0_wrt_table.npy'))
-        trans = np.dot(align_mat, camera_pose)
-        workspace_mask = get_workspace_mask(cloud, seg, trans=trans, organized=True, outlier=0.02)
-        mask = (depth_mask & workspace_mask)
+    tic = time.time()
+    scene_done = os.path.exists(scene_offsets_path) or not cfgs.consolidate
+    todo_ann_ids = [ann_id for ann_id in range(256) if cfgs.overwrite or not os.path.exists(frame_paths[ann_id])]
+    if len(todo_ann_ids) == 0 and scene_done:
+        return scene_id, 0, 0.0
 
-        cloud_masked = cloud[mask]
+    camera_poses = np.load(os.path.join(scene_dir, 'camera_poses.npy'))
+    align_mat = np.load(os.path.join(scene_dir, 'cam0_wrt_table.npy'))
+    for start in range(0, len(todo_ann_ids), cfgs.frames_per_call):
+        ann_ids = todo_ann_ids[start:start + cfgs.frames_per_call]
+        clouds = [load_masked_cloud(scene_dir, ann_id, camera_poses, align_mat) for ann_id in ann_ids]
+        normals = estimate_normals(clouds, radius=cfgs.radius, max_nn=cfgs.max_nn, orientation=(0., 0., -1.))
+        for ann_id, normal_masked in zip(ann_ids, normals):
+            save_atomic(frame_paths[ann_id], normal_masked.astype(np.float16))
 
-        scene = o3d.geometry.PointCloud()
-        scene.points = o3d.utility.Vector3dVector(cloud_masked.reshape(-1, 3))
-        scene.estimate_normals(o3d.geometry.KDTreeSearchParamRadius(0.015), fast_normal_computation=True)
-        scene.orient_normals_to_align_with_direction(np.array([0., 0., -1.]))
-        scene.normalize_normals()
-        normal_masked = np.asarray(scene.normals).astype(np.float16)
+    if cfgs.consolidate and (len(todo_ann_ids) > 0 or not scene_done):
+        consolidate_scene_frames(frame_paths, scene_normal_path, scene_offsets_path)
+    return scene_id, len(todo_ann_ids), time.time() - tic
 
-        save_path = os.path.join(save_path_root, 'scene_' + str(scene_id).zfill(4), camera_type)
-        os.makedirs(save_path, exist_ok=True)
-        # np.savez_compressed(os.path.join(save_path, '{:04}.npz'.format(ann_id)), normals=normal_masked)
 
-        np.save(os.path.join(save_path, str(ann_id).zfill(4) + '.npy'), normal_masked)
+def generate_scene_star(args):
+    return generate_scene(*args)
 
 
 def parallel_generate(scene_ids, cfgs, proc = 2):
     # from multiprocessing import Pool
     ctx_in_main = multiprocessing.get_context('forkserver')
-    p = ctx_in_main.Pool(processes = proc)
-    for scene_id in scene_ids:
-        p.apply_async(generate_scene, (scene_id, cfgs))
-    p.close()
-    p.join()
+    with ctx_in_main.Pool(processes = proc) as p:
+        for scene_id, num_generated, elapsed in p.imap_unordered(generate_scene_star, [(x, cfgs) for x in scene_ids]):
+            print('scene: {} generated frames: {} time: {:.1f}s'.format(scene_id, num_generated, elapsed))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataset_root', default='/data/rcao/dataset/graspnet')
     parser.add_argument('--camera_type', default='kinect', help='Camera split [realsense/kinect]')
+    parser.add_argument('--radius', type=float, default=0.015, help='Neighborhood radius [default: 0.015]')
+    parser.add_argument('--max_nn', type=int, default=None, help='Keep only the nearest max_nn neighbors inside the radius, faster [default: None]')
+    parser.add_argument('--frames_per_call', type=int, default=8, help='Frames whose normals are solved together [default: 8]')
+    parser.add_argument('--num_workers', type=int, default=10, help='Number of scenes processed in parallel [default: 10]')
+    parser.add_argument('--consolidate', action='store_true', help='Also write one float16 normal file per scene [default: False]')
+    parser.add_argument('--queue_dir', default=None, help='Shared work queue directory, scenes are claimed by workers on any host instead of a static split [default: None]')
+    parser.add_argument('--lease', type=float, default=1800, help='Seconds a queue claim is valid without renewal [default: 1800]')
+    parser.add_argument('--poll_interval', type=float, default=60, help='Seconds between checks for expired claims of other workers once nothing is left to claim, 0 to exit right away [default: 60]')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Queue attempts per scene before it is marked failed [default: 3]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate frames whose normal file exists [default: False]')
     cfgs = parser.parse_args()
-    
-    parallel_generate(list(range(190)), cfgs=cfgs, proc = 10)
\ No newline at end of file
+
+    if cfgs.queue_dir:
+        run_queue_workers(cfgs.queue_dir, {'scene_' + str(x).zfill(4): (x, cfgs) for x in range(190)}, generate_scene,
+                          num_workers=cfgs.num_workers, lease=cfgs.lease, max_attempts=cfgs.max_attempts,
+                          poll_interval=cfgs.poll_interval)
+    else:
+        parallel_generate(list(range(190)), cfgs=cfgs, proc = cfgs.num_workers)
@@ -0,0 +1,243 @@
+""" Simplified grasp labels from the full per-object grasp labels.
+    grasp_label/xxx_labels.npz holds points (Np,3), offsets (Np,V,A,D,3) (angle, depth, width) and
+    scores (Np,V,A,D); grasp_label_simplified/xxx_labels.npz keeps points, width = offsets[...,2]
+    and scores. The npz members are streamed in chunks of grasp points in both directions, so the
+    memory of a conversion is bounded by --chunk_mb instead of the size of the object labels.
+
+    --quantize stores widths as float16 and scores as int8 tenths (scores_x10, decoded by
+    utils.data_utils.load_label_scores). Scores are friction coefficients in steps of 0.1 and must
+    come back exactly: float16 would turn 0.6 into 0.6001 and flip the score <= 0.6 graspness masks.
+
+    python dataset/generate_simplified_label.py --dataset_root /data/graspnet --quantize
+    python dataset/generate_simplified_label.py --dataset_root /data/graspnet --check
+    python dataset/generate_simplified_label.py --self_test
+"""
+
+import os
+import sys
+import time
+import zipfile
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from utils.data_utils import decode_quantized_scores
+
+# friction coefficient threshold of the graspness masks, (scores > 0) & (scores <= 0.6)
+FRIC_COEF_THRESH = 0.6
+
+
+def open_npz_member(zf, key):
+    """ Open one array of an npz file for sequential reading.
+
+        Output:
+            shape: [tuple of int]
+            dtype: [np.dtype]
+            fp: [file object]
+                positioned at the first array byte
+    """
+    fp = zf.open(key + '.npy')
+    version = np.lib.format.read_magic(fp)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+    if fortran_order:
+        raise ValueError('{} is stored in Fortran order and cannot be streamed by rows'.format(key))
+    return shape, dtype, fp
+
+
+def iter_npz_rows(path, key, chunk_bytes=None, chunk_rows=None):
+    """ Yield consecutive chunks of rows (first axis) of an npz array, chunk_rows rows or about
+        chunk_bytes bytes per chunk.
+    """
+    with zipfile.ZipFile(path) as zf:
+        shape, dtype, fp = open_npz_member(zf, key)
+        row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+        if chunk_rows is None:
+            chunk_rows = max(1, chunk_bytes // max(row_bytes, 1))
+        with fp:
+            for start in range(0, shape[0], chunk_rows):
+                num_rows = min(chunk_rows, shape[0] - start)
+                buffer = fp.read(num_rows * row_bytes)
+                yield np.frombuffer(buffer, dtype=dtype).reshape((num_rows,) + tuple(shape[1:]))
+
+
+def npz_member_shape(path, key):
+    with zipfile.ZipFile(path) as zf:
+        shape, dtype, fp = open_npz_member(zf, key)
+        fp.close()
+    return shape, dtype
+
+
+def write_npz_member(zf, key, shape, dtype, chunks):
+    """ Write an array given as chunks of rows into an open npz (zip) file. """
+    with zf.open(key + '.npy', 'w', force_zip64=True) as fp:
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)}
+        np.lib.format.write_array_header_2_0(fp, header)
+        num_rows = 0
+        for chunk in chunks:
+            fp.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+            num_rows += len(chunk)
+    if num_rows != shape[0]:
+        raise IOError('{}: wrote {} rows, expected {}'.format(key, num_rows, shape[0]))
+
+
+def quantize_scores(scores):
+    """ int8 tenths of friction scores, raises if they do not decode exactly (load_label_scores). """
+    scores_x10 = np.round(scores.astype(np.float64) * 10)
+    if np.abs(scores_x10).max(initial=0) > 127 or \
+            not np.array_equal(scores_x10.astype(np.float32) / np.float32(10), scores.astype(np.float32)):
+        raise ValueError('scores are not multiples of 0.1 and cannot be quantized exactly, run without --quantize')
+    return scores_x10.astype(np.int8)
+
+
+def graspness_mask(scores):
+    return (scores > 0) & (scores <= FRIC_COEF_THRESH)
+
+
+def label_paths(obj_idx, cfgs):
+    obj_name = str(obj_idx).zfill(3)
+    src_path = os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(obj_name))
+    dst_path = os.path.join(cfgs.dataset_root, cfgs.save_name, '{}_labels.npz'.format(obj_name))
+    return src_path, dst_path
+
+
+def simplify_object(obj_idx, cfgs):
+    src_path, dst_path = label_paths(obj_idx, cfgs)
+    if os.path.exists(dst_path) and not cfgs.overwrite:
+        return obj_idx, 0.0, None
+
+    tic = time.time()
+    chunk_bytes = int(cfgs.chunk_mb * (1 << 20))
+    points = np.load(src_path)['points']
+    offsets_shape, offsets_dtype = npz_member_shape(src_path, 'offsets')
+    scores_shape, scores_dtype = npz_member_shape(src_path, 'scores')
+    width_dtype = np.float16 if cfgs.quantize else offsets_dtype
+    scores_chunks = iter_npz_rows(src_path, 'scores', chunk_bytes)
+    if cfgs.quantize:
+        scores_key, scores_dtype = 'scores_x10', np.int8
+        scores_chunks = (quantize_scores(chunk) for chunk in scores_chunks)
+    else:
+        scores_key = 'scores'
+
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = dst_path + '.tmp'
+    compression = zipfile.ZIP_DEFLATED if cfgs.compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(tmp_path, 'w', compression=compression, allowZip64=True) as zf:
+        write_npz_member(zf, 'points', points.shape, points.dtype, [points])
+        write_npz_member(zf, 'width', offsets_shape[:-1], width_dtype,
+                         (chunk[..., 2] for chunk in iter_npz_rows(src_path, 'offsets', chunk_bytes)))
+        write_npz_member(zf, scores_key, scores_shape, scores_dtype, scores_chunks)
+    os.replace(tmp_path, dst_path)
+    return obj_idx, time.time() - tic, None
+
+
+def check_object(obj_idx, cfgs):
+    """ Compare an existing simplified label file with the full labels, chunk by chunk.
+
+        Output:
+            report: [dict]
+                max absolute width/score error, number of grasps off by more than cfgs.atol,
+                whether points and shapes match, and for scores the number of changed scores and
+                of grasps whose graspness mask flips (both must be 0)
+    """
+    src_path, dst_path = label_paths(obj_idx, cfgs)
+    tic = time.time()
+    if not os.path.exists(dst_path):
+        return obj_idx, time.time() - tic, {'missing': True}
+    chunk_bytes = int(cfgs.chunk_mb * (1 << 20))
+    src, dst = np.load(src_path), np.load(dst_path)
+    report = {'points_equal': bool(np.array_equal(src['points'], dst['points']))}
+    scores_key = 'scores_x10' if 'scores_x10' in dst.files else 'scores'
+    for key, dst_key, src_key, index in [('width', 'width', 'offsets', 2), ('scores', scores_key, 'scores', None)]:
+        src_shape, src_dtype = npz_member_shape(src_path, src_key)
+        dst_shape, _ = npz_member_shape(dst_path, dst_key)
+        expected_shape = src_shape[:-1] if index is not None else src_shape
+        if tuple(dst_shape) != tuple(expected_shape):
+            report[key + '_shape'] = (tuple(dst_shape), tuple(expected_shape))
+            continue
+        max_error, num_bad, num_changed, num_mask_flips = 0.0, 0, 0, 0
+        chunk_rows = max(1, chunk_bytes // (int(np.prod(src_shape[1:])) * src_dtype.itemsize))
+        for src_chunk, dst_chunk in zip(iter_npz_rows(src_path, src_key, chunk_rows=chunk_rows),
+                                        iter_npz_rows(dst_path, dst_key, chunk_rows=chunk_rows)):
+            if index is not None:
+                src_chunk = src_chunk[..., index]
+            src_chunk = src_chunk.astype(np.float32)
+            if dst_key == 'scores_x10':
+                dst_chunk = decode_quantized_scores(dst_chunk)
+            dst_chunk = dst_chunk.astype(np.float32)
+            error = np.abs(src_chunk - dst_chunk)
+            max_error = max(max_error, float(error.max()))
+            num_bad += int(np.sum(error > cfgs.atol))
+            if key == 'scores':
+                num_changed += int(np.sum(src_chunk != dst_chunk))
+                num_mask_flips += int(np.sum(graspness_mask(src_chunk) != graspness_mask(dst_chunk)))
+        report[key + '_max_error'] = max_error
+        report[key + '_num_bad'] = num_bad
+        if key == 'scores':
+            report['scores_num_changed'] = num_changed
+            report['scores_mask_flips'] = num_mask_flips
+    return obj_idx, time.time() - tic, report
+
+
+def self_test(cfgs):
+    """ Round trip of a synthetic object through --quantize and --check: widths within atol, scores
+        unchanged and no graspness mask flips. float16 scores are shown for comparison.
+    """
+    rng = np.random.RandomState(0)
+    num_points, V, A, D = 64, 300, 12, 4
+    fric_coefs = np.array([-1.0, 0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0], dtype=np.float32)
+    scores = fric_coefs[rng.randint(len(fric_coefs), size=(num_points, V, A, D))]
+    offsets = rng.rand(num_points, V, A, D, 3).astype(np.float32) * 0.1
+    with tempfile.TemporaryDirectory() as root:
+        test_cfgs = argparse.Namespace(**dict(vars(cfgs), dataset_root=root, quantize=True, overwrite=True))
+        src_path, dst_path = label_paths(0, test_cfgs)
+        os.makedirs(os.path.dirname(src_path))
+        np.savez(src_path, points=rng.rand(num_points, 3).astype(np.float32), offsets=offsets, scores=scores)
+        simplify_object(0, test_cfgs)
+        _, _, report = check_object(0, test_cfgs)
+    float16_flips = int(np.sum(graspness_mask(scores) != graspness_mask(scores.astype(np.float16).astype(np.float32))))
+    print('quantized round trip: {}'.format(report))
+    print('float16 scores would flip {} graspness masks'.format(float16_flips))
+    assert report['points_equal'] and report['width_num_bad'] == 0
+    assert report['scores_num_changed'] == 0 and report['scores_mask_flips'] == 0
+    print('self test passed')
+
+
+def process_object_star(args):
+    func, obj_idx, cfgs = args
+    return func(obj_idx, cfgs)
+
+
+def parallel_process(obj_idxs, func, cfgs, proc = 2):
+    ctx_in_main = multiprocessing.get_context('forkserver')
+    with ctx_in_main.Pool(processes = proc) as p:
+        for obj_idx, elapsed, report in p.imap_unordered(process_object_star, [(func, x, cfgs) for x in obj_idxs]):
+            print('object: {} time: {:.1f}s{}'.format(obj_idx, elapsed, '' if report is None else ' ' + str(report)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet')
+    parser.add_argument('--save_name', default='grasp_label_simplified', help='Output directory under dataset_root [default: grasp_label_simplified]')
+    parser.add_argument('--obj_start', type=int, default=0, help='First object [default: 0]')
+    parser.add_argument('--obj_end', type=int, default=88, help='Last object (exclusive) [default: 88]')
+    parser.add_argument('--chunk_mb', type=float, default=256, help='Bytes of source rows held per chunk, in MB [default: 256]')
+    parser.add_argument('--quantize', action='store_true', help='Store widths as float16 and scores as int8 tenths [default: False]')
+    parser.add_argument('--no_compress', dest='compress', action='store_false', help='Store npz members uncompressed [default: False]')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of objects processed in parallel [default: 4]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate objects whose simplified file exists [default: False]')
+    parser.add_argument('--check', action='store_true', help='Compare existing simplified files with the full labels instead of writing [default: False]')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Check tolerance of widths, float16 rounding is below it [default: 1e-3]')
+    parser.add_argument('--self_test', action='store_true', help='Check the quantized round trip on a synthetic object and exit [default: False]')
+    cfgs = parser.parse_args()
+
+    if cfgs.self_test:
+        self_test(cfgs)
+        sys.exit(0)
+
+    func = check_object if cfgs.check else simplify_object
+    parallel_process(list(range(cfgs.obj_start, cfgs.obj_end)), func, cfgs, proc = cfgs.num_workers)
@@ -1,5 +1,10 @@
 """ Tolerance label generation.
     Author: chenxi-wang
+
+    For every grasp point the tolerance of a (view, angle, depth) grasp is the largest radius in
+    radius_list whose ball still has enough positive neighbors. Neighbors within the largest
+    radius come from a KD-tree, each neighbor is binned by the smallest radius containing it, and
+    the sweep over all radii is a cumulative sum of per-bin positive counts for a chunk of points.
 """
 
 import os
@@ -8,95 +13,151 @@ import numpy as np
 import time
 import argparse
 import multiprocessing as mp
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-ROOT_DIR = os.path.dirname(BASE_DIR)
-sys.path.append(os.path.join(ROOT_DIR, 'utils'))
-from data_utils import compute_point_dists
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--dataset_root', required=True, help='Dataset root')
-parser.add_argument('--pos_ratio_thresh', type=float, default=0.8, help='Threshold of positive neighbor ratio[default: 0.8]')
-parser.add_argument('--mu_thresh', type=float, default=0.55, help='Threshold of friction coefficient[default: 0.55]')
-parser.add_argument('--num_workers', type=int, default=50, help='Worker number[default: 50]')
-cfgs = parser.parse_args()
-
-save_path = 'tolerance'
+from scipy.spatial import cKDTree
+from scipy import sparse
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from utils.work_queue import run_queue_workers
 
 V = 300
 A = 12
 D = 4
 radius_list = [0.001 * x for x in range(51)]
 
-def manager(obj_name, pool_size=8):
-    # load models
-    label_path = '{}_labels.npz'.format(obj_name)
-    label = np.load(os.path.join(cfgs.dataset_root, 'grasp_label', label_path))
-    points = label['points']
-    scores = label['scores']
 
-    # create dict
-    tolerance = mp.Manager().dict()
-    dists = compute_point_dists(points, points)
-    params = params = (scores, dists)
-
-    # assign works
-    pool = []
-    process_cnt = 0
-    work_list = [x for x in range(len(points))]
-    for _ in range(pool_size):
-        point_ind = work_list.pop(0)
-        pool.append(mp.Process(target=worker, args=(obj_name, point_ind, params, tolerance)))
-    [p.start() for p in pool]
-
-    # refill
-    while len(work_list) > 0:
-        for ind, p in enumerate(pool):
-            if not p.is_alive():
-                pool.pop(ind)
-                point_ind = work_list.pop(0)
-                p = mp.Process(target=worker, args=(obj_name, point_ind, params, tolerance))
-                p.start()
-                pool.append(p)
-                process_cnt += 1
-                print('{}/{}'.format(process_cnt, len(points)))
-                break
-    while len(pool) > 0:
-        for ind, p in enumerate(pool):
-            if not p.is_alive():
-                pool.pop(ind)
-                process_cnt += 1
-                print('{}/{}'.format(process_cnt, len(points)))
+def compute_tolerance(points, scores, radii, mu_thresh, pos_ratio_thresh, chunk_size=16):
+    """ Vectorized tolerance labels of one object.
+
+        Input:
+            points: [np.ndarray, (Np,3), np.float32]
+            scores: [np.ndarray, (Np,V,A,D), np.float32]
+            radii: [np.ndarray, (R,)]
+                ascending ball radii
+            chunk_size: [int]
+                number of points swept at once, peak memory is about chunk_size*R*V*A*D*4 bytes
+
+        Output:
+            tolerance: [np.ndarray, (Np,V,A,D), np.float32]
+    """
+    num_points = len(points)
+    num_radii = len(radii)
+    positive = ((scores > 0) & (scores <= mu_thresh)).reshape(num_points, -1).astype(np.float32)
+    # smallest positive count passing pos_cnt/ball_cnt >= pos_ratio_thresh for every ball size,
+    # so the sweep compares integer counts and gives the same result as the float ratio
+    ball_sizes = np.arange(num_points + 1)
+    min_pos_cnt = np.ceil(pos_ratio_thresh * ball_sizes)
+    for _ in range(2):
+        min_pos_cnt[(min_pos_cnt > 0) & ((min_pos_cnt - 1) / np.maximum(ball_sizes, 1) >= pos_ratio_thresh)] -= 1
+        min_pos_cnt[min_pos_cnt / np.maximum(ball_sizes, 1) < pos_ratio_thresh] += 1
+
+    # neighbor pairs within the largest radius, distances recomputed like compute_point_dists
+    tree = cKDTree(points)
+    pairs = tree.query_pairs(radii[-1] * (1 + 1e-4) + 1e-6, output_type='ndarray')
+    pairs = np.concatenate([pairs, pairs[:, ::-1], np.stack([np.arange(num_points)] * 2, axis=1)], axis=0)
+    dists = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=-1)
+    # smallest radius index k with dist <= radii[k]
+    bins = np.searchsorted(radii, dists, side='left')
+    valid = bins < num_radii
+    pairs, bins = pairs[valid], bins[valid]
+    order = np.argsort(pairs[:, 0], kind='stable')
+    pairs, bins = pairs[order], bins[order]
+    starts = np.searchsorted(pairs[:, 0], np.arange(num_points + 1))
+
+    tolerance = np.zeros([num_points, positive.shape[1]], dtype=np.float32)
+    for chunk_start in range(0, num_points, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_points)
+        lo, hi = starts[chunk_start], starts[chunk_end]
+        rows = (pairs[lo:hi, 0] - chunk_start) * num_radii + bins[lo:hi]
+        shape = ((chunk_end - chunk_start) * num_radii, num_points)
+        ball_hist = sparse.csr_matrix((np.ones(hi - lo, dtype=np.float32), (rows, pairs[lo:hi, 1])), shape=shape)
+        # (chunk, R, V*A*D) positive counts and (chunk, R) neighbor counts inside every ball
+        pos_cnt = (ball_hist @ positive).reshape(-1, num_radii, positive.shape[1])
+        ball_cnt = np.cumsum(np.asarray(ball_hist.sum(axis=1)).reshape(-1, num_radii), axis=1).astype(np.int64)
+        chunk_tolerance = np.zeros([chunk_end - chunk_start, positive.shape[1]], dtype=np.float32)
+        active = np.ones(chunk_end - chunk_start, dtype=bool)
+        for k in range(num_radii):
+            if k > 0:
+                pos_cnt[:, k] += pos_cnt[:, k - 1]
+            tolerance_mask = pos_cnt[:, k] >= min_pos_cnt[ball_cnt[:, k]][:, np.newaxis]
+            # the sweep of a point stops at the first radius without any tolerant grasp
+            active &= tolerance_mask.any(axis=1)
+            if not active.any():
                 break
+            tolerance_mask &= active[:, np.newaxis]
+            np.copyto(chunk_tolerance, radii[k], where=tolerance_mask)
+        tolerance[chunk_start:chunk_end] = chunk_tolerance
+    return tolerance.reshape(scores.shape)
+
 
-    # save tolerance
-    if not os.path.exists(save_path):
-        os.mkdir(save_path)
-    saved_tolerance = [None for _ in range(len(points))]
-    for i in range(len(points)):
-        saved_tolerance[i] = tolerance[i]
-    saved_tolerance = np.array(saved_tolerance)
-    np.save('{}/{}_tolerance.npy'.format(save_path, obj_name), saved_tolerance)
-
-def worker(obj_name, point_ind, params, tolerance):
-    scores, dists = params
+def reference_tolerance(points, scores, point_ind, radii, mu_thresh, pos_ratio_thresh):
+    """ Per-point radius sweep of the original generator, used by --verify_num. """
+    dists = np.linalg.norm(points - points[point_ind], axis=-1)
     tmp_tolerance = np.zeros([V, A, D], dtype=np.float32)
-    tic = time.time()
-    for r in radius_list:
-        dist_mask = (dists[point_ind] <= r)
+    for r in radii:
+        dist_mask = (dists <= r)
         scores_in_ball = scores[dist_mask]
-        pos_ratio = ((scores_in_ball > 0) & (scores_in_ball <= cfgs.mu_thresh)).mean(axis=0)
-        tolerance_mask = (pos_ratio >= cfgs.pos_ratio_thresh)
+        pos_ratio = ((scores_in_ball > 0) & (scores_in_ball <= mu_thresh)).mean(axis=0)
+        tolerance_mask = (pos_ratio >= pos_ratio_thresh)
         if tolerance_mask.sum() == 0:
             break
         tmp_tolerance[tolerance_mask] = r
-    tolerance[point_ind] = tmp_tolerance
-    toc = time.time()
-    print("{}: point {} time".format(obj_name, point_ind), toc - tic)
+    return tmp_tolerance
+
+
+def worker(obj_name, cfgs):
+    save_file = os.path.join(cfgs.save_path, '{}_tolerance.npy'.format(obj_name))
+    if os.path.exists(save_file) and not cfgs.overwrite:
+        return obj_name, None
+    tic = time.time()
+    label = np.load(os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(obj_name)))
+    points = label['points']
+    scores = label['scores']
+    radii = np.array(radius_list)
+    tolerance = compute_tolerance(points, scores, radii, cfgs.mu_thresh, cfgs.pos_ratio_thresh, cfgs.chunk_size)
+
+    if cfgs.verify_num > 0:
+        for point_ind in np.random.choice(len(points), min(cfgs.verify_num, len(points)), replace=False):
+            ref = reference_tolerance(points, scores, point_ind, radius_list, cfgs.mu_thresh, cfgs.pos_ratio_thresh)
+            if not np.array_equal(ref, tolerance[point_ind]):
+                raise RuntimeError('{}: tolerance of point {} differs from the reference'.format(obj_name, point_ind))
+
+    # write to a temporary file first, an interrupted job never leaves a truncated label behind
+    tmp_file = os.path.join(cfgs.save_path, '{}_tolerance.tmp.npy'.format(obj_name))
+    np.save(tmp_file, tolerance)
+    os.replace(tmp_file, save_file)
+    return obj_name, time.time() - tic
+
+
+def worker_star(args):
+    return worker(*args)
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', required=True, help='Dataset root')
+    parser.add_argument('--pos_ratio_thresh', type=float, default=0.8, help='Threshold of positive neighbor ratio[default: 0.8]')
+    parser.add_argument('--mu_thresh', type=float, default=0.55, help='Threshold of friction coefficient[default: 0.55]')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of objects processed in parallel[default: 8]')
+    parser.add_argument('--chunk_size', type=int, default=16, help='Points swept over all radii at once, memory grows linearly[default: 16]')
+    parser.add_argument('--save_path', default='tolerance', help='Output directory[default: tolerance]')
+    parser.add_argument('--queue_dir', default=None, help='Shared work queue directory, objects are claimed by workers on any host[default: None]')
+    parser.add_argument('--lease', type=float, default=1800, help='Seconds a queue claim is valid without renewal[default: 1800]')
+    parser.add_argument('--poll_interval', type=float, default=60, help='Seconds between checks for expired claims of other workers once nothing is left to claim, 0 to exit right away[default: 60]')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Queue attempts per object before it is marked failed[default: 3]')
+    parser.add_argument('--overwrite', action='store_true', help='Regenerate objects whose tolerance file exists[default: False]')
+    parser.add_argument('--verify_num', type=int, default=0, help='Compare this many points per object with the per-point reference[default: 0]')
+    cfgs = parser.parse_args()
+
+    os.makedirs(cfgs.save_path, exist_ok=True)
     obj_list = ['%03d' % x for x in range(88)]
-    for obj_name in obj_list:
-        p = mp.Process(target=manager, args=(obj_name, cfgs.num_workers))
-        p.start()
-        p.join()
\ No newline at end of file
+    if cfgs.queue_dir:
+        run_queue_workers(cfgs.queue_dir, {x: (x, cfgs) for x in obj_list}, worker,
+                          num_workers=cfgs.num_workers, lease=cfgs.lease, max_attempts=cfgs.max_attempts,
+                          poll_interval=cfgs.poll_interval)
+    else:
+        with mp.Pool(cfgs.num_workers) as pool:
+            for obj_name, elapsed in pool.imap_unordered(worker_star, [(x, cfgs) for x in obj_list]):
+                if elapsed is None:
+                    print('{}: exists, skipped'.format(obj_name))
+                else:
+                    print('{}: time {:.1f}s'.format(obj_name, elapsed))
\ No newline at end of file
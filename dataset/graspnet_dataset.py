@@ -16,11 +16,14 @@ from tqdm import tqdm
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(BASE_DIR)
 from utils.data_utils import CameraInfo, transform_point_cloud, create_point_cloud_from_depth_image,\
-                            get_workspace_mask, remove_invisible_grasp_points
+                            get_workspace_mask, remove_invisible_grasp_points, get_scene_array_paths,\
+                            load_scene_frame, load_label_scores
+from dataset.packed_index import pack_dataset_index
 
 class GraspNetDataset(Dataset):
     def __init__(self, root, valid_obj_idxs, grasp_labels, camera='kinect', split='train', num_points=20000,
-                 remove_outlier=False, voxel_size=0.005, remove_invisible=True, augment=False, load_label=True):
+                 remove_outlier=False, voxel_size=0.005, remove_invisible=True, augment=False, load_label=True, pack_labels=False, packed_index=False,
+                 scene_graspness=False, scene_normals=False):
         assert(num_points<=50000)
         self.root = root
         self.split = split
@@ -32,6 +35,10 @@ class GraspNetDataset(Dataset):
         self.camera = camera
         self.augment = augment
         self.load_label = load_label    
+        self.pack_labels = pack_labels
+        self.scene_graspness = scene_graspness
+        self.scene_normals = scene_normals
+        self.scene_arrays = {}
         self.collision_labels = {}
         self.voxel_size = voxel_size
 
@@ -72,9 +79,33 @@ class GraspNetDataset(Dataset):
                 for i in range(len(collision_labels)):
                     self.collision_labels[x.strip()][i] = collision_labels['arr_{}'.format(i)]
 
+        # keep worker memory flat with forked dataloader workers
+        if packed_index:
+            pack_dataset_index(self, ['colorpath', 'depthpath', 'labelpath', 'metapath', 'normalpath', 'graspnesspath',
+                                      'scenename'], {'frameid': np.int32})
+
     def scene_list(self):
         return self.scenename
 
+    def load_scene_frame(self, name, index):
+        scene = self.scenename[index]
+        if (name, scene) not in self.scene_arrays:
+            # memory-mapped, opened lazily so every worker maps the consolidated files itself
+            values_path, offsets_path = get_scene_array_paths(self.root, name, scene, self.camera)
+            self.scene_arrays[(name, scene)] = (np.load(values_path, mmap_mode='r'), np.load(offsets_path))
+        values, offsets = self.scene_arrays[(name, scene)]
+        return load_scene_frame(values, offsets, self.frameid[index])
+
+    def load_graspness(self, index):
+        if self.scene_graspness:
+            return self.load_scene_frame('graspness', index)
+        return np.load(self.graspnesspath[index])
+
+    def load_normals(self, index):
+        if self.scene_normals:
+            return self.load_scene_frame('normals', index)
+        return np.load(self.normalpath[index])
+
     def __len__(self):
         return len(self.depthpath)
 
@@ -111,7 +142,7 @@ class GraspNetDataset(Dataset):
         depth = np.array(Image.open(self.depthpath[index]))
         seg = np.array(Image.open(self.labelpath[index]))
         meta = scio.loadmat(self.metapath[index])
-        normal = np.load(self.normalpath[index])
+        normal = self.load_normals(index)
         scene = self.scenename[index]
         try:
             intrinsic = meta['intrinsic_matrix']
@@ -165,8 +196,8 @@ class GraspNetDataset(Dataset):
         seg = np.array(Image.open(self.labelpath[index]))
         meta = scio.loadmat(self.metapath[index])
         scene = self.scenename[index]
-        graspness = np.load(self.graspnesspath[index])  # for each point in workspace masked point cloud
-        normal = np.load(self.normalpath[index])
+        graspness = self.load_graspness(index)  # for each point in workspace masked point cloud
+        normal = self.load_normals(index)
         try:
             obj_idxs = meta['cls_indexes'].flatten().astype(np.int32)
             poses = meta['poses']
@@ -259,10 +290,13 @@ class GraspNetDataset(Dataset):
 
         ret_dict['graspness_label'] = graspness_sampled.astype(np.float32)
         ret_dict['objectness_label'] = objectness_label.astype(np.int64)
-        ret_dict['object_poses_list'] = object_poses_list
-        ret_dict['grasp_points_list'] = grasp_points_list
-        ret_dict['grasp_offsets_list'] = grasp_offsets_list
-        ret_dict['grasp_labels_list'] = grasp_scores_list
+        if self.pack_labels:
+            ret_dict.update(pack_object_labels(object_poses_list, grasp_points_list, grasp_offsets_list, grasp_scores_list))
+        else:
+            ret_dict['object_poses_list'] = object_poses_list
+            ret_dict['grasp_points_list'] = grasp_points_list
+            ret_dict['grasp_offsets_list'] = grasp_offsets_list
+            ret_dict['grasp_labels_list'] = grasp_scores_list
         # ret_dict['grasp_tolerance_list'] = grasp_tolerance_list
 
         return ret_dict
@@ -283,15 +317,61 @@ def load_grasp_labels(root):
         #                           label['scores'].astype(np.float32), tolerance)
         label = np.load(os.path.join(root, 'grasp_label_simplified', '{}_labels.npz'.format(str(obj_idx).zfill(3))))
         grasp_labels[obj_idx+1] = (label['points'].astype(np.float32), label['width'].astype(np.float32),
-                                  label['scores'].astype(np.float32))
+                                  load_label_scores(label))
     return valid_obj_idxs, grasp_labels
 
 
+PACKED_LABEL_KEYS = ['packed_object_poses', 'packed_grasp_points', 'packed_grasp_offsets', 'packed_grasp_labels',
+                     'packed_grasp_point_nums']
+
+
+def pack_object_labels(object_poses_list, grasp_points_list, grasp_offsets_list, grasp_scores_list):
+    """ Concatenate per-object grasp labels of one scene into flat arrays.
+
+        Input:
+            object_poses_list: [list of numpy.ndarray, [(3,4),]]
+            grasp_points_list: [list of numpy.ndarray, [(Np_i,3),]]
+            grasp_offsets_list: [list of numpy.ndarray, [(Np_i,V,A,D),]]
+            grasp_scores_list: [list of numpy.ndarray, [(Np_i,V,A,D),]]
+
+        Output:
+            packed: [dict]
+                'packed_object_poses': (No,3,4), 'packed_grasp_points': (sum(Np_i),3),
+                'packed_grasp_offsets'/'packed_grasp_labels': (sum(Np_i),V,A,D),
+                'packed_grasp_point_nums': (No,) number of grasp points of each object
+    """
+    packed = {}
+    packed['packed_object_poses'] = np.stack(object_poses_list, 0).astype(np.float32)
+    packed['packed_grasp_points'] = np.concatenate(grasp_points_list, 0).astype(np.float32)
+    packed['packed_grasp_offsets'] = np.concatenate(grasp_offsets_list, 0).astype(np.float32)
+    packed['packed_grasp_labels'] = np.concatenate(grasp_scores_list, 0).astype(np.float32)
+    packed['packed_grasp_point_nums'] = np.array([len(x) for x in grasp_points_list], dtype=np.int64)
+    return packed
+
+
+def collate_packed_labels(batch):
+    """ Collate packed labels of a batch by concatenation, object and grasp point boundaries
+        are kept as offsets: the objects of sample i are packed_object_offsets[i]:packed_object_offsets[i+1]
+        and the grasp points of object j are packed_grasp_point_offsets[j]:packed_grasp_point_offsets[j+1].
+    """
+    res = {}
+    for key in PACKED_LABEL_KEYS[:-1]:
+        res[key] = torch.from_numpy(np.concatenate([d[key] for d in batch], 0))
+    object_nums = torch.tensor([len(d['packed_object_poses']) for d in batch], dtype=torch.int64)
+    point_nums = torch.from_numpy(np.concatenate([d['packed_grasp_point_nums'] for d in batch], 0))
+    res['packed_object_offsets'] = torch.cat([object_nums.new_zeros(1), torch.cumsum(object_nums, 0)])
+    res['packed_grasp_point_offsets'] = torch.cat([point_nums.new_zeros(1), torch.cumsum(point_nums, 0)])
+    return res
+
+
 def collate_fn(batch):
     if type(batch[0]).__module__ == 'numpy':
         return torch.stack([torch.from_numpy(b) for b in batch], 0)
     elif isinstance(batch[0], container_abcs.Mapping):
-        return {key:collate_fn([d[key] for d in batch]) for key in batch[0]}
+        res = {key:collate_fn([d[key] for d in batch]) for key in batch[0] if key not in PACKED_LABEL_KEYS}
+        if 'packed_object_poses' in batch[0]:
+            res.update(collate_packed_labels(batch))
+        return res
     elif isinstance(batch[0], container_abcs.Sequence):
         return [[torch.from_numpy(sample) for sample in b] for b in batch]
     
@@ -317,9 +397,11 @@ def minkowski_collate_fn(list_data):
             return [[torch.from_numpy(sample) for sample in b] for b in batch]
         elif isinstance(batch[0], container_abcs.Mapping):
             for key in batch[0]:
-                if key == 'coors' or key == 'feats':
+                if key == 'coors' or key == 'feats' or key in PACKED_LABEL_KEYS:
                     continue
                 res[key] = collate_fn_([d[key] for d in batch])
+            if 'packed_object_poses' in batch[0]:
+                res.update(collate_packed_labels(batch))
             return res
     res = collate_fn_(list_data)
 
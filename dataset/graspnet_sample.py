@@ -1,5 +1,16 @@
+""" Export a subset of GraspNet frames (debugging / benchmark samples).
+    Files are hardlinked when source and destination share a filesystem, reflinked where the
+    filesystem supports it, and copied by a thread pool otherwise. Every file is checked against
+    the source size and the exported frames are listed in sample_manifest.json. Each export merges
+    its frames into the manifest, so scenes exported by earlier runs or pipeline units are kept.
+"""
+
 import os
-from shutil import copyfile
+import json
+import errno
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 result_root = 'graspnet_sample'
 dataset_root = '/media/gpuadmin/rcao/dataset/graspnet'
@@ -8,64 +19,160 @@ dataset_save_root = os.path.join('/media/gpuadmin/rcao/dataset', result_root)
 width = 1280
 height = 720
 
-for camera in ['realsense', 'kinect']:
-    for scene_idx in range(190):
-        for anno_idx in [0, 128, 255]:
-            print("camera:{}, scene index:{}, anno index:{}".format(camera, scene_idx, anno_idx))
-
-            rgb_path = os.path.join(dataset_root, 'scenes/scene_{:04d}/{}/rgb/{:04d}.png'.format(scene_idx, camera, anno_idx))
-            depth_path = os.path.join(dataset_root, 'scenes/scene_{:04d}/{}/depth/{:04d}.png'.format(scene_idx, camera, anno_idx))
-            meta_path = os.path.join(dataset_root, 'scenes/scene_{:04d}/{}/meta/{:04d}.mat'.format(scene_idx, camera, anno_idx))
-            label_path = os.path.join(dataset_root, 'scenes/scene_{:04d}/{}/label/{:04d}.png'.format(scene_idx, camera, anno_idx))
-            
-            virtual_rgb_path = os.path.join(dataset_root, 'virtual_scenes/scene_{:04d}/{}/{:04d}_rgb.png'.format(scene_idx, camera, anno_idx))
-            virtual_depth_path = os.path.join(dataset_root, 'virtual_scenes/scene_{:04d}/{}/{:04d}_depth.png'.format(scene_idx, camera, anno_idx))
-            virtual_mask_depth = os.path.join(dataset_root, 'virtual_scenes/scene_{:04d}/{}/{:04d}_label.png'.format(scene_idx, camera, anno_idx))
-            
-            if scene_idx in range(100, 190):
-                seg_path = os.path.join(dataset_root, '{}_mask/scene_{:04d}/{}/{:04d}.png'.format(seg_method, scene_idx, camera, anno_idx))
-                seg_save_root = os.path.join(dataset_save_root, '{}_mask/scene_{:04d}/{}'.format(seg_method, scene_idx, camera))
-                os.makedirs(seg_save_root, exist_ok=True)
-                copyfile(seg_path, os.path.join(seg_save_root, '{:04d}.png'.format(anno_idx)))
-            
-            camera_pose_path = os.path.join(dataset_root, 'scenes/scene_{:04d}/{}/camera_poses.npy'.format(scene_idx, camera))
-            camera_pose_save_root = os.path.join(dataset_save_root, 'scenes', 'scene_{:04d}/{}'.format(scene_idx, camera))
-            os.makedirs(camera_pose_save_root, exist_ok=True)
-            if not os.path.exists(os.path.join(camera_pose_save_root, 'camera_poses.npy')):
-                copyfile(camera_pose_path, os.path.join(camera_pose_save_root, 'camera_poses.npy'))
-
-            align_mat_path = os.path.join(dataset_root, 'scenes/scene_{:04d}/{}/cam0_wrt_table.npy'.format(scene_idx, camera))
-            align_mat_save_root = os.path.join(dataset_save_root, 'scenes', 'scene_{:04d}/{}'.format(scene_idx, camera))
-            os.makedirs(align_mat_save_root, exist_ok=True)
-            if not os.path.exists(os.path.join(align_mat_save_root, 'cam0_wrt_table.npy')):
-                copyfile(align_mat_path, os.path.join(align_mat_save_root, 'cam0_wrt_table.npy'))
-                
-            rgb_save_root = os.path.join(dataset_save_root, 'scenes', 'scene_{:04d}/{}/rgb'.format(scene_idx, camera))
-            os.makedirs(rgb_save_root, exist_ok=True)
-            copyfile(rgb_path, os.path.join(rgb_save_root, '{:04d}.png'.format(anno_idx)))
-
-            depth_save_root = os.path.join(dataset_save_root, 'scenes', 'scene_{:04d}/{}/depth'.format(scene_idx, camera))
-            os.makedirs(depth_save_root, exist_ok=True)
-            copyfile(depth_path, os.path.join(depth_save_root, '{:04d}.png'.format(anno_idx)))
-            
-            meta_save_root = os.path.join(dataset_save_root, 'scenes', 'scene_{:04d}/{}/meta'.format(scene_idx, camera))
-            os.makedirs(meta_save_root, exist_ok=True)
-            copyfile(meta_path, os.path.join(meta_save_root, '{:04d}.mat'.format(anno_idx)))
-            
-            label_save_root = os.path.join(dataset_save_root, 'scenes', 'scene_{:04d}/{}/label'.format(scene_idx, camera))
-            os.makedirs(label_save_root, exist_ok=True)
-            copyfile(label_path, os.path.join(label_save_root, '{:04d}.png'.format(anno_idx)))
-
-            if scene_idx in range(100, 130):
-                virtual_rgb_save_root = os.path.join(dataset_save_root, 'virtual_scenes', 'scene_{:04d}/{}/rgb'.format(scene_idx, camera))
-                os.makedirs(virtual_rgb_save_root, exist_ok=True)
-                copyfile(virtual_rgb_path, os.path.join(virtual_rgb_save_root, '{:04d}.png'.format(anno_idx)))
-                
-                virtual_depth_save_root = os.path.join(dataset_save_root, 'virtual_scenes', 'scene_{:04d}/{}/depth'.format(scene_idx, camera))
-                os.makedirs(virtual_depth_save_root, exist_ok=True)
-                copyfile(virtual_depth_path, os.path.join(virtual_depth_save_root, '{:04d}.png'.format(anno_idx)))
-                
-                virtual_mask_save_root = os.path.join(dataset_save_root, 'virtual_scenes', 'scene_{:04d}/{}/label'.format(scene_idx, camera))
-                os.makedirs(virtual_mask_save_root, exist_ok=True)
-                copyfile(virtual_mask_depth, os.path.join(virtual_mask_save_root, '{:04d}.png'.format(anno_idx)))
-            
\ No newline at end of file
+MANIFEST_NAME = 'sample_manifest.json'
+FICLONE = 0x40049409  # linux ioctl, copy-on-write clone on btrfs/xfs
+
+
+def scene_sample_files(camera, scene_idx, anno_idxs=(0, 128, 255), dataset_root=dataset_root,
+                       dataset_save_root=dataset_save_root, seg_method=seg_method):
+    """ (source, destination) pairs of the sample frames of one scene. """
+    pairs = []
+    scene_dir = 'scenes/scene_{:04d}/{}'.format(scene_idx, camera)
+    for name in ['camera_poses.npy', 'cam0_wrt_table.npy']:
+        pairs.append((os.path.join(dataset_root, scene_dir, name), os.path.join(dataset_save_root, scene_dir, name)))
+
+    for anno_idx in anno_idxs:
+        for kind, ext in [('rgb', 'png'), ('depth', 'png'), ('meta', 'mat'), ('label', 'png')]:
+            frame_path = '{}/{}/{:04d}.{}'.format(scene_dir, kind, anno_idx, ext)
+            pairs.append((os.path.join(dataset_root, frame_path), os.path.join(dataset_save_root, frame_path)))
+
+        if scene_idx in range(100, 190):
+            seg_path = '{}_mask/scene_{:04d}/{}/{:04d}.png'.format(seg_method, scene_idx, camera, anno_idx)
+            pairs.append((os.path.join(dataset_root, seg_path), os.path.join(dataset_save_root, seg_path)))
+
+        if scene_idx in range(100, 130):
+            for kind in ['rgb', 'depth', 'label']:
+                virtual_path = 'virtual_scenes/scene_{:04d}/{}/{:04d}_{}.png'.format(scene_idx, camera, anno_idx, kind)
+                virtual_save_path = 'virtual_scenes/scene_{:04d}/{}/{}/{:04d}.png'.format(scene_idx, camera, kind, anno_idx)
+                pairs.append((os.path.join(dataset_root, virtual_path), os.path.join(dataset_save_root, virtual_save_path)))
+    return pairs
+
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def transfer_file(src, dst, mode='auto'):
+    """ Hardlink, reflink or copy src to dst and check the size.
+
+        Input:
+            mode: [str]
+                'auto' tries hardlink, then reflink, then copy; 'hardlink', 'reflink' and 'copy'
+                force one method (hardlink/reflink fall back to copy if unsupported)
+
+        Output:
+            method: [str]
+                'skip' if dst already exists with the source size
+    """
+    src_size = os.stat(src).st_size
+    if os.path.exists(dst):
+        if os.stat(dst).st_size == src_size:
+            return 'skip'
+        os.remove(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    method = None
+    if mode in ['auto', 'hardlink']:
+        try:
+            os.link(src, dst)
+            method = 'hardlink'
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+                raise
+    if method is None and mode in ['auto', 'reflink']:
+        try:
+            reflink(src, dst)
+            method = 'reflink'
+        except (OSError, ImportError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    if method is None:
+        shutil.copyfile(src, dst)
+        method = 'copy'
+
+    dst_size = os.stat(dst).st_size
+    if dst_size != src_size:
+        raise IOError('size mismatch after {}: {} ({} bytes) -> {} ({} bytes)'.format(method, src, src_size, dst, dst_size))
+    return method
+
+
+def export_scene(camera, scene_idx, anno_idxs=(0, 128, 255), dataset_root=dataset_root,
+                 dataset_save_root=dataset_save_root, seg_method=seg_method, mode='auto', num_threads=8):
+    pairs = scene_sample_files(camera, scene_idx, anno_idxs, dataset_root, dataset_save_root, seg_method)
+    with ThreadPoolExecutor(num_threads) as pool:
+        methods = list(pool.map(lambda p: transfer_file(p[0], p[1], mode), pairs))
+    update_manifest(dataset_save_root, [camera], [scene_idx], anno_idxs, pairs, dataset_root, seg_method)
+    return methods
+
+
+def export_sample(cameras, scene_idxs, anno_idxs=(0, 128, 255), dataset_root=dataset_root,
+                  dataset_save_root=dataset_save_root, seg_method=seg_method, mode='auto', num_threads=16):
+    """ Export all scenes/cameras with one thread pool and merge them into the manifest. """
+    pairs = []
+    for camera in cameras:
+        for scene_idx in scene_idxs:
+            pairs += scene_sample_files(camera, scene_idx, anno_idxs, dataset_root, dataset_save_root, seg_method)
+    with ThreadPoolExecutor(num_threads) as pool:
+        methods = list(pool.map(lambda p: transfer_file(p[0], p[1], mode), pairs))
+
+    update_manifest(dataset_save_root, cameras, scene_idxs, anno_idxs, pairs, dataset_root, seg_method)
+    return {method: methods.count(method) for method in set(methods)}
+
+
+def update_manifest(dataset_save_root, cameras, scene_idxs, anno_idxs, pairs, dataset_root=dataset_root,
+                    seg_method=seg_method):
+    """ Merge exported frames and files into sample_manifest.json.
+        Concurrent exports (pipeline units, several runs) serialize on flock() of the lock file,
+        which the kernel releases when the holder exits, and the manifest is replaced atomically, so
+        frames listed by earlier exports are never dropped.
+    """
+    import fcntl
+    manifest_path = os.path.join(dataset_save_root, MANIFEST_NAME)
+    os.makedirs(dataset_save_root, exist_ok=True)
+    # the lock file is never removed, a waiter could otherwise lock an unlinked file
+    with open(manifest_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        manifest = {'frames': {}, 'files': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        manifest['dataset_root'] = dataset_root
+        manifest['seg_method'] = seg_method
+        for camera in cameras:
+            camera_frames = manifest['frames'].setdefault(camera, {})
+            for scene_idx in scene_idxs:
+                camera_frames[str(scene_idx)] = sorted(set(camera_frames.get(str(scene_idx), [])) | set(anno_idxs))
+        manifest['files'].update({os.path.relpath(dst, dataset_save_root): os.stat(dst).st_size for _, dst in pairs})
+
+        tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+
+def load_sample_frames(manifest_path, camera):
+    """ Exported frames of one camera as {scene_idx: [anno_idx, ...]}, no directory walk needed. """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return {int(scene_idx): anno_idxs for scene_idx, anno_idxs in manifest['frames'][camera].items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', default=dataset_root, help='Source dataset root')
+    parser.add_argument('--save_root', default=dataset_save_root, help='Sample dataset root')
+    parser.add_argument('--cameras', default='realsense,kinect', help='Comma separated cameras [default: realsense,kinect]')
+    parser.add_argument('--scene_start', type=int, default=0, help='First scene [default: 0]')
+    parser.add_argument('--scene_end', type=int, default=190, help='Last scene (exclusive) [default: 190]')
+    parser.add_argument('--anno_idxs', default='0,128,255', help='Comma separated frame ids [default: 0,128,255]')
+    parser.add_argument('--seg_method', default=seg_method, help='Segmentation masks to export [default: uois]')
+    parser.add_argument('--mode', default='auto', choices=['auto', 'hardlink', 'reflink', 'copy'], help='File transfer method [default: auto]')
+    parser.add_argument('--num_threads', type=int, default=16, help='Transfer threads [default: 16]')
+    cfgs = parser.parse_args()
+
+    stats = export_sample(cfgs.cameras.split(','), list(range(cfgs.scene_start, cfgs.scene_end)),
+                          [int(x) for x in cfgs.anno_idxs.split(',')], cfgs.dataset_root, cfgs.save_root,
+                          cfgs.seg_method, cfgs.mode, cfgs.num_threads)
+    print('exported files: {}'.format(stats))
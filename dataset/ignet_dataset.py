@@ -18,7 +18,8 @@ from tqdm import tqdm
 # ROOT_DIR = os.path.dirname(BASE_DIR)
 # sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 from utils.data_utils import CameraInfo, transform_point_cloud, create_point_cloud_from_depth_image,\
-                            get_workspace_mask, remove_invisible_grasp_points, sample_points, points_denoise
+                            get_workspace_mask, remove_invisible_grasp_points, sample_points, points_denoise, \
+                            load_label_scores
 
 class GraspNetDataset(Dataset):
     def __init__(self, root, valid_obj_idxs, grasp_labels, camera='kinect', split='train', num_points=1024,
@@ -300,7 +301,7 @@ def load_grasp_labels(root):
         #                           label['scores'].astype(np.float32), tolerance)
         label = np.load(os.path.join(root, 'grasp_label_simplified', '{}_labels.npz'.format(str(obj_idx).zfill(3))))
         grasp_labels[obj_idx+1] = (label['points'].astype(np.float32), label['width'].astype(np.float32),
-                                  label['scores'].astype(np.float32))
+                                  load_label_scores(label))
     return valid_obj_idxs, grasp_labels
 
 
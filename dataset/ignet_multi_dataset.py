@@ -18,7 +18,11 @@ from tqdm import tqdm
 from torchvision import transforms
 
 from utils.data_utils import CameraInfo, transform_point_cloud, create_point_cloud_from_depth_image,\
-                            get_workspace_mask, remove_invisible_grasp_points, points_denoise, sample_points
+                            get_workspace_mask, remove_invisible_grasp_points, points_denoise, sample_points, \
+                            load_label_scores
+from dataset.packed_index import pack_dataset_index
+from dataset.label_assignment import assign_grasp_labels
+from utils.loss_utils import NUM_VIEW, NUM_ANGLE
 
 img_width = 720
 img_length = 1280
@@ -67,10 +71,13 @@ def get_bbox(label):
 
 class GraspNetDataset(Dataset):
     def __init__(self, root, valid_obj_idxs, grasp_labels, camera='kinect', split='train', num_points=1024,
-                 remove_outlier=False, remove_invisible=True, augment=False, denoise=False, load_label=True, real_data=True, syn_data=False, visib_threshold=0.0, voxel_size=0.005):
+                 remove_outlier=False, remove_invisible=True, augment=False, denoise=False, load_label=True, real_data=True, syn_data=False, visib_threshold=0.0, voxel_size=0.005, packed_index=False,
+                 compact_transfer=False, sparse_labels=False, grasp_num=350, fps_grasp_order=False, label_align_lut=False,
+                 worker_labels=False):
         self.root = root
         self.split = split
         self.num_points = num_points
+        self.grasp_num = grasp_num
         self.remove_outlier = remove_outlier
         self.remove_invisible = remove_invisible
         self.valid_obj_idxs = valid_obj_idxs
@@ -86,6 +93,15 @@ class GraspNetDataset(Dataset):
         self.real_data = real_data
         self.syn_data = syn_data
         self.visib_threshold = visib_threshold
+        self.compact_transfer = compact_transfer
+        self.sparse_labels = sparse_labels
+        # nested farthest point orderings of the grasp points, see dataset/generate_fps_order.py
+        self.grasp_orders = load_fps_grasp_orders(root) if fps_grasp_order else None
+        # pose-keyed label alignment tables, see dataset/generate_alignment_lut.py
+        self.label_align_lut = label_align_lut
+        self.align_luts = {}
+        # label assignment indices computed here instead of in the training step, see dataset/label_assignment.py
+        self.worker_labels = worker_labels
         if split == 'train':
             self.sceneIds = list(range(100))
         elif split == 'test':
@@ -104,6 +120,12 @@ class GraspNetDataset(Dataset):
             transforms.Resize(self.resize_shape),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
+        # uint8 image, normalized on device by unpack_compact_batch()
+        self.img_compact_transforms = transforms.Compose([
+            transforms.ToPILImage(),
+            transforms.Resize(self.resize_shape),
+            transforms.PILToTensor(),
+        ])
         
         self.colorpath = []
         self.depthpath = []
@@ -145,9 +167,20 @@ class GraspNetDataset(Dataset):
                 for i in range(len(collision_labels)):
                     self.collision_labels[x.strip()][i] = collision_labels['arr_{}'.format(i)]
 
+        # keep worker memory flat with forked dataloader workers
+        if packed_index:
+            pack_dataset_index(self, ['colorpath', 'depthpath', 'labelpath', 'metapath', 'visibpath', 'scenename'],
+                               {'frameid': np.int32, 'real_flags': np.bool_})
+
     def scene_list(self):
         return self.scenename
 
+    def set_point_budget(self, num_points, grasp_num):
+        # call before building the DataLoader, running workers keep their own copy
+        self.num_points = num_points
+        self.denoise_pre_sample_num = int(self.num_points * 1.5)
+        self.grasp_num = grasp_num
+
     def __len__(self):
         return len(self.depthpath)
 
@@ -173,6 +206,16 @@ class GraspNetDataset(Dataset):
 
         return point_clouds, object_poses_list
 
+    def get_label_align(self, scene, frame_id, obj_pos):
+        # -1 rows are aligned by the model, the table holds un-augmented poses only
+        if scene not in self.align_luts:
+            lut_path = os.path.join(self.root, 'label_align_lut', scene, '{}.npy'.format(self.camera))
+            self.align_luts[scene] = np.load(lut_path, mmap_mode='r') if os.path.exists(lut_path) else None
+        lut = self.align_luts[scene]
+        if lut is None or self.augment:
+            return -np.ones(NUM_VIEW * NUM_ANGLE, dtype=np.int16)
+        return np.array(lut[frame_id, obj_pos])
+
     def __getitem__(self, index):
         if self.load_label:
             return self.get_data_label(index)
@@ -325,7 +368,10 @@ class GraspNetDataset(Dataset):
         inst_mask_choose = inst_mask_org.flatten().nonzero()[0]
         orig_width, orig_length, _ = img.shape
         resized_idxs = self.get_resized_idxs(inst_mask_choose[idxs], (orig_width, orig_length))
-        img = self.img_transforms(img)
+        if self.compact_transfer:
+            img = self.img_compact_transforms(np.round(img * 255.0).astype(np.uint8))
+        else:
+            img = self.img_transforms(img)
         
         # inst_idxs_img = np.zeros_like(img)
         # inst_idxs_img = inst_idxs_img.reshape(-1, 3)
@@ -347,7 +393,12 @@ class GraspNetDataset(Dataset):
             inst_cloud, object_poses_list = self.augment_data(inst_cloud, [object_pose])
             object_pose = object_poses_list[0]
         
-        grasp_idxs = np.sort(np.random.choice(len(points), 350, replace=False))
+        if self.grasp_orders is not None:
+            # first grasp_num points of one of the FPS orderings
+            orders = self.grasp_orders[obj_idxs[choose_idx]]
+            grasp_idxs = np.sort(orders[np.random.randint(len(orders)), :self.grasp_num])
+        else:
+            grasp_idxs = np.sort(np.random.choice(len(points), self.grasp_num, replace=False))
         # grasp_idxs = np.random.choice(len(points), min(max(int(len(points) / 4), 350), len(points)), replace=False)
         grasp_points = points[grasp_idxs]
         grasp_offsets = offsets[grasp_idxs]
@@ -375,8 +426,23 @@ class GraspNetDataset(Dataset):
         # ret_dict['grasp_labels_list'] = grasp_scores_list
         ret_dict['object_pose'] = object_pose.astype(np.float32)
         ret_dict['grasp_points'] = grasp_points.astype(np.float32)
-        ret_dict['grasp_offsets'] = grasp_offsets.astype(np.float32)
-        ret_dict['grasp_labels'] = grasp_scores.astype(np.float32)
+        label_align = self.get_label_align(scene, self.frameid[index], choose_idx) if self.label_align_lut else None
+        if self.worker_labels:
+            ret_dict['grasp_nn_inds'], label_align, ret_dict['grasp_point_graspness_count'] = \
+                assign_grasp_labels(object_pose, grasp_points, grasp_scores, inst_cloud, label_align)
+        if label_align is not None:
+            ret_dict['grasp_label_align'] = label_align
+        if self.sparse_labels:
+            # only positive, collision-free entries are consumed by the labels and the loss
+            valid_mask = grasp_scores > 0
+            ret_dict['grasp_label_inds'] = np.flatnonzero(valid_mask).astype(np.int32)
+            ret_dict['grasp_label_scores'] = grasp_scores[valid_mask].astype(np.float32)
+            ret_dict['grasp_label_widths'] = grasp_offsets[valid_mask].astype(np.float32)
+        else:
+            ret_dict['grasp_offsets'] = grasp_offsets.astype(np.float32)
+            ret_dict['grasp_labels'] = grasp_scores.astype(np.float32)
+        if self.compact_transfer:
+            ret_dict = compact_sample(ret_dict)
         return ret_dict
 
 def load_grasp_labels(root):
@@ -396,17 +462,86 @@ def load_grasp_labels(root):
         # label = h5py.File(os.path.join(root, 'grasp_label_simplified_hdf5', '{}_labels.hdf5'.format(str(obj_idx).zfill(3))), "r")
         label = np.load(os.path.join(root, 'grasp_label_simplified', '{}_labels.npz'.format(str(obj_idx).zfill(3))))
         grasp_labels[obj_idx+1] = (label['points'].astype(np.float32), label['width'].astype(np.float32),
-                                  label['scores'].astype(np.float32))
+                                  load_label_scores(label))
     return valid_obj_idxs, grasp_labels
 
 
+def load_fps_grasp_orders(root):
+    grasp_orders = {}
+    for obj_idx in range(88):
+        grasp_orders[obj_idx+1] = np.load(os.path.join(root, 'grasp_label_fps', '{}_order.npy'.format(str(obj_idx).zfill(3))))
+    return grasp_orders
+
+
+IMG_MEAN = [0.485, 0.456, 0.406]
+IMG_STD = [0.229, 0.224, 0.225]
+
+
+def compact_sample(ret_dict):
+    """ Shrink a sample before it is sent through worker IPC and host to device copy:
+        the cloud is split into a float32 center and float16 offsets, the derivable 'coors'
+        and the constant 'feats' are dropped and image indices are stored as int32.
+        The image is expected as uint8 already. Reverted by unpack_compact_batch().
+    """
+    cloud = ret_dict.pop('point_clouds')
+    center = cloud.mean(axis=0).astype(np.float32)
+    ret_dict['point_clouds_center'] = center
+    ret_dict['point_clouds_offset'] = (cloud - center).astype(np.float16)
+    ret_dict.pop('coors', None)
+    ret_dict.pop('feats', None)
+    ret_dict['img_idxs'] = ret_dict['img_idxs'].astype(np.int32)
+    return ret_dict
+
+
+def unpack_compact_batch(end_points, voxel_size):
+    """ Rebuild the model inputs of a compact batch on its device. """
+    if 'point_clouds_offset' not in end_points:
+        return end_points
+    point_clouds = end_points.pop('point_clouds_offset').float() + end_points.pop('point_clouds_center').unsqueeze(1)
+    end_points['point_clouds'] = point_clouds
+    end_points['coors'] = point_clouds / voxel_size
+    img = end_points['img'].float() / 255.0
+    img_mean = torch.tensor(IMG_MEAN, device=img.device).view(1, 3, 1, 1)
+    img_std = torch.tensor(IMG_STD, device=img.device).view(1, 3, 1, 1)
+    end_points['img'] = (img - img_mean) / img_std
+    end_points['img_idxs'] = end_points['img_idxs'].long()
+    return end_points
+
+
+def batch_nbytes(batch):
+    """ Total payload of a collated batch in bytes. """
+    if isinstance(batch, torch.Tensor):
+        return batch.element_size() * batch.nelement()
+    elif isinstance(batch, container_abcs.Mapping):
+        return sum(batch_nbytes(v) for v in batch.values())
+    elif isinstance(batch, container_abcs.Sequence):
+        return sum(batch_nbytes(v) for v in batch)
+    return 0
+
+
+SPARSE_LABEL_KEYS = ['grasp_label_inds', 'grasp_label_scores', 'grasp_label_widths']
+
+
+def collate_sparse_labels(batch):
+    """ Concatenate sparse labels of a batch, entries of sample i are
+        grasp_label_offsets[i]:grasp_label_offsets[i+1].
+    """
+    res = {key: torch.from_numpy(np.concatenate([d[key] for d in batch], 0)) for key in SPARSE_LABEL_KEYS}
+    label_nums = torch.tensor([len(d['grasp_label_inds']) for d in batch], dtype=torch.int64)
+    res['grasp_label_offsets'] = torch.cat([label_nums.new_zeros(1), torch.cumsum(label_nums, 0)])
+    return res
+
+
 def collate_fn(batch):
     if isinstance(batch[0], torch.Tensor):
         return torch.stack(batch, 0)
     elif type(batch[0]).__module__ == 'numpy':
         return torch.stack([torch.from_numpy(b) for b in batch], 0)
     elif isinstance(batch[0], container_abcs.Mapping):
-        return {key:collate_fn([d[key] for d in batch]) for key in batch[0]}
+        res = {key:collate_fn([d[key] for d in batch]) for key in batch[0] if key not in SPARSE_LABEL_KEYS}
+        if 'grasp_label_inds' in batch[0]:
+            res.update(collate_sparse_labels(batch))
+        return res
     elif isinstance(batch[0], container_abcs.Sequence):
         return [[torch.from_numpy(sample) for sample in b] for b in batch]
     
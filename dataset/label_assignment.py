@@ -0,0 +1,84 @@
+""" Grasp label assignment on the CPU, in DataLoader workers.
+    numpy / KD-tree version of the index part of models/grasp_label_utils.py: the nearest grasp point
+    of every seed, the template -> label (view, angle) alignment and the per grasp point graspness
+    counts. The training step then only gathers (process_lazy_grasp_labels), the final per-seed
+    targets still depend on the template the model predicts.
+"""
+
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, batch_get_key_points, \
+                             NUM_VIEW, NUM_ANGLE
+
+_TEMPLATES = {}
+
+
+def get_numpy_templates():
+    """ Template views (V,3) and key points of the template rotations (V*A,4,3), with their symmetric
+        version, at width 0.02 and depth 0.02 as in models/grasp_label_utils.py.
+    """
+    if 'views' not in _TEMPLATES:
+        views = generate_grasp_views(NUM_VIEW)
+        angles = torch.tensor([np.pi / NUM_ANGLE * i for i in range(NUM_ANGLE)])
+        rots = batch_viewpoint_params_to_matrix(-views.repeat_interleave(NUM_ANGLE, dim=0), angles.tile(NUM_VIEW))
+        num_rots = rots.size(0)
+        key_points, key_points_sym = batch_get_key_points(torch.zeros((num_rots, 3)), rots, 0.02 * torch.ones(num_rots),
+                                                          0.02 * torch.ones(num_rots))
+        _TEMPLATES.update({'views': views.numpy(), 'key_points': key_points.numpy(),
+                           'key_points_sym': key_points_sym.numpy()})
+    return _TEMPLATES
+
+
+def label_alignment(object_rot):
+    """ Label (view, angle) of every template (view, angle) for one object rotation, as
+        batch_label_alignment. Key points of rotated templates are the rotated template key points.
+
+        Input:
+            object_rot: [np.ndarray, (3,3)]
+
+        Output:
+            label_inds: [np.ndarray, (V*A,), np.int64]
+    """
+    templates = get_numpy_templates()
+    object_rot = object_rot.astype(np.float32)
+    _, view_inds = cKDTree(templates['views'] @ object_rot.T).query(templates['views'], k=1)
+    key_points = templates['key_points'].reshape(NUM_VIEW, NUM_ANGLE, 4, 3)
+    key_points_trans = (templates['key_points'] @ object_rot.T).reshape(NUM_VIEW, NUM_ANGLE, 4, 3)[view_inds]
+    key_points_sym = (templates['key_points_sym'] @ object_rot.T).reshape(NUM_VIEW, NUM_ANGLE, 4, 3)[view_inds]
+    key_points = key_points.reshape(NUM_VIEW, NUM_ANGLE, 1, 12)
+    dis = np.sum((key_points - key_points_trans.reshape(NUM_VIEW, 1, NUM_ANGLE, 12)) ** 2, axis=-1)  # (V, A, A)
+    dis_sym = np.sum((key_points - key_points_sym.reshape(NUM_VIEW, 1, NUM_ANGLE, 12)) ** 2, axis=-1)
+    inds, inds_sym = dis.argmin(axis=-1), dis_sym.argmin(axis=-1)
+    dis, dis_sym = np.take_along_axis(dis, inds[..., None], -1)[..., 0], np.take_along_axis(dis_sym, inds_sym[..., None], -1)[..., 0]
+    angle_inds = np.where(dis < dis_sym, inds, inds_sym)
+    return (view_inds[:, None] * NUM_ANGLE + angle_inds).reshape(-1)
+
+
+def assign_grasp_labels(object_pose, grasp_points, grasp_scores, cloud, label_inds=None):
+    """ Index part of the grasp label assignment of one sample.
+
+        Input:
+            object_pose: [np.ndarray, (3,4)]
+            grasp_points: [np.ndarray, (Np,3)]
+                object-frame grasp points
+            grasp_scores: [np.ndarray, (Np,V,A,D)]
+            cloud: [np.ndarray, (Ns,3)]
+                seeds
+            label_inds: [np.ndarray, (V*A,)]
+                alignment from the lookup table, computed if None or -1
+
+        Output:
+            nn_inds: [np.ndarray, (Ns,), np.int64]
+                nearest grasp point of every seed, unchanged by rotating seeds and pose together
+            label_inds: [np.ndarray, (V*A,), np.int16]
+            graspness_count: [np.ndarray, (Np,V*A), np.uint8]
+                number of depths with 0 < score <= 0.6 per label (view, angle), in label order
+    """
+    grasp_points_trans = grasp_points @ object_pose[:, :3].T + object_pose[:, 3]
+    _, nn_inds = cKDTree(grasp_points_trans).query(cloud, k=1)
+    if label_inds is None or label_inds[0] < 0:
+        label_inds = label_alignment(object_pose[:, :3])
+    graspness_count = ((grasp_scores > 0) & (grasp_scores <= 0.6)).sum(axis=-1, dtype=np.uint8)
+    return nn_inds.astype(np.int64), label_inds.astype(np.int16), graspness_count.reshape(len(grasp_points), -1)
@@ -26,12 +26,13 @@ def convert_npz_to_hdf5(npz_path, hdf5_path):
 #     hdf5_file_path = os.path.join(file_root, '{:03d}_labels.hdf5'.format(i))
 #     convert_npz_to_hdf5(npz_file_path, hdf5_file_path)
 
-file_root = '/media/gpuadmin/rcao/dataset/graspnet/collision_label'
-save_root = '/media/gpuadmin/rcao/dataset/graspnet/collision_label_hdf5'
+if __name__ == '__main__':
+    file_root = '/media/gpuadmin/rcao/dataset/graspnet/collision_label'
+    save_root = '/media/gpuadmin/rcao/dataset/graspnet/collision_label_hdf5'
 
-for i in range(0, 190):
-    npz_file_path = os.path.join(file_root, 'scene_{:04d}'.format(i), 'collision_labels.npz')
-    save_path = os.path.join(save_root, 'scene_{:04d}'.format(i))
-    os.makedirs(save_path, exist_ok=True)
-    hdf5_file_path = os.path.join(save_path, 'collision_labels.hdf5')
-    convert_npz_to_hdf5(npz_file_path, hdf5_file_path)
+    for i in range(0, 190):
+        npz_file_path = os.path.join(file_root, 'scene_{:04d}'.format(i), 'collision_labels.npz')
+        save_path = os.path.join(save_root, 'scene_{:04d}'.format(i))
+        os.makedirs(save_path, exist_ok=True)
+        hdf5_file_path = os.path.join(save_path, 'collision_labels.hdf5')
+        convert_npz_to_hdf5(npz_file_path, hdf5_file_path)
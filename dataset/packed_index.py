@@ -0,0 +1,124 @@
+""" Copy-on-write friendly dataset index.
+    Long python lists of path strings are spread over many small objects; every access in a
+    forked DataLoader worker updates their refcounts and the touched pages get copied, so worker
+    memory grows over an epoch. PackedStringArray keeps all strings in one numpy byte buffer
+    plus an offset array, which are never written after construction.
+"""
+
+import os
+import numpy as np
+
+
+class PackedStringArray():
+    """ Read-only list of strings stored as one utf-8 buffer and int64 offsets. """
+    def __init__(self, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('index {} out of range for {} strings'.format(index, len(self)))
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def pack_dataset_index(dataset, path_attrs, array_attrs=None):
+    """ Replace list attributes of a dataset by packed/flat storage in place.
+
+        Input:
+            dataset: [torch.utils.data.Dataset]
+            path_attrs: [list of str]
+                names of string list attributes, converted to PackedStringArray
+            array_attrs: [dict]
+                attribute name -> numpy dtype, converted to flat numpy arrays, default: None (none)
+    """
+    if array_attrs is None:
+        array_attrs = {}
+    for name in path_attrs:
+        setattr(dataset, name, PackedStringArray(getattr(dataset, name)))
+    for name, dtype in array_attrs.items():
+        setattr(dataset, name, np.array(getattr(dataset, name), dtype=dtype))
+
+
+def get_private_memory():
+    """ Private (unshared) memory of the current process in bytes. Pages shared copy-on-write
+        with the parent are already counted in RSS right after fork, so the growth caused by
+        refcount writes only shows up in the private part.
+    """
+    try:
+        private = 0
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+                    private += int(line.split()[1]) * 1024
+        return private
+    except OSError:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+if __name__ == '__main__':
+    # Measure worker memory growth over two epochs (persistent workers) for a list index and a packed index.
+    import argparse
+    import torch
+    from torch.utils.data import Dataset, DataLoader
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', type=int, default=1000000, help='Number of index entries [default: 1000000]')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of dataloader workers [default: 4]')
+    parser.add_argument('--batch_size', type=int, default=256, help='Batch size [default: 256]')
+    cfgs = parser.parse_args()
+
+    class PathIndexDataset(Dataset):
+        def __init__(self, num_samples, packed):
+            self.colorpath = []
+            self.depthpath = []
+            self.scenename = []
+            self.frameid = []
+            for i in range(num_samples):
+                scene = 'scene_{}'.format(str(i // 256).zfill(4))
+                self.colorpath.append(os.path.join('/data/graspnet/scenes', scene, 'realsense', 'rgb', str(i % 256).zfill(4) + '.png'))
+                self.depthpath.append(os.path.join('/data/graspnet/scenes', scene, 'realsense', 'depth', str(i % 256).zfill(4) + '.png'))
+                self.scenename.append(scene)
+                self.frameid.append(i % 256)
+            if packed:
+                pack_dataset_index(self, ['colorpath', 'depthpath', 'scenename'], {'frameid': np.int32})
+
+        def __len__(self):
+            return len(self.colorpath)
+
+        def __getitem__(self, index):
+            length = len(self.colorpath[index]) + len(self.depthpath[index]) + len(self.scenename[index]) + int(self.frameid[index])
+            # reading smaps is slow, sample it every 1000 items
+            memory = get_private_memory() if index % 1000 == 0 else -1
+            return torch.tensor([os.getpid(), memory, length], dtype=torch.int64)
+
+    for packed in [False, True]:
+        dataset = PathIndexDataset(cfgs.num_samples, packed)
+        dataloader = DataLoader(dataset, batch_size=cfgs.batch_size, shuffle=True, num_workers=cfgs.num_workers,
+                                persistent_workers=True)
+        first, last = {}, {}
+        for epoch in range(2):
+            for batch in dataloader:
+                for pid, mem, _ in batch.tolist():
+                    if mem < 0:
+                        continue
+                    first.setdefault(pid, mem)
+                    last[pid] = mem
+        growth = np.mean([last[pid] - first[pid] for pid in first]) / 1024 ** 2
+        print('{} index: {} samples, mean worker private memory growth over 2 epochs: {:.1f} MB'.format(
+            'packed' if packed else 'list', len(dataset), growth))
+        del dataloader, dataset
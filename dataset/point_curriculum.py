@@ -0,0 +1,76 @@
+""" Progressive point-budget curriculum.
+    Early epochs train on a fraction of the input points and grasp points per instance, the
+    budget grows stage by stage up to the full configuration. Activation memory grows about
+    linearly with the number of points, so the batch size is scaled inversely to keep memory flat.
+"""
+
+
+class PointBudgetCurriculum():
+    """ Epoch -> (num_points, grasp_num, batch_size) schedule.
+
+        Input:
+            schedule: [str]
+                comma separated 'start_epoch:ratio' stages, e.g. '0:0.25,4:0.5,8:1.0'.
+                ratio scales num_points and grasp_num of the full configuration, an empty
+                string is a single full-budget stage
+            num_points: [int]
+                full number of input points
+            grasp_num: [int]
+                full number of grasp points per instance
+            batch_size: [int]
+                batch size at the full budget
+            max_batch_size: [int]
+                upper bound of the scaled batch size, 0 for no bound
+    """
+    def __init__(self, schedule, num_points, grasp_num, batch_size, max_batch_size=0):
+        self.stages = self.parse_schedule(schedule)
+        self.num_points = num_points
+        self.grasp_num = grasp_num
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+
+    @staticmethod
+    def parse_schedule(schedule):
+        if schedule is None or schedule.strip() == '':
+            return [(0, 1.0)]
+        stages = []
+        for item in schedule.split(','):
+            start_epoch, ratio = item.split(':')
+            stages.append((int(start_epoch), float(ratio)))
+        if stages[0][0] != 0:
+            raise ValueError('the first curriculum stage should start at epoch 0, got {}'.format(schedule))
+        for (prev_epoch, _), (epoch, _) in zip(stages[:-1], stages[1:]):
+            if epoch <= prev_epoch:
+                raise ValueError('curriculum stages should have increasing start epochs, got {}'.format(schedule))
+        for _, ratio in stages:
+            if ratio <= 0 or ratio > 1:
+                raise ValueError('curriculum ratios should be in (0, 1], got {}'.format(schedule))
+        return stages
+
+    def stage_idx(self, epoch):
+        idx = 0
+        for i, (start_epoch, _) in enumerate(self.stages):
+            if epoch >= start_epoch:
+                idx = i
+        return idx
+
+    def is_stage_end(self, epoch):
+        """ True if epoch is the last epoch before the next stage starts. """
+        idx = self.stage_idx(epoch)
+        return idx + 1 < len(self.stages) and self.stages[idx + 1][0] == epoch + 1
+
+    def budget(self, epoch):
+        """ Output:
+                budget: [dict]
+                    'stage', 'ratio', 'num_points', 'grasp_num', 'batch_size'
+        """
+        idx = self.stage_idx(epoch)
+        ratio = self.stages[idx][1]
+        batch_size = max(int(round(self.batch_size / ratio)), 1)
+        if self.max_batch_size > 0:
+            batch_size = min(batch_size, max(self.max_batch_size, self.batch_size))
+        return {'stage': idx,
+                'ratio': ratio,
+                'num_points': max(int(round(self.num_points * ratio)), 1),
+                'grasp_num': max(int(round(self.grasp_num * ratio)), 1),
+                'batch_size': batch_size}
@@ -0,0 +1,372 @@
+""" Preprocessing pipeline runner.
+    The offline generators (collision labels, simplified grasp labels, grasp point FPS orderings,
+    graspness, normals, tolerance, label alignment tables, hdf5 collision labels, sample subset)
+    are stages of a DAG, every stage is split into units (one scene or one object). A unit is keyed
+    by a hash of its parameters, the source of its generator and the content of its input files;
+    it only runs if its key differs from the one in the manifest or an output is missing. Stages
+    whose inputs are outputs of another stage run after it, units of a stage run in parallel.
+
+    python dataset/preprocess_pipeline.py --dataset_root /data/graspnet --stages graspness,normals --dry_run
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+sys.path.append(BASE_DIR)
+
+# func(*args) produces outputs from inputs, paths are absolute
+Unit = namedtuple('Unit', ['stage', 'name', 'inputs', 'outputs', 'params', 'func', 'args'])
+
+
+class Manifest():
+    """ JSON record of unit keys and of file content hashes. A file hash is reused while size and
+        mtime are unchanged, so re-running the pipeline only stats unchanged inputs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = {'files': {}, 'units': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def file_hash(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 'missing'
+        cached = self.data['files'].get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        self.data['files'][path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def unit_key(self, unit, code_hash, pool):
+        input_hashes = list(pool.map(self.file_hash, unit.inputs))
+        description = json.dumps([unit.stage, unit.name, unit.params, code_hash, sorted(zip(unit.inputs, input_hashes))],
+                                 sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def source_hash(paths):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(os.path.join(ROOT_DIR, path), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def scene_name(scene_id):
+    return 'scene_' + str(scene_id).zfill(4)
+
+
+def scene_frame_inputs(root, scene_id, camera, kinds=('depth', 'label', 'meta')):
+    scene_dir = os.path.join(root, 'scenes', scene_name(scene_id), camera)
+    ext = {'rgb': '.png', 'depth': '.png', 'label': '.png', 'meta': '.mat', 'annotations': '.xml'}
+    inputs = [os.path.join(scene_dir, 'camera_poses.npy'), os.path.join(scene_dir, 'cam0_wrt_table.npy')]
+    for kind in kinds:
+        inputs += [os.path.join(scene_dir, kind, str(ann_id).zfill(4) + ext[kind]) for ann_id in range(256)]
+    return inputs
+
+
+def scene_object_ids(root, scene_id):
+    with open(os.path.join(root, 'scenes', scene_name(scene_id), 'object_id_list.txt')) as f:
+        return [int(line.strip()) for line in f if line.strip()]
+
+
+# ---------------------------------------------------------------------------------------- units
+
+def run_generate_scene(module_name, scene_id, cfgs_dict):
+    module = __import__(module_name)
+    return module.generate_scene(scene_id, argparse.Namespace(**cfgs_dict))
+
+
+def run_tolerance(obj_name, cfgs_dict):
+    from generate_tolerance_label import worker
+    return worker(obj_name, argparse.Namespace(**cfgs_dict))
+
+
+def run_simplified(obj_idx, cfgs_dict):
+    from generate_simplified_label import simplify_object
+    return simplify_object(obj_idx, argparse.Namespace(**cfgs_dict))
+
+
+def run_fps_order(obj_idx, cfgs_dict):
+    from generate_fps_order import generate_object
+    return generate_object(obj_idx, argparse.Namespace(**cfgs_dict))
+
+
+def run_collision_hdf5(npz_path, hdf5_path):
+    from numpy_file_convert import convert_npz_to_hdf5
+    os.makedirs(os.path.dirname(hdf5_path), exist_ok=True)
+    convert_npz_to_hdf5(npz_path, hdf5_path)
+
+
+def run_sample(camera, scene_id, anno_idxs, dataset_root, sample_root, seg_method):
+    from graspnet_sample import export_scene
+    export_scene(camera, scene_id, anno_idxs, dataset_root, sample_root, seg_method)
+
+
+# --------------------------------------------------------------------------------------- stages
+# every stage: (source files of its generator, function cfgs -> list of units)
+
+def graspness_units(cfgs):
+    units = []
+    for scene_id in range(130):
+        name = scene_name(scene_id)
+        inputs = scene_frame_inputs(cfgs.dataset_root, scene_id, cfgs.camera, ('depth', 'label', 'meta', 'annotations'))
+        inputs.append(os.path.join(cfgs.dataset_root, 'collision_label', name, 'collision_labels.npz'))
+        inputs += [os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(str(obj_id).zfill(3)))
+                   for obj_id in scene_object_ids(cfgs.dataset_root, scene_id)]
+        save_path = os.path.join(cfgs.dataset_root, 'graspness', name, cfgs.camera)
+        outputs = [os.path.join(save_path, str(ann_id).zfill(4) + '.npy') for ann_id in range(256)]
+        params = {'camera_type': cfgs.camera, 'consolidate': cfgs.consolidate}
+        cfgs_dict = dict(params, dataset_root=cfgs.dataset_root, backend='kdtree', overwrite=True)
+        units.append(Unit('graspness', name, inputs, outputs, params, run_generate_scene,
+                          ('generate_graspness', scene_id, cfgs_dict)))
+    return units
+
+
+def collision_units(cfgs):
+    units = []
+    for scene_id in range(190):
+        name = scene_name(scene_id)
+        obj_names = [str(obj_id).zfill(3) for obj_id in scene_object_ids(cfgs.dataset_root, scene_id)]
+        scene_dir = os.path.join(cfgs.dataset_root, 'scenes', name, cfgs.camera)
+        inputs = [os.path.join(scene_dir, 'camera_poses.npy'), os.path.join(scene_dir, 'cam0_wrt_table.npy'),
+                  os.path.join(scene_dir, 'annotations', '0000.xml')]
+        inputs += [os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(obj_name)) for obj_name in obj_names]
+        inputs += [os.path.join(cfgs.dataset_root, 'models', obj_name, 'nontextured.ply') for obj_name in obj_names]
+        outputs = [os.path.join(cfgs.dataset_root, cfgs.collision_name, name, 'collision_labels.npz')]
+        params = {'camera_type': cfgs.camera, 'save_name': cfgs.collision_name, 'voxel_size': cfgs.collision_voxel_size,
+                  'max_width': cfgs.collision_max_width, 'finger_width': 0.01, 'finger_length': 0.06, 'height': 0.02,
+                  'approach_dist': 0.05, 'collision_thresh': 0.0, 'table': True, 'all_grasps': False}
+        cfgs_dict = dict(params, dataset_root=cfgs.dataset_root, reference_name='', grasps_per_call=65536, overwrite=True)
+        units.append(Unit('collision', name, inputs, outputs, params, run_generate_scene,
+                          ('generate_collision_label', scene_id, cfgs_dict)))
+    return units
+
+
+def normals_units(cfgs):
+    units = []
+    for scene_id in range(190):
+        name = scene_name(scene_id)
+        inputs = scene_frame_inputs(cfgs.dataset_root, scene_id, cfgs.camera)
+        save_path = os.path.join(cfgs.dataset_root, 'normals', name, cfgs.camera)
+        outputs = [os.path.join(save_path, str(ann_id).zfill(4) + '.npy') for ann_id in range(256)]
+        params = {'camera_type': cfgs.camera, 'radius': cfgs.normal_radius, 'max_nn': cfgs.normal_max_nn,
+                  'consolidate': cfgs.consolidate}
+        cfgs_dict = dict(params, dataset_root=cfgs.dataset_root, frames_per_call=8, overwrite=True)
+        units.append(Unit('normals', name, inputs, outputs, params, run_generate_scene,
+                          ('generate_normals', scene_id, cfgs_dict)))
+    return units
+
+
+def tolerance_units(cfgs):
+    units = []
+    save_path = os.path.join(cfgs.dataset_root, 'tolerance')
+    for obj_id in range(88):
+        obj_name = '%03d' % obj_id
+        inputs = [os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(obj_name))]
+        outputs = [os.path.join(save_path, '{}_tolerance.npy'.format(obj_name))]
+        params = {'mu_thresh': cfgs.mu_thresh, 'pos_ratio_thresh': cfgs.pos_ratio_thresh}
+        cfgs_dict = dict(params, dataset_root=cfgs.dataset_root, save_path=save_path, chunk_size=16,
+                         overwrite=True, verify_num=0)
+        units.append(Unit('tolerance', obj_name, inputs, outputs, params, run_tolerance, (obj_name, cfgs_dict)))
+    return units
+
+
+def simplified_units(cfgs):
+    units = []
+    for obj_id in range(88):
+        obj_name = '%03d' % obj_id
+        inputs = [os.path.join(cfgs.dataset_root, 'grasp_label', '{}_labels.npz'.format(obj_name))]
+        outputs = [os.path.join(cfgs.dataset_root, 'grasp_label_simplified', '{}_labels.npz'.format(obj_name))]
+        # the quantized format is part of the params, so float16-score files of older runs are rebuilt
+        params = {'quantize': 'width_f16_scores_x10' if cfgs.quantize_labels else False}
+        cfgs_dict = dict(quantize=cfgs.quantize_labels, dataset_root=cfgs.dataset_root, save_name='grasp_label_simplified',
+                         chunk_mb=256, compress=True, overwrite=True)
+        units.append(Unit('simplified', obj_name, inputs, outputs, params, run_simplified, (obj_id, cfgs_dict)))
+    return units
+
+
+def fps_order_units(cfgs):
+    units = []
+    for obj_id in range(88):
+        obj_name = '%03d' % obj_id
+        inputs = [os.path.join(cfgs.dataset_root, 'grasp_label_simplified', '{}_labels.npz'.format(obj_name))]
+        outputs = [os.path.join(cfgs.dataset_root, 'grasp_label_fps', '{}_order.npy'.format(obj_name))]
+        params = {'num_orders': 16}
+        cfgs_dict = dict(params, dataset_root=cfgs.dataset_root, overwrite=True, coverage_k=0)
+        units.append(Unit('fps_order', obj_name, inputs, outputs, params, run_fps_order, (obj_id, cfgs_dict)))
+    return units
+
+
+def label_align_units(cfgs):
+    units = []
+    for scene_id in range(190):
+        name = scene_name(scene_id)
+        inputs = scene_frame_inputs(cfgs.dataset_root, scene_id, cfgs.camera, ('meta',))[2:]
+        outputs = [os.path.join(cfgs.dataset_root, 'label_align_lut', name, '{}.npy'.format(cfgs.camera))]
+        params = {'camera': cfgs.camera}
+        cfgs_dict = dict(params, dataset_root=cfgs.dataset_root, device='cpu', poses_per_call=64, overwrite=True)
+        units.append(Unit('label_align', name, inputs, outputs, params, run_generate_scene,
+                          ('generate_alignment_lut', scene_id, cfgs_dict)))
+    return units
+
+
+def collision_hdf5_units(cfgs):
+    units = []
+    for scene_id in range(190):
+        name = scene_name(scene_id)
+        npz_path = os.path.join(cfgs.dataset_root, 'collision_label', name, 'collision_labels.npz')
+        hdf5_path = os.path.join(cfgs.dataset_root, 'collision_label_hdf5', name, 'collision_labels.hdf5')
+        units.append(Unit('collision_hdf5', name, [npz_path], [hdf5_path], {}, run_collision_hdf5, (npz_path, hdf5_path)))
+    return units
+
+
+def sample_units(cfgs):
+    from graspnet_sample import scene_sample_files
+    units = []
+    anno_idxs = (0, 128, 255)
+    for scene_id in range(190):
+        pairs = scene_sample_files(cfgs.camera, scene_id, anno_idxs, cfgs.dataset_root, cfgs.sample_root, cfgs.seg_method)
+        params = {'camera': cfgs.camera, 'anno_idxs': list(anno_idxs), 'seg_method': cfgs.seg_method,
+                  'sample_root': cfgs.sample_root}
+        units.append(Unit('sample', scene_name(scene_id), [p[0] for p in pairs], [p[1] for p in pairs], params, run_sample,
+                          (cfgs.camera, scene_id, anno_idxs, cfgs.dataset_root, cfgs.sample_root, cfgs.seg_method)))
+    return units
+
+
+STAGES = {
+    'collision': (['dataset/generate_collision_label.py', 'utils/collision_detector.py'], collision_units),
+    'graspness': (['dataset/generate_graspness.py'], graspness_units),
+    'normals': (['dataset/generate_normals.py', 'utils/normal_utils.py'], normals_units),
+    'tolerance': (['dataset/generate_tolerance_label.py'], tolerance_units),
+    'simplified': (['dataset/generate_simplified_label.py'], simplified_units),
+    'fps_order': (['dataset/generate_fps_order.py', 'utils/data_utils.py'], fps_order_units),
+    'label_align': (['dataset/generate_alignment_lut.py', 'models/grasp_label_utils.py', 'utils/loss_utils.py'], label_align_units),
+    'collision_hdf5': (['dataset/numpy_file_convert.py'], collision_hdf5_units),
+    'sample': (['dataset/graspnet_sample.py'], sample_units),
+}
+
+
+def stage_order(stage_units):
+    """ Topological order of stages, a stage depends on the stages producing any of its inputs. """
+    producers = {}
+    for stage, units in stage_units.items():
+        for unit in units:
+            for path in unit.outputs:
+                producers[path] = stage
+    deps = {stage: set() for stage in stage_units}
+    for stage, units in stage_units.items():
+        for unit in units:
+            for path in unit.inputs:
+                if path in producers and producers[path] != stage:
+                    deps[stage].add(producers[path])
+    order = []
+    while len(order) < len(deps):
+        ready = [s for s in deps if s not in order and deps[s].issubset(order)]
+        if len(ready) == 0:
+            raise RuntimeError('cyclic stage dependencies: {}'.format(deps))
+        order += sorted(ready)
+    return order, deps
+
+
+def run_unit(unit):
+    tic = time.time()
+    try:
+        unit.func(*unit.args)
+    except Exception as e:
+        return unit.stage, unit.name, repr(e), time.time() - tic
+    missing = [path for path in unit.outputs if not os.path.exists(path)]
+    if len(missing) > 0:
+        return unit.stage, unit.name, 'missing outputs: {}'.format(missing[:3]), time.time() - tic
+    return unit.stage, unit.name, None, time.time() - tic
+
+
+def run_pipeline(cfgs):
+    manifest = Manifest(cfgs.manifest if cfgs.manifest else os.path.join(cfgs.dataset_root, 'preprocess_manifest.json'))
+    stage_units = {stage: STAGES[stage][1](cfgs) for stage in cfgs.stages.split(',')}
+    order, deps = stage_order(stage_units)
+    print('stage order: {}'.format(' -> '.join(order)))
+
+    ctx = multiprocessing.get_context('forkserver')
+    with ThreadPoolExecutor(cfgs.hash_threads) as hash_pool:
+        for stage in order:
+            code_hash = source_hash(STAGES[stage][0])
+            keys, todo = {}, []
+            for unit in stage_units[stage]:
+                # keys of downstream stages are computed after their inputs were produced
+                keys[unit.name] = manifest.unit_key(unit, code_hash, hash_pool)
+                unit_id = '{}/{}'.format(stage, unit.name)
+                outputs_exist = all(os.path.exists(path) for path in unit.outputs)
+                if cfgs.force or manifest.data['units'].get(unit_id) != keys[unit.name] or not outputs_exist:
+                    todo.append(unit)
+            manifest.save()
+            print('stage {}: {} units, {} to run'.format(stage, len(stage_units[stage]), len(todo)))
+            if cfgs.dry_run or len(todo) == 0:
+                continue
+
+            failed = 0
+            with ctx.Pool(cfgs.num_workers) as pool:
+                for stage_, name, error, elapsed in pool.imap_unordered(run_unit, todo):
+                    if error is None:
+                        manifest.data['units']['{}/{}'.format(stage_, name)] = keys[name]
+                        manifest.save()
+                        print('{}/{} done in {:.1f}s'.format(stage_, name, elapsed))
+                    else:
+                        failed += 1
+                        print('{}/{} failed: {}'.format(stage_, name, error))
+            if failed > 0:
+                dependents = [s for s in order if stage in deps[s]]
+                print('stage {}: {} units failed, stopping before {}'.format(stage, failed, dependents))
+                if len(dependents) > 0:
+                    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_root', required=True, help='Dataset root')
+    parser.add_argument('--camera', default='realsense', help='Camera split [realsense/kinect]')
+    parser.add_argument('--stages', default='graspness,normals,tolerance', help='Comma separated stages out of {} [default: graspness,normals,tolerance]'.format(','.join(STAGES)))
+    parser.add_argument('--manifest', default=None, help='Manifest path [default: <dataset_root>/preprocess_manifest.json]')
+    parser.add_argument('--num_workers', type=int, default=8, help='Units processed in parallel [default: 8]')
+    parser.add_argument('--hash_threads', type=int, default=8, help='Threads hashing input files [default: 8]')
+    parser.add_argument('--dry_run', action='store_true', help='Only report stale units [default: False]')
+    parser.add_argument('--force', action='store_true', help='Run all units of the selected stages [default: False]')
+    parser.add_argument('--consolidate', action='store_true', help='Also write consolidated per-scene graspness/normal files [default: False]')
+    parser.add_argument('--normal_radius', type=float, default=0.015, help='Normal estimation radius [default: 0.015]')
+    parser.add_argument('--normal_max_nn', type=int, default=None, help='Normal estimation neighbor bound [default: None]')
+    parser.add_argument('--mu_thresh', type=float, default=0.55, help='Tolerance friction coefficient threshold [default: 0.55]')
+    parser.add_argument('--pos_ratio_thresh', type=float, default=0.8, help='Tolerance positive neighbor ratio [default: 0.8]')
+    parser.add_argument('--collision_name', default='collision_label_voxel', help='Output directory of the collision stage, collision_label makes graspness depend on it [default: collision_label_voxel]')
+    parser.add_argument('--collision_voxel_size', type=float, default=0.005, help='Collision stage voxel size [default: 0.005]')
+    parser.add_argument('--collision_max_width', type=float, default=0.1, help='Collision stage maximum grasp width [default: 0.1]')
+    parser.add_argument('--quantize_labels', action='store_true', help='Store simplified label widths as float16 and scores as int8 tenths [default: False]')
+    parser.add_argument('--sample_root', default=None, help='Output root of the sample stage')
+    parser.add_argument('--seg_method', default='uois', help='Segmentation masks copied by the sample stage [default: uois]')
+    cfgs = parser.parse_args()
+    if 'sample' in cfgs.stages.split(',') and cfgs.sample_root is None:
+        parser.error('the sample stage needs --sample_root')
+
+    run_pipeline(cfgs)
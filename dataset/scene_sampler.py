@@ -0,0 +1,96 @@
+""" Scene-affinity sampler.
+    Shuffles scenes first, splits them into consecutive non-overlapping windows of window_size
+    scenes and shuffles samples only inside each window, so per-scene assets (collision labels,
+    camera poses, page-cached frames) are reused by consecutive samples instead of being touched
+    once per epoch at random.
+"""
+
+import math
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+class SceneAffinitySampler(Sampler):
+    """ Sampler yielding dataset indices grouped by scene.
+
+        Input:
+            scene_names: [list of str]
+                scene of every dataset index, e.g. dataset.scene_list()
+            window_size: [int]
+                number of scenes whose frames/instances are shuffled together, this is the
+                locality/randomness knob: 1 visits one scene at a time, a value >= the number
+                of scenes falls back to a plain global shuffle
+            shuffle: [bool]
+                if False scenes and frames are visited in dataset order
+            seed: [int]
+                base seed, the epoch set by set_epoch() is added to it
+            num_replicas, rank: [int]
+                DDP world size and rank, taken from torch.distributed if initialized.
+                Every rank gets a disjoint set of scenes, index lists are wrapped or cut
+                to the same length on all ranks.
+            drop_last: [bool]
+                cut instead of wrap when balancing ranks
+    """
+    def __init__(self, scene_names, window_size=4, shuffle=True, seed=0, num_replicas=None, rank=None,
+                 drop_last=False):
+        if window_size < 1:
+            raise ValueError('window_size should be a positive integer, got {}'.format(window_size))
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if rank >= num_replicas or rank < 0:
+            raise ValueError('Invalid rank {}, rank should be in the interval [0, {}]'.format(rank, num_replicas - 1))
+
+        self.window_size = window_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # group dataset indices by scene, keeping the first-seen scene order
+        scene_to_group = {}
+        groups = []
+        for idx, name in enumerate(scene_names):
+            if name not in scene_to_group:
+                scene_to_group[name] = len(groups)
+                groups.append([])
+            groups[scene_to_group[name]].append(idx)
+        self.scene_groups = [np.array(g, dtype=np.int64) for g in groups]
+        if len(self.scene_groups) < num_replicas:
+            raise ValueError('{} scenes can not be split over {} replicas'.format(len(self.scene_groups), num_replicas))
+
+        num_indices = len(scene_names)
+        if self.drop_last:
+            self.num_samples = num_indices // num_replicas
+        else:
+            self.num_samples = int(math.ceil(num_indices / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        scene_order = rng.permutation(len(self.scene_groups)) if self.shuffle else np.arange(len(self.scene_groups))
+        # disjoint scene groups per rank
+        scene_order = scene_order[self.rank::self.num_replicas]
+
+        indices = []
+        for start in range(0, len(scene_order), self.window_size):
+            window = np.concatenate([self.scene_groups[s] for s in scene_order[start:start + self.window_size]])
+            if self.shuffle:
+                window = rng.permutation(window)
+            indices.append(window)
+        indices = np.concatenate(indices)
+
+        # same number of samples on every rank
+        if len(indices) < self.num_samples:
+            indices = np.resize(indices, self.num_samples)
+        indices = indices[:self.num_samples]
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
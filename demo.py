@@ -32,6 +32,7 @@ from utils.collision_detector import ModelFreeCollisionDetector
 from utils.data_utils import CameraInfo, create_point_cloud_from_depth_image, get_workspace_mask, sample_points, points_denoise
 from torchvision import transforms
 from dataset.ignet_multi_dataset import load_grasp_labels
+from dataset.graspnet_sample import load_sample_frames
 
 import cv2
 cv2.setNumThreads(0)
@@ -61,6 +62,7 @@ parser.add_argument('--ckpt_epoch', type=int, default=53, help='Checkpoint epoch
 parser.add_argument('--inst_denoise', action='store_true', help='Denoise instance points during training and testing [default: False]')
 parser.add_argument('--seg_root',type=str, default='/media/gpuadmin/rcao/dataset/graspnet_sample', help='Segmentation results root')
 parser.add_argument('--seg_model',type=str, default='uois', help='Segmentation results [default: uois]')
+parser.add_argument('--sample_manifest', type=str, default=None, help='sample_manifest.json of graspnet_sample.py, run only the exported frames [default: None]')
 parser.add_argument('--multi_scale_grouping', action='store_true', help='Multi-scale grouping [default: False]')
 parser.add_argument('--voxel_size', type=float, default=0.002, help='Voxel Size to quantize point cloud [default: 0.005]')
 parser.add_argument('--collision_voxel_size', type=float, default=0.01, help='Voxel Size to process point clouds before collision detection [default: 0.01]')
@@ -215,7 +217,7 @@ except:
     net.load_state_dict(checkpoint, strict=True)
 eps = 1e-8
 
-def inference(scene_idx):
+def inference(scene_idx, anno_list=anno_list):
     for anno_idx in anno_list:
         if data_type == 'real':
             rgb_path = os.path.join(dataset_root,
@@ -427,7 +429,11 @@ elif split == 'test_novel':
 else:
     print('invalid split')
 
+sample_frames = load_sample_frames(cfgs.sample_manifest, camera) if cfgs.sample_manifest else None
+if sample_frames is not None:
+    scene_list = [scene_idx for scene_idx in scene_list if scene_idx in sample_frames]
+
 # scene_list = [100]
 # res = []
 for scene_idx in scene_list:
-    inference(scene_idx)
\ No newline at end of file
+    inference(scene_idx, sample_frames[scene_idx] if sample_frames is not None else anno_list)
\ No newline at end of file
@@ -63,6 +63,8 @@ parser.add_argument('--multi_scale_grouping', action='store_true', help='Multi-s
 parser.add_argument('--voxel_size', type=float, default=0.002, help='Voxel Size to quantize point cloud [default: 0.005]')
 parser.add_argument('--collision_voxel_size', type=float, default=0.01, help='Voxel Size to process point clouds before collision detection [default: 0.01]')
 parser.add_argument('--collision_thresh', type=float, default=0.01, help='Collision Threshold in collision detection [default: 0.01]')
+parser.add_argument('--cascade_k', type=int, default=0, help='Seeds per instance kept after the rotation head (v0.8), 0 for all [default: 0]')
+parser.add_argument('--cascade_threshold', type=float, default=0., help='Also drop seeds with rotation graspness below this (v0.8) [default: 0]')
 cfgs = parser.parse_args()
 
 print(cfgs)
@@ -181,6 +183,9 @@ except :
 
 if network_ver.startswith('v0.6'):
     net = IGNet(num_view=300, seed_feat_dim=cfgs.seed_feat_dim, is_training=False)
+elif network_ver.startswith('v0.8'):
+    net = IGNet(num_view=300, seed_feat_dim=cfgs.seed_feat_dim, img_feat_dim=cfgs.img_feat_dim, is_training=False, multi_scale_grouping=cfgs.multi_scale_grouping,
+                cascade_k=cfgs.cascade_k, cascade_threshold=cfgs.cascade_threshold)
 else:
     net = IGNet(num_view=300, seed_feat_dim=cfgs.seed_feat_dim, img_feat_dim=cfgs.img_feat_dim, is_training=False, multi_scale_grouping=cfgs.multi_scale_grouping)
 net.to(device)
@@ -195,6 +200,9 @@ eps = 1e-8
 
 start = torch.cuda.Event(enable_timing=True)
 end = torch.cuda.Event(enable_timing=True)
+net_start = torch.cuda.Event(enable_timing=True)
+net_end = torch.cuda.Event(enable_timing=True)
+net_time_list = []
 
 def inference(scene_idx):
     elapsed_time_list = []
@@ -337,10 +345,14 @@ def inference(scene_idx):
                             }
 
         with torch.no_grad(): 
+            net_start.record()
             end_points = net(batch_data_label)
             grasp_preds = pred_decode(end_points, normalize=False)
+            net_end.record()
             preds = np.stack(grasp_preds).reshape(-1, 17)
             gg = GraspGroup(preds)
+        torch.cuda.synchronize()
+        net_time_list.append(net_start.elapsed_time(net_end))
             
         # torch.cuda.empty_cache()
         # collision detection
@@ -396,4 +408,8 @@ else:
 # scene_list = [100]
 # res = []
 for scene_idx in scene_list:
-    inference(scene_idx)
\ No newline at end of file
+    inference(scene_idx)
+
+# network + decode time per frame, read by benchmark_cascade.py
+print(f"Mean Network Time：{np.mean(net_time_list[1:]):.3f} ms")
+np.save(os.path.join(dump_dir, 'net_time_{}_{}.npy'.format(split, camera)), np.array(net_time_list))
\ No newline at end of file
@@ -17,6 +17,7 @@ from pointnet2.pointnet2_utils import CylinderQueryAndGroup, furthest_point_samp
 from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, batch_get_key_points, transform_point_cloud, \
                        GRASPNESS_THRESHOLD, GRASP_MAX_WIDTH, NUM_ANGLE, NUM_VIEW, NUM_DEPTH, M_POINT
 from models.coral_loss import corn_label_from_logits
+from models.grasp_decode_utils import pack_grasp_preds
 
 
 angles = torch.tensor([np.pi / NUM_ANGLE * i for i in range(NUM_ANGLE)])
@@ -174,6 +175,10 @@ class ApproachNet(nn.Module):
         self.is_training = is_training
         self.conv1 = nn.Conv1d(self.in_dim, self.in_dim, 1)
         self.conv2 = nn.Conv1d(self.in_dim, self.num_view, 1)
+        template_views = generate_grasp_views(self.num_view)  # (num_view, 3)
+        self.register_buffer('template_views', template_views, persistent=False)
+        self.register_buffer('template_view_rots', batch_viewpoint_params_to_matrix(-template_views, torch.zeros(self.num_view)),
+                             persistent=False)
 
     def forward(self, seed_features, end_points):
         B, _, num_seed = seed_features.size()
@@ -199,13 +204,8 @@ class ApproachNet(nn.Module):
         else:
             _, top_view_inds = torch.max(view_score, dim=2)  # (B, num_seed)
 
-            top_view_inds_ = top_view_inds.view(B, num_seed, 1, 1).expand(-1, -1, -1, 3).contiguous()
-            template_views = generate_grasp_views(self.num_view).to(features.device)  # (num_view, 3)
-            template_views = template_views.view(1, 1, self.num_view, 3).expand(B, num_seed, -1, -1).contiguous()
-            vp_xyz = torch.gather(template_views, 2, top_view_inds_).squeeze(2)  # (B, num_seed, 3)
-            vp_xyz_ = vp_xyz.view(-1, 3)
-            batch_angle = torch.zeros(vp_xyz_.size(0), dtype=vp_xyz.dtype, device=vp_xyz.device)
-            vp_rot = batch_viewpoint_params_to_matrix(-vp_xyz_, batch_angle).view(B, num_seed, 3, 3)
+            vp_xyz = self.template_views[top_view_inds]  # (B, num_seed, 3)
+            vp_rot = self.template_view_rots[top_view_inds]  # (B, num_seed, 3, 3)
             end_points['grasp_top_view_xyz'] = vp_xyz
             end_points['grasp_top_view_rot'] = vp_rot
 
@@ -403,8 +403,8 @@ class GraspNet(nn.Module):
         return end_points
 
 
-def process_grasp_labels(end_points):
-    """ Process labels according to scene points and object poses. """
+def gather_listed_grasp_labels(end_points):
+    """ Assign labels given as per-object lists to scene points. """
     seed_xyzs = end_points['xyz_graspable']  # (B, M_point, 3)
     batch_size, num_samples, _ = seed_xyzs.size()
 
@@ -481,6 +481,84 @@ def process_grasp_labels(end_points):
     batch_grasp_scores = torch.stack(batch_grasp_scores, 0)  # (B, Ns, V, A, D)
     batch_grasp_widths = torch.stack(batch_grasp_widths, 0)  # (B, Ns, V, A, D)
 
+    return batch_grasp_points, batch_grasp_views_rot, batch_grasp_scores, batch_grasp_widths
+
+
+def gather_packed_grasp_labels(end_points):
+    """ Assign packed labels to scene points, all objects of the batch are processed at once.
+
+        Input:
+            end_points: [dict]
+                'packed_object_poses': (No,3,4), 'packed_grasp_points': (Np,3),
+                'packed_grasp_labels'/'packed_grasp_offsets': (Np,V,A,D),
+                'packed_object_offsets': (B+1,), 'packed_grasp_point_offsets': (No+1,)
+    """
+    seed_xyzs = end_points['xyz_graspable']  # (B, Ns, 3)
+    batch_size, num_samples, _ = seed_xyzs.size()
+    poses = end_points['packed_object_poses']  # (No, 3, 4)
+    grasp_points = end_points['packed_grasp_points']  # (Np, 3)
+    grasp_scores = end_points['packed_grasp_labels']  # (Np, V, A, D)
+    grasp_widths = end_points['packed_grasp_offsets']  # (Np, V, A, D)
+    object_offsets = end_points['packed_object_offsets']  # (B+1,)
+    point_offsets = end_points['packed_grasp_point_offsets']  # (No+1,)
+    num_objects = poses.size(0)
+    num_grasp_points, V, A, D = grasp_scores.size()
+    device = poses.device
+
+    object_batch_ids = torch.repeat_interleave(torch.arange(batch_size, device=device),
+                                               object_offsets[1:] - object_offsets[:-1])  # (No,)
+    point_object_ids = torch.repeat_interleave(torch.arange(num_objects, device=device),
+                                               point_offsets[1:] - point_offsets[:-1])  # (Np,)
+    point_batch_ids = object_batch_ids[point_object_ids]  # (Np,)
+
+    # transform grasp points of all objects
+    rots = poses[:, :3, :3]  # (No, 3, 3)
+    grasp_points_trans = torch.matmul(rots[point_object_ids], grasp_points.unsqueeze(-1)).squeeze(-1) \
+                         + poses[point_object_ids, :, 3]  # (Np, 3)
+
+    # generate and transform template grasp views and view rotations
+    grasp_views = generate_grasp_views(V).to(device)  # (V, 3)
+    grasp_views_trans = torch.matmul(grasp_views, rots.transpose(1, 2))  # (No, V, 3)
+    angles = torch.zeros(V, dtype=grasp_views.dtype, device=device)
+    grasp_views_rot = batch_viewpoint_params_to_matrix(-grasp_views, angles)  # (V, 3, 3)
+    grasp_views_rot_trans = torch.matmul(rots.unsqueeze(1), grasp_views_rot.unsqueeze(0))  # (No, V, 3, 3)
+
+    # assign views
+    grasp_views_ = grasp_views.unsqueeze(0).expand(num_objects, -1, -1).contiguous()
+    _, view_inds, _ = knn_points(grasp_views_, grasp_views_trans, K=1)
+    view_inds = view_inds.squeeze(-1)  # (No, V)
+    grasp_views_rot_trans = torch.gather(grasp_views_rot_trans, 1,
+                                         view_inds.view(num_objects, V, 1, 1).expand(-1, -1, 3, 3))  # (No, V, 3, 3)
+
+    # compute nearest neighbors on zero padded per-sample grasp points
+    batch_point_offsets = point_offsets[object_offsets]  # (B+1,)
+    batch_point_nums = batch_point_offsets[1:] - batch_point_offsets[:-1]  # (B,)
+    point_local_ids = torch.arange(num_grasp_points, device=device) - batch_point_offsets[point_batch_ids]
+    grasp_points_padded = grasp_points_trans.new_zeros((batch_size, int(batch_point_nums.max()), 3))
+    grasp_points_padded[point_batch_ids, point_local_ids] = grasp_points_trans
+    _, nn_inds, _ = knn_points(seed_xyzs, grasp_points_padded, lengths2=batch_point_nums, K=1)
+    nn_inds = nn_inds.squeeze(-1) + batch_point_offsets[:-1].unsqueeze(-1)  # (B, Ns)
+    nn_object_ids = point_object_ids[nn_inds]  # (B, Ns)
+
+    # assign anchor points to real points, only the selected rows are gathered
+    seed_view_inds = view_inds[nn_object_ids]  # (B, Ns, V)
+    batch_grasp_points = grasp_points_trans[nn_inds]  # (B, Ns, 3)
+    batch_grasp_views_rot = grasp_views_rot_trans[nn_object_ids]  # (B, Ns, V, 3, 3)
+    batch_grasp_scores = grasp_scores[nn_inds.unsqueeze(-1), seed_view_inds]  # (B, Ns, V, A, D)
+    batch_grasp_widths = grasp_widths[nn_inds.unsqueeze(-1), seed_view_inds]  # (B, Ns, V, A, D)
+
+    return batch_grasp_points, batch_grasp_views_rot, batch_grasp_scores, batch_grasp_widths
+
+
+def process_grasp_labels(end_points):
+    """ Process labels according to scene points and object poses. """
+    if 'packed_object_poses' in end_points:
+        batch_grasp_points, batch_grasp_views_rot, batch_grasp_scores, batch_grasp_widths = \
+            gather_packed_grasp_labels(end_points)
+    else:
+        batch_grasp_points, batch_grasp_views_rot, batch_grasp_scores, batch_grasp_widths = \
+            gather_listed_grasp_labels(end_points)
+
     # compute view graspness
     view_u_threshold = 0.6
     view_grasp_num = 48
@@ -563,6 +641,25 @@ def pred_decode(end_points):
     return grasp_preds
 
 
+def pred_decode_batched(end_points, to_numpy=False):
+    """ pred_decode for the whole batch at once, see models/grasp_decode_utils.py.
+
+        Output:
+            grasp_preds: [torch.FloatTensor, (B*M_POINT,17)]
+            offsets: [torch.LongTensor, (B+1,)]
+    """
+    grasp_center = end_points['xyz_graspable'].float()
+    batch_size = len(grasp_center)
+    grasp_score = end_points['grasp_score_pred'].float().view(batch_size, M_POINT, NUM_ANGLE*NUM_DEPTH)
+    grasp_score, grasp_score_inds = torch.max(grasp_score, -1)  # (B, M_POINT)
+    grasp_width = 1.2 * end_points['grasp_width_pred'] / 10.
+    grasp_width = grasp_width.view(batch_size, M_POINT, NUM_ANGLE*NUM_DEPTH)
+    grasp_width = torch.gather(grasp_width, 2, grasp_score_inds.unsqueeze(-1)).squeeze(-1)
+    grasp_width = torch.clamp(grasp_width, min=0., max=GRASP_MAX_WIDTH)
+    rot_inds = end_points['grasp_top_view_inds'] * NUM_ANGLE + grasp_score_inds // NUM_DEPTH
+    return pack_grasp_preds(grasp_score, grasp_width.float(), grasp_score_inds % NUM_DEPTH, rot_inds, grasp_center, to_numpy)
+
+
 # v0.4
 # class ScoringNet(nn.Module):
 #     def __init__(self, seed_feature_dim):
@@ -13,6 +13,7 @@ ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(ROOT_DIR)
 
 from pytorch3d.ops.knn import knn_points
+from models.grasp_label_utils import process_lazy_grasp_labels, gather_lazy_grasp_labels
 import pointnet2.pytorch_utils as pt_utils
 from pointnet2.pointnet2_utils import RectangularQueryAndGroup, RectangularQuery, furthest_point_sample, gather_operation
 from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, batch_get_key_points, transform_point_cloud, GRASPNESS_THRESHOLD, GRASP_MAX_WIDTH, NUM_ANGLE, NUM_VIEW, NUM_DEPTH, M_POINT
@@ -398,9 +399,10 @@ class RotationScoringNet(nn.Module):
 
 
 class IGNet(nn.Module):
-    def __init__(self,  num_view=300, num_angle=12, num_depth=4, seed_feat_dim=512, is_training=True):
+    def __init__(self,  num_view=300, num_angle=12, num_depth=4, seed_feat_dim=512, is_training=True, batched_labels=True):
         super().__init__()
         self.is_training = is_training
+        self.batched_labels = batched_labels
         self.seed_feature_dim = seed_feat_dim
         self.num_depth = num_depth
         self.num_angle = num_angle
@@ -459,7 +461,10 @@ class IGNet(nn.Module):
         seed_features = seed_features + rot_features
 
         if self.is_training:
-            end_points = process_grasp_labels(end_points)
+            if self.batched_labels:
+                end_points = process_grasp_labels_batched(end_points)
+            else:
+                end_points = process_grasp_labels(end_points)
             grasp_top_rots, end_points = match_grasp_view_and_label(end_points)
         else:
             grasp_top_rots = end_points['grasp_top_rot']
@@ -631,20 +636,32 @@ def process_grasp_labels(end_points):
     return end_points
 
 
+def process_grasp_labels_batched(end_points):
+    """ process_grasp_labels for the whole batch at once, lazily: the labels stay per grasp point with
+        the seed and rotation indices (models/grasp_label_utils.py), and match_grasp_view_and_label
+        materializes only the predicted rotation of every seed.
+    """
+    return process_lazy_grasp_labels(end_points)
+
+
 def match_grasp_view_and_label(end_points):
     """ Slice grasp labels according to predicted views. """
     top_rot_inds = end_points['grasp_top_rot_inds']  # (B, Ns)
-    template_views_rot = end_points['batch_grasp_rot']  # (B, Ns, V, A, 3, 3)
-    grasp_scores = end_points['batch_grasp_score']  # (B, Ns, V, A, D)
-    grasp_widths = end_points['batch_grasp_width']  # (B, Ns, V, A, D)
-
-    B, Ns, V, A, D = grasp_scores.size()
-    top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, 3, 3)
-    top_template_rot_mat = torch.gather(template_views_rot.view(B, Ns, V*A, 3, 3), 2, top_rot_inds_).squeeze(2)
-    
-    top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1).expand(-1, -1, -1, D)
-    top_rot_grasp_scores = torch.gather(grasp_scores.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
-    top_rot_grasp_widths = torch.gather(grasp_widths.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
+    if 'batch_grasp_label_inds' in end_points:
+        # lazy labels of process_grasp_labels_batched
+        top_template_rot_mat, top_rot_grasp_scores, top_rot_grasp_widths = gather_lazy_grasp_labels(end_points, top_rot_inds)
+    else:
+        template_views_rot = end_points['batch_grasp_rot']  # (B, Ns, V, A, 3, 3)
+        grasp_scores = end_points['batch_grasp_score']  # (B, Ns, V, A, D)
+        grasp_widths = end_points['batch_grasp_width']  # (B, Ns, V, A, D)
+
+        B, Ns, V, A, D = grasp_scores.size()
+        top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, 3, 3)
+        top_template_rot_mat = torch.gather(template_views_rot.view(B, Ns, V*A, 3, 3), 2, top_rot_inds_).squeeze(2)
+
+        top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1).expand(-1, -1, -1, D)
+        top_rot_grasp_scores = torch.gather(grasp_scores.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
+        top_rot_grasp_widths = torch.gather(grasp_widths.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
 
     # print(top_rot_grasp_scores.min(), top_rot_grasp_scores.max(), top_rot_grasp_scores.mean())
     # print(top_rot_grasp_widths.min(), top_rot_grasp_widths.max(), top_rot_grasp_widths.mean())
@@ -665,8 +682,8 @@ def match_grasp_view_and_label(end_points):
         top_rot_grasp_scores[po_mask] = torch.log(u_max / top_rot_grasp_scores[po_mask]) / \
             (torch.log(u_max / u_min) + 1e-8)
 
-    batch_grasp_scores_ids = torch.bucketize(top_rot_grasp_scores, score_bins.to(grasp_widths.device))
-    batch_grasp_widths_ids = torch.bucketize(top_rot_grasp_scores, width_bins.to(grasp_scores.device))
+    batch_grasp_scores_ids = torch.bucketize(top_rot_grasp_scores, score_bins.to(top_rot_grasp_scores.device))
+    batch_grasp_widths_ids = torch.bucketize(top_rot_grasp_scores, width_bins.to(top_rot_grasp_scores.device))
 
     end_points['batch_grasp_score'] = top_rot_grasp_scores  # (B, Ns, D)
     end_points['batch_grasp_width'] = top_rot_grasp_widths  # (B, Ns, D)
@@ -676,8 +693,23 @@ def match_grasp_view_and_label(end_points):
     return top_template_rot_mat, end_points
 
 
-def compute_grasp_widths(grasp_points, grasp_poses, width_intervals, nsample):
+finger_width = 0.01
+finger_height = 0.02
+finger_depth_base = 0.02
+
+
+def group_gripper_points(grasp_points, grasp_poses, nsample):
+    """ Points in the crop box of every grasp, in the gripper frame.
+
+        Input:
+            grasp_points: [torch.FloatTensor, (P,3)]
+            grasp_poses: [torch.FloatTensor, (P,9)]
+            nsample: [int]
 
+        Output:
+            target: [torch.FloatTensor, (P,nsample,3)]
+                (depth, width, height) coordinates relative to the grasp point
+    """
     point_num, _ = grasp_points.size()
     crop_length = (0.04 + base_depth) * torch.ones((1, point_num, 1), device=grasp_points.device)
     crop_width = GRASP_MAX_WIDTH * torch.ones_like(crop_length, device=grasp_points.device)
@@ -689,21 +721,30 @@ def compute_grasp_widths(grasp_points, grasp_poses, width_intervals, nsample):
                                 rectangular_idx.unsqueeze(-1).expand(-1, -1, -1, 3))
     query_points = query_points.squeeze(0)
     grasp_poses = grasp_poses.view(point_num, 3, 3)
-    
-    finger_width = 0.01
-    finger_height = 0.02
-    finger_depth_base = 0.02
 
-    grasp_depths = 0.04 * torch.ones((len(grasp_points),), device=grasp_points.device)
-    grasp_widths = width_intervals.unsqueeze(0).tile((len(grasp_points), 1)).to(grasp_points.device)
-    width_num = len(width_intervals)
-    
     # 调整grasp_points形状以广播
     grasp_points = grasp_points.unsqueeze(1)  # 形状从(1024, 3)变为(1024, 1, 3)
 
     # 计算target
     target = query_points - grasp_points  # 利用广播减法
     target = torch.matmul(target, grasp_poses)  # 矩阵乘法
+    return target
+
+
+def grasp_width_collisions(target, grasp_widths, grasp_depth=0.04):
+    """ Collision of the gripper at every candidate width.
+
+        Input:
+            target: [torch.FloatTensor, (P,nsample,3)]
+                group_gripper_points
+            grasp_widths: [torch.FloatTensor, (P,W)]
+
+        Output:
+            collision_mask: [torch.BoolTensor, (P,W)]
+    """
+    nsample = target.size(1)
+    width_num = grasp_widths.size(1)
+    grasp_depths = grasp_depth * torch.ones((len(target),), device=target.device)
 
     # 扩展grasp_widths为 (1024, nsample, len(width_bins) )
     grasp_widths_expand = grasp_widths.unsqueeze(1).expand(-1, nsample, -1)
@@ -730,14 +771,69 @@ def compute_grasp_widths(grasp_points, grasp_poses, width_intervals, nsample):
     bottom_mask = mask1 & mask3 & mask5 & mask7
 
     # 综合所有bin，检查是否有碰撞
-    collision_mask = (left_mask | right_mask | bottom_mask).any(dim=1)
+    return (left_mask | right_mask | bottom_mask).any(dim=1)
 
+
+def bin_grasp_widths(target, width_intervals, grasp_depth=0.04):
+    """ First collision-free width of width_intervals per grasp, width_intervals[0] if all collide. """
+    grasp_widths = width_intervals.unsqueeze(0).tile((len(target), 1)).to(target.device)
+    collision_mask = grasp_width_collisions(target, grasp_widths, grasp_depth)
     first_no_collision = torch.argmax((~collision_mask).int(), dim=1)
     pred_grasp_widths = torch.gather(grasp_widths, 1, first_no_collision.view(-1, 1))
     return pred_grasp_widths
 
 
-def pred_decode(end_points, normalize=False):
+def solve_grasp_widths(target, grasp_depth=0.04, max_width=GRASP_MAX_WIDTH):
+    """ Minimal collision-free width per grasp, without candidate widths.
+
+        A finger region point at |y| = a collides with the fingers for widths in (2(a - finger_width), 2a),
+        a bottom region point for widths above 2(a - finger_width). The minimal free width is therefore
+        0 or 2a of some finger point, free if no other finger point lies in (a, a + finger_width), i.e.
+        the next larger |y| after sorting is at least finger_width away, and at most the bottom bound.
+
+        Input:
+            target: [torch.FloatTensor, (P,nsample,3)]
+                group_gripper_points
+
+        Output:
+            grasp_widths: [torch.FloatTensor, (P,1)]
+                0 if no width up to max_width is free, as bin_grasp_widths
+    """
+    in_height = (target[:, :, 2] > -finger_height / 2) & (target[:, :, 2] < finger_height / 2)
+    finger_mask = in_height & (target[:, :, 0] > -finger_depth_base) & (target[:, :, 0] < grasp_depth)
+    bottom_mask = in_height & (target[:, :, 0] > -(finger_depth_base + finger_width)) & (target[:, :, 0] < -finger_depth_base)
+    half_widths = target[:, :, 1].abs()
+
+    inf = torch.tensor(float('inf'), device=target.device)
+    width_bound = torch.where(bottom_mask, 2 * (half_widths - finger_width), inf).amin(dim=1, keepdim=True)
+    width_bound = torch.clamp(width_bound, max=max_width)
+
+    # width 0 as a candidate point at a = 0
+    candidates = torch.where(finger_mask, half_widths, inf)
+    candidates = torch.cat([torch.zeros_like(candidates[:, :1]), candidates], dim=1).sort(dim=1)[0]
+    gaps = torch.cat([candidates[:, 1:], inf.expand(len(candidates), 1)], dim=1) - candidates
+    widths = torch.where((gaps >= finger_width) & (2 * candidates <= width_bound), 2 * candidates, inf)
+    widths = widths.amin(dim=1, keepdim=True)
+    return torch.where(torch.isinf(widths), torch.zeros_like(widths), widths)
+
+
+def compute_grasp_widths(grasp_points, grasp_poses, width_intervals, nsample):
+    target = group_gripper_points(grasp_points, grasp_poses, nsample)
+    return bin_grasp_widths(target, width_intervals)
+
+
+def compute_grasp_widths_analytic(grasp_points, grasp_poses, nsample):
+    """ compute_grasp_widths with solve_grasp_widths: the exact minimal width instead of the first free
+        bin, at (P,nsample) instead of (P,nsample,W) memory.
+    """
+    target = group_gripper_points(grasp_points, grasp_poses, nsample)
+    return solve_grasp_widths(target)
+
+
+def pred_decode(end_points, normalize=False, analytic_widths=False):
+    """ analytic_widths: replace the predicted widths with the minimal free width of the gripper
+        in the scene points (compute_grasp_widths_analytic), default: False
+    """
     grasp_center = end_points['point_clouds']
     batch_size, num_samples, _ = grasp_center.shape
     grasp_preds = []
@@ -775,10 +871,71 @@ def pred_decode(end_points, normalize=False):
         topk_grasp_rots = topk_grasp_rots.view(-1, 9)
 
         # grasp_width  = compute_grasp_widths(grasp_center, topk_grasp_rots, width_intervals.clone(), nsample=512)
+        if analytic_widths:
+            grasp_width = compute_grasp_widths_analytic(grasp_center, topk_grasp_rots, nsample=512)
         grasp_height = 0.02 * torch.ones_like(grasp_score)
         obj_ids = -1 * torch.ones_like(grasp_score)
         grasp_preds.append(torch.cat([grasp_score, grasp_width, grasp_height,
                                       grasp_depth, topk_grasp_rots, grasp_center, obj_ids],
                                      axis=-1).detach().cpu().numpy())
 
-    return grasp_preds
\ No newline at end of file
+    return grasp_preds
+
+
+if __name__ == '__main__':
+    # parity of solve_grasp_widths with the width bins on synthetic gripper-frame crops, asserted:
+    # python -m models.IGNet_v0_6 --num_grasps 1024 --nsample 512 --device cuda
+    import time
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_grasps', type=int, default=1024, help='Number of grasps [default: 1024]')
+    parser.add_argument('--nsample', type=int, default=512, help='Points per crop [default: 512]')
+    parser.add_argument('--device', default='cpu', help='Device [default: cpu]')
+    parser.add_argument('--fine_step', type=float, default=0.0005, help='Step of the fine width bins [default: 0.0005]')
+    cfgs = parser.parse_args()
+
+    def timed(func, *args):
+        if cfgs.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        tic = time.time()
+        out = func(*args)
+        if cfgs.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        return out, (time.time() - tic) * 1000
+
+    P, N = cfgs.num_grasps, cfgs.nsample
+    # an object slab of random half width around each grasp, clutter in the rest of the crop, and
+    # queries padded with the grasp point itself as RectangularQuery does
+    object_half = torch.rand(P, 1) * 0.045
+    target = torch.rand(P, N, 3) * torch.tensor([0.08, 0.1, 0.02]) - torch.tensor([0.04, 0.05, 0.01])
+    is_object = torch.rand(P, N) < 0.98
+    target[:, :, 1] = torch.where(is_object, (2 * torch.rand(P, N) - 1) * object_half, target[:, :, 1])
+    target[:, :, 0] = torch.where(is_object, torch.rand(P, N) * 0.05 - 0.01, target[:, :, 0])
+    num_valid = torch.randint(1, N + 1, (P, 1))
+    target[torch.arange(N).unsqueeze(0).expand(P, -1) >= num_valid] = 0
+    target = target.to(cfgs.device)
+
+    with torch.no_grad():
+        timed(solve_grasp_widths, target)
+        bin_widths, bin_ms = timed(bin_grasp_widths, target, width_intervals.clone())
+        widths, solve_ms = timed(solve_grasp_widths, target)
+        fine_intervals = torch.arange(0, GRASP_MAX_WIDTH + 1e-6, cfgs.fine_step)
+        fine_widths, fine_ms = timed(bin_grasp_widths, target, fine_intervals)
+        # a zero width is a solution only if width 0 is free, otherwise the fallback
+        solved = ~grasp_width_collisions(target, widths)[:, 0]
+        solved_zero = solved & (widths[:, 0] == 0)
+        bin_free = ~grasp_width_collisions(target, width_intervals.unsqueeze(0).expand(P, -1).to(target.device))
+    print('grasps: {} nsample: {} solved: {:.1%} at width 0: {:.1%}'.format(
+        P, N, solved.float().mean().item(), solved_zero.float().mean().item()))
+    checks = [('non-zero solved widths that collide', ~solved & (widths[:, 0] > 0)),
+              ('unsolved grasps with a free bin', ~solved & bin_free.any(dim=1)),
+              ('free bins below the solved width', solved.unsqueeze(1) & bin_free & (width_intervals.to(target.device) < widths - 1e-6)),
+              # the bins skip free windows narrower than their spacing, they are never below the solved width
+              ('bin widths below solved widths', (bin_widths[:, 0] < widths[:, 0] - 1e-6) & bin_free.any(dim=1))]
+    for name, mask in checks:
+        print('{}: {}'.format(name, mask.sum().item()))
+        assert mask.sum().item() == 0, '{}: {}'.format(name, mask.sum().item())
+    fine_diff = (fine_widths - widths)[:, 0][solved].abs()
+    print('solved widths within {} of the fine bins: {:.1%}, max diff {:.5f}'.format(
+        cfgs.fine_step, (fine_diff <= cfgs.fine_step + 1e-6).float().mean().item(), fine_diff.max().item()))
+    print('time ms: bins ({}) {:.1f} fine bins ({}) {:.1f} solver {:.1f}'.format(len(width_intervals), bin_ms, len(fine_intervals), fine_ms, solve_ms))
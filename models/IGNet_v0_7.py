@@ -13,6 +13,8 @@ ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(ROOT_DIR)
 
 from pytorch3d.ops.knn import knn_points
+from models.grasp_label_utils import process_lazy_grasp_labels, gather_lazy_grasp_labels
+from models.grasp_decode_utils import pack_grasp_preds
 import pointnet2.pytorch_utils as pt_utils
 from pointnet2.pointnet2_utils import CylinderQueryAndGroup, furthest_point_sample, gather_operation
 from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, batch_get_key_points, transform_point_cloud, GRASPNESS_THRESHOLD, GRASP_MAX_WIDTH, NUM_ANGLE, NUM_VIEW, NUM_DEPTH, M_POINT
@@ -200,6 +202,10 @@ class ApproachNet(nn.Module):
         # classfication-based (len(score_bins)+1) CORN (len(score_bins))
         # self.conv3 = nn.Conv1d(self.in_dim * 2, self.num_view * self.num_angle * self.num_depth * len(score_bins), 1)
         self.act =  nn.ReLU(inplace=True)
+        template_views = generate_grasp_views(self.num_view)  # (num_view, 3)
+        self.register_buffer('template_views', template_views, persistent=False)
+        self.register_buffer('template_view_rots', batch_viewpoint_params_to_matrix(-template_views, torch.zeros(self.num_view)),
+                             persistent=False)
         
     def forward(self, seed_features, end_points):
         B, _, num_seed = seed_features.size()
@@ -225,13 +231,8 @@ class ApproachNet(nn.Module):
             top_view_inds = torch.stack(top_view_inds, dim=0).squeeze(-1)  # B, num_seed
         else:
             _, top_view_inds = torch.max(view_scores, dim=-1)  # (B, num_seed)
-            top_view_inds_ = top_view_inds.view(B, num_seed, 1, 1).expand(-1, -1, -1, 3).contiguous()
-            template_views = generate_grasp_views(self.num_view).to(seed_features.device)  # (num_view, 3)
-            template_views = template_views.view(1, 1, self.num_view, 3).expand(B, num_seed, -1, -1).contiguous()
-            vp_xyz = torch.gather(template_views, 2, top_view_inds_).squeeze(2)  # (B, num_seed, 3)
-            vp_xyz_ = vp_xyz.view(-1, 3)
-            batch_angle = torch.zeros(vp_xyz_.size(0), dtype=vp_xyz.dtype, device=seed_features.device)
-            vp_rot = batch_viewpoint_params_to_matrix(-vp_xyz_, batch_angle).view(B, num_seed, 3, 3)
+            vp_xyz = self.template_views[top_view_inds]  # (B, num_seed, 3)
+            vp_rot = self.template_view_rots[top_view_inds]  # (B, num_seed, 3, 3)
             end_points['grasp_top_view_xyz'] = vp_xyz
             end_points['grasp_top_view_rot'] = vp_rot
 
@@ -297,9 +298,10 @@ class ApproachNet(nn.Module):
 
 from models.pspnet import PSPNet
 class IGNet(nn.Module):
-    def __init__(self,  num_view=300, num_angle=12, num_depth=4, seed_feat_dim=512, img_feat_dim=64, is_training=True):
+    def __init__(self,  num_view=300, num_angle=12, num_depth=4, seed_feat_dim=512, img_feat_dim=64, is_training=True, batched_labels=True):
         super().__init__()
         self.is_training = is_training
+        self.batched_labels = batched_labels
         self.seed_feature_dim = seed_feat_dim
         self.num_depth = num_depth
         self.num_angle = num_angle
@@ -360,7 +362,10 @@ class IGNet(nn.Module):
         seed_features = seed_features + rot_features
 
         if self.is_training:
-            end_points = process_grasp_labels(end_points)
+            if self.batched_labels:
+                end_points = process_grasp_labels_batched(end_points)
+            else:
+                end_points = process_grasp_labels(end_points)
             grasp_top_views_rot, end_points = match_grasp_view_and_label(end_points)
         else:
             grasp_top_views_rot = end_points['grasp_top_view_rot']
@@ -524,19 +529,32 @@ def process_grasp_labels(end_points):
     return end_points
 
 
+def process_grasp_labels_batched(end_points):
+    """ process_grasp_labels for the whole batch at once, lazily: the labels stay per grasp point with
+        the seed and view indices (models/grasp_label_utils.py), and match_grasp_view_and_label
+        materializes only the predicted view of every seed.
+    """
+    return process_lazy_grasp_labels(end_points, align_angles=False)
+
+
 def match_grasp_view_and_label(end_points):
     """ Slice grasp labels according to predicted views. """
     top_view_inds = end_points['grasp_top_view_inds']  # (B, Ns)
-    template_views_rot = end_points['batch_grasp_view_rot']  # (B, Ns, V, 3, 3)
-    grasp_scores = end_points['batch_grasp_score']  # (B, Ns, V, A, D)
-    grasp_widths = end_points['batch_grasp_width']  # (B, Ns, V, A, D, 3)
-
-    B, Ns, V, A, D = grasp_scores.size()
-    top_view_inds_ = top_view_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, 3, 3)
-    top_template_views_rot = torch.gather(template_views_rot, 2, top_view_inds_).squeeze(2)
-    top_view_inds_ = top_view_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, A, D)
-    top_view_grasp_scores = torch.gather(grasp_scores, 2, top_view_inds_).squeeze(2)
-    top_view_grasp_widths = torch.gather(grasp_widths, 2, top_view_inds_).squeeze(2)
+    if 'batch_grasp_label_inds' in end_points:
+        # lazy labels of process_grasp_labels_batched
+        top_template_views_rot, top_view_grasp_scores, top_view_grasp_widths = gather_lazy_grasp_labels(
+            end_points, top_view_inds, view_only=True)
+    else:
+        template_views_rot = end_points['batch_grasp_view_rot']  # (B, Ns, V, 3, 3)
+        grasp_scores = end_points['batch_grasp_score']  # (B, Ns, V, A, D)
+        grasp_widths = end_points['batch_grasp_width']  # (B, Ns, V, A, D, 3)
+
+        B, Ns, V, A, D = grasp_scores.size()
+        top_view_inds_ = top_view_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, 3, 3)
+        top_template_views_rot = torch.gather(template_views_rot, 2, top_view_inds_).squeeze(2)
+        top_view_inds_ = top_view_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, A, D)
+        top_view_grasp_scores = torch.gather(grasp_scores, 2, top_view_inds_).squeeze(2)
+        top_view_grasp_widths = torch.gather(grasp_widths, 2, top_view_inds_).squeeze(2)
 
     u_max = top_view_grasp_scores.max()
     po_mask = top_view_grasp_scores > 0
@@ -593,4 +611,28 @@ def pred_decode(end_points, normalize=False):
                                       grasp_depth, topk_grasp_rots, grasp_center, obj_ids],
                                      axis=-1).detach().cpu().numpy())
 
-    return grasp_preds
\ No newline at end of file
+    return grasp_preds
+
+
+def pred_decode_batched(end_points, normalize=False, to_numpy=False):
+    """ pred_decode for the whole batch at once, see models/grasp_decode_utils.py.
+
+        Output:
+            grasp_preds: [torch.FloatTensor, (B*Ns,17)]
+            offsets: [torch.LongTensor, (B+1,)]
+    """
+    grasp_center = end_points['point_clouds'].float()
+    batch_size, num_samples, _ = grasp_center.shape
+    grasp_score = end_points['grasp_score_pred'].float()  # (B, Ns, A, D)
+    grasp_width = 1.2 * end_points['grasp_width_pred'] / 10.  # 10 for multiply 10 in loss function
+    if normalize:
+        grasp_score = normalize_tensor(grasp_score)
+
+    grasp_score = grasp_score.view(batch_size, num_samples, NUM_ANGLE * NUM_DEPTH)
+    grasp_width = grasp_width.view(batch_size, num_samples, NUM_ANGLE * NUM_DEPTH)
+    grasp_score, grasp_score_inds = torch.max(grasp_score, dim=-1)  # (B, Ns)
+    grasp_angle_inds, grasp_depth_inds = unravel_index(grasp_score_inds, (NUM_ANGLE, NUM_DEPTH))
+    grasp_width = torch.gather(grasp_width, 2, grasp_score_inds.unsqueeze(-1)).squeeze(-1)
+    grasp_width = torch.clamp(grasp_width, min=0., max=GRASP_MAX_WIDTH)
+    rot_inds = end_points['grasp_top_view_inds'] * NUM_ANGLE + grasp_angle_inds
+    return pack_grasp_preds(grasp_score, grasp_width.float(), grasp_depth_inds, rot_inds, grasp_center, to_numpy)
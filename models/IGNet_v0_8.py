@@ -13,6 +13,8 @@ ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(ROOT_DIR)
 
 from pytorch3d.ops.knn import knn_points
+from models.grasp_label_utils import process_lazy_grasp_labels, gather_lazy_grasp_labels, densify_grasp_labels
+from models.grasp_decode_utils import pack_grasp_preds
 import pointnet2.pytorch_utils as pt_utils
 from pointnet2.pointnet2_utils import RectangularQueryAndGroup
 from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, batch_get_key_points, transform_point_cloud, GRASPNESS_THRESHOLD, GRASP_MAX_WIDTH, NUM_ANGLE, NUM_VIEW, NUM_DEPTH, M_POINT
@@ -170,8 +172,11 @@ class CloudCrop(nn.Module):
         self.grouper = RectangularQueryAndGroup(nsample=nsample, use_xyz=True)
         self.mlps = pt_utils.SharedMLP(mlps, bn=True)
 
-    def forward(self, seed_xyz, seed_features, rot, crop_size):
-        grouped_feature = self.grouper(seed_xyz, seed_xyz, rot, crop_size, seed_features)  # B*3 + feat_dim*M*K
+    def forward(self, seed_xyz, seed_features, rot, crop_size, query_xyz=None):
+        # crops around query_xyz (the seeds if None), grouping from all seeds
+        if query_xyz is None:
+            query_xyz = seed_xyz
+        grouped_feature = self.grouper(seed_xyz, query_xyz, rot, crop_size, seed_features)  # B*3 + feat_dim*M*K
         new_features = self.mlps(grouped_feature)  # (batch_size, mlps[-1], M, nsample)
         new_features = F.max_pool2d(new_features, kernel_size=[1, new_features.size(3)])  # (batch_size, mlps[-1], M, 1)
         new_features = new_features.squeeze(-1)   # (batch_size, mlps[-1], M)
@@ -266,6 +271,8 @@ class RotationScoringNet(nn.Module):
         # classfication-based (len(score_bins)+1) CORN (len(score_bins))
         # self.conv3 = nn.Conv1d(self.in_dim * 2, self.num_view * self.num_angle * self.num_depth * len(score_bins), 1)
         self.act =  nn.ReLU(inplace=True)
+        # eval picks the top rotation by index, not by gathering from per-seed template copies
+        self.register_buffer('template_rots', grasp_rot.clone().view(num_view * num_angle, 3, 3), persistent=False)
         
     def forward(self, seed_features, end_points):
         B, _, num_seed = seed_features.size()
@@ -291,11 +298,7 @@ class RotationScoringNet(nn.Module):
             top_rot_inds = torch.stack(top_rot_inds, dim=0).squeeze(-1)  # B, num_seed
         else:
             _, top_rot_inds = torch.max(rotation_scores, dim=-1)  # (B, num_seed)
-            temp_grasp_rots = grasp_rot.clone().to(seed_features.device)
-            temp_grasp_rots = temp_grasp_rots.view(1, 1, self.num_view*self.num_angle, 3, 3)
-            temp_grasp_rots = temp_grasp_rots.expand(B, num_seed, -1, -1, -1).contiguous()
-            top_rot_inds_ = top_rot_inds.view(B, num_seed, 1, 1, 1).expand(-1, -1, -1, 3, 3)
-            grasp_top_rot = torch.gather(temp_grasp_rots, 2, top_rot_inds_).squeeze(2)
+            grasp_top_rot = self.template_rots[top_rot_inds]  # (B, num_seed, 3, 3)
             end_points['grasp_top_rot'] = grasp_top_rot
 
         end_points['grasp_top_rot_inds'] = top_rot_inds
@@ -315,6 +318,7 @@ class RotationGraspableNet(nn.Module):
         self.conv3 = nn.Conv1d(self.in_dim, self.num_view * self.num_angle, 1)
         self.bn1 = nn.BatchNorm1d(self.in_dim)
         self.bn2 = nn.BatchNorm1d(self.in_dim)
+        self.register_buffer('template_rots', grasp_rot.clone().view(num_view * num_angle, 3, 3), persistent=False)
         
     def forward(self, seed_features, end_points):
         B, _, num_seed = seed_features.size()
@@ -337,11 +341,7 @@ class RotationGraspableNet(nn.Module):
             top_rot_inds = torch.stack(top_rot_inds, dim=0).squeeze(-1)  # B, num_seed
         else:
             _, top_rot_inds = torch.max(rotation_scores, dim=-1)  # (B, num_seed)
-            temp_grasp_rots = grasp_rot.clone().to(seed_features.device)
-            temp_grasp_rots = temp_grasp_rots.view(1, 1, self.num_view*self.num_angle, 3, 3)
-            temp_grasp_rots = temp_grasp_rots.expand(B, num_seed, -1, -1, -1).contiguous()
-            top_rot_inds_ = top_rot_inds.view(B, num_seed, 1, 1, 1).expand(-1, -1, -1, 3, 3)
-            grasp_top_rot = torch.gather(temp_grasp_rots, 2, top_rot_inds_).squeeze(2)
+            grasp_top_rot = self.template_rots[top_rot_inds]  # (B, num_seed, 3, 3)
             end_points['grasp_top_rot'] = grasp_top_rot
 
         end_points['grasp_top_rot_inds'] = top_rot_inds
@@ -443,9 +443,15 @@ class CrossAttentionConcat(nn.Module):
 
 class IGNet(nn.Module):
     def __init__(self,  num_view=300, num_angle=12, num_depth=4, seed_feat_dim=512, img_feat_dim=64, 
-                 is_training=True, multi_scale_grouping=False):
+                 is_training=True, multi_scale_grouping=False, batched_labels=True, cascade_k=0, cascade_threshold=0.):
         super().__init__()
         self.is_training = is_training
+        self.batched_labels = batched_labels
+        # inference cascade, can be changed at runtime: only the cascade_k seeds per instance with the highest
+        # predicted rotation graspness (0 for all), further cut to those above cascade_threshold, go through
+        # CloudCrop and DepthNet
+        self.cascade_k = cascade_k
+        self.cascade_threshold = cascade_threshold
         self.seed_feature_dim = seed_feat_dim
 
         self.num_depth = num_depth
@@ -577,10 +583,18 @@ class IGNet(nn.Module):
         seed_features = seed_features + rot_features
 
         if self.is_training:
-            end_points = process_grasp_labels(end_points)
+            if self.batched_labels:
+                end_points = process_grasp_labels_batched(end_points)
+            else:
+                end_points = process_grasp_labels(end_points)
             grasp_top_rots, end_points = match_grasp_view_and_label(end_points)
         else:
             grasp_top_rots = end_points['grasp_top_rot']
+
+        query_xyz, query_features = seed_xyz, seed_features
+        if not self.is_training and (self.cascade_k > 0 or self.cascade_threshold > 0):
+            query_xyz, query_features, grasp_top_rots = self.select_cascade_seeds(seed_xyz, seed_features, end_points)
+            point_num = query_xyz.size(1)
         
         if self.multi_scale_grouping:
             group_features = []
@@ -590,10 +604,10 @@ class IGNet(nn.Module):
                 crop_height = 0.02 * torch.ones_like(crop_length, device=seed_xyz.device)
                 crop_size = torch.concat([crop_length, crop_width, crop_height], dim=-1)
                 group_features.append(crop_op(seed_xyz.contiguous(), seed_features.contiguous(), 
-                                                grasp_top_rots, crop_size.contiguous()))
+                                                grasp_top_rots, crop_size.contiguous(), query_xyz.contiguous()))
             group_features = torch.cat(group_features, dim=1) #            
             group_features = self.multi_scale_fuse(group_features)
-            seed_features_gate = self.multi_scale_gate(seed_features) * seed_features
+            seed_features_gate = self.multi_scale_gate(query_features) * query_features
             group_features = group_features + seed_features_gate
         else:
             crop_length = (0.04 + base_depth) * torch.ones((B, point_num, 1), device=seed_xyz.device)
@@ -601,10 +615,44 @@ class IGNet(nn.Module):
             crop_height = 0.02 * torch.ones_like(crop_length, device=seed_xyz.device)
             crop_size = torch.concat([crop_length, crop_width, crop_height], dim=-1).contiguous()
             group_features = self.crop(seed_xyz.contiguous(), seed_features.contiguous(),
-                                       grasp_top_rots, crop_size)
+                                       grasp_top_rots, crop_size, query_xyz.contiguous())
         end_points = self.depth_head(group_features, end_points)
         return end_points
 
+    def select_cascade_seeds(self, seed_xyz, seed_features, end_points):
+        """ Keep the seeds of every instance with the highest predicted rotation graspness.
+            The number kept is cascade_k (all if 0), lowered to the largest number of seeds above
+            cascade_threshold in the batch, so instances stay batched. The kept seed centers go to
+            cascade_xyz and their indices to cascade_seed_inds, grasp_top_rot(_inds) are cut to the kept
+            seeds; the input point_clouds and the per-seed outputs before the cascade keep all seeds.
+            The crops of the kept seeds still group from all seeds.
+
+            Input:
+                seed_xyz: [torch.FloatTensor, (B,Ns,3)]
+                seed_features: [torch.FloatTensor, (B,C,Ns)]
+
+            Output:
+                seed_xyz: [torch.FloatTensor, (B,K,3)]
+                seed_features: [torch.FloatTensor, (B,C,K)]
+                grasp_top_rots: [torch.FloatTensor, (B,K,3,3)]
+        """
+        B, point_num, _ = seed_xyz.shape
+        seed_scores = end_points['grasp_rot_graspness_pred'].max(dim=-1)[0]  # (B, Ns)
+        num_keep = point_num if self.cascade_k <= 0 else min(self.cascade_k, point_num)
+        if self.cascade_threshold > 0:
+            num_above = int((seed_scores > self.cascade_threshold).sum(dim=1).max())
+            num_keep = max(min(num_keep, num_above), 1)
+        _, seed_inds = torch.topk(seed_scores, num_keep, dim=1)  # (B, K)
+
+        seed_xyz = torch.gather(seed_xyz, 1, seed_inds.unsqueeze(-1).expand(-1, -1, 3))
+        seed_features = torch.gather(seed_features, 2, seed_inds.unsqueeze(1).expand(-1, seed_features.size(1), -1))
+        for key in ['grasp_top_rot_inds', 'grasp_top_rot']:
+            value = end_points[key]
+            end_points[key] = torch.gather(value, 1, seed_inds.view((B, num_keep) + (1,) * (value.dim() - 2)).expand(
+                (-1, -1) + value.shape[2:]))
+        end_points['cascade_xyz'] = seed_xyz
+        end_points['cascade_seed_inds'] = seed_inds
+        return seed_xyz, seed_features, end_points['grasp_top_rot']
 
 
 def process_grasp_labels(end_points):
@@ -623,6 +671,7 @@ def process_grasp_labels(end_points):
     
     pred_grasp_rots = []
     pred_grasp_depths = []
+    label_offsets = end_points['grasp_label_offsets'].tolist() if 'grasp_label_inds' in end_points else None
     
     for i in range(batch_size):
         seed_xyz = seed_xyzs[i]  # (Ns, 3)
@@ -630,8 +679,11 @@ def process_grasp_labels(end_points):
 
         # get merged grasp points for label computation
         grasp_points = end_points['grasp_points'][i]  # (Np, 3)
-        grasp_scores = end_points['grasp_labels'][i]  # (Np, V, A, D)
-        grasp_widths = end_points['grasp_offsets'][i]  # (Np, V, A, D)
+        if 'grasp_label_inds' in end_points:
+            grasp_scores, grasp_widths = densify_grasp_labels(end_points, i, grasp_points.size(0), label_offsets)
+        else:
+            grasp_scores = end_points['grasp_labels'][i]  # (Np, V, A, D)
+            grasp_widths = end_points['grasp_offsets'][i]  # (Np, V, A, D)
         _, V, A, D = grasp_scores.size()
         # num_grasp_points = grasp_points.size(0)
         
@@ -761,20 +813,32 @@ def process_grasp_labels(end_points):
     return end_points
 
 
+def process_grasp_labels_batched(end_points):
+    """ process_grasp_labels for the whole batch at once, lazily: the labels stay per grasp point with
+        the seed and rotation indices (models/grasp_label_utils.py), and match_grasp_view_and_label
+        materializes only the predicted rotation of every seed.
+    """
+    return process_lazy_grasp_labels(end_points)
+
+
 def match_grasp_view_and_label(end_points):
     """ Slice grasp labels according to predicted views. """
     top_rot_inds = end_points['grasp_top_rot_inds']  # (B, Ns)
-    template_views_rot = end_points['batch_grasp_rot']  # (B, Ns, V, A, 3, 3)
-    grasp_scores = end_points['batch_grasp_score']  # (B, Ns, V, A, D)
-    grasp_widths = end_points['batch_grasp_width']  # (B, Ns, V, A, D)
-
-    B, Ns, V, A, D = grasp_scores.size()
-    top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, 3, 3)
-    top_template_rot_mat = torch.gather(template_views_rot.view(B, Ns, V*A, 3, 3), 2, top_rot_inds_).squeeze(2)
-    
-    top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1).expand(-1, -1, -1, D)
-    top_rot_grasp_scores = torch.gather(grasp_scores.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
-    top_rot_grasp_widths = torch.gather(grasp_widths.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
+    if 'batch_grasp_label_inds' in end_points:
+        # lazy labels of process_grasp_labels_batched
+        top_template_rot_mat, top_rot_grasp_scores, top_rot_grasp_widths = gather_lazy_grasp_labels(end_points, top_rot_inds)
+    else:
+        template_views_rot = end_points['batch_grasp_rot']  # (B, Ns, V, A, 3, 3)
+        grasp_scores = end_points['batch_grasp_score']  # (B, Ns, V, A, D)
+        grasp_widths = end_points['batch_grasp_width']  # (B, Ns, V, A, D)
+
+        B, Ns, V, A, D = grasp_scores.size()
+        top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1, 1).expand(-1, -1, -1, 3, 3)
+        top_template_rot_mat = torch.gather(template_views_rot.view(B, Ns, V*A, 3, 3), 2, top_rot_inds_).squeeze(2)
+
+        top_rot_inds_ = top_rot_inds.view(B, Ns, 1, 1).expand(-1, -1, -1, D)
+        top_rot_grasp_scores = torch.gather(grasp_scores.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
+        top_rot_grasp_widths = torch.gather(grasp_widths.view(B, Ns, V*A, D), 2, top_rot_inds_).squeeze(2)
 
     # print(top_rot_grasp_scores.min(), top_rot_grasp_scores.max(), top_rot_grasp_scores.mean())
     # print(top_rot_grasp_widths.min(), top_rot_grasp_widths.max(), top_rot_grasp_widths.mean())
@@ -807,11 +871,13 @@ def match_grasp_view_and_label(end_points):
 
 
 def pred_decode(end_points, normalize=False):
-    grasp_center = end_points['point_clouds']
+    # grasp centers are the seeds kept by the inference cascade if it ran
+    center_key = 'cascade_xyz' if 'cascade_xyz' in end_points else 'point_clouds'
+    grasp_center = end_points[center_key]
     batch_size, num_samples, _ = grasp_center.shape
     grasp_preds = []
     for i in range(batch_size):
-        grasp_center = end_points['point_clouds'][i].float()
+        grasp_center = end_points[center_key][i].float()
         grasp_score = end_points['grasp_score_pred'][i].float() # (num_samples, D)
         grasp_width = 1.2 * end_points['grasp_width_pred'][i] / 10.  # 10 for multiply 10 in loss function
 
@@ -849,4 +915,24 @@ def pred_decode(end_points, normalize=False):
                                       grasp_depth, topk_grasp_rots, grasp_center, obj_ids],
                                      axis=-1).detach().cpu().numpy())
 
-    return grasp_preds
\ No newline at end of file
+    return grasp_preds
+
+
+def pred_decode_batched(end_points, normalize=False, to_numpy=False):
+    """ pred_decode for the whole batch at once, see models/grasp_decode_utils.py.
+
+        Output:
+            grasp_preds: [torch.FloatTensor, (B*Ns,17)]
+            offsets: [torch.LongTensor, (B+1,)]
+    """
+    grasp_center = end_points['cascade_xyz' if 'cascade_xyz' in end_points else 'point_clouds'].float()
+    grasp_score = end_points['grasp_score_pred'].float()  # (B, Ns, D)
+    grasp_width = 1.2 * end_points['grasp_width_pred'] / 10.  # 10 for multiply 10 in loss function
+    if normalize:
+        grasp_score = normalize_tensor(grasp_score)
+
+    grasp_score, grasp_score_inds = torch.max(grasp_score, dim=-1)  # (B, Ns)
+    grasp_width = torch.gather(grasp_width, 2, grasp_score_inds.unsqueeze(-1)).squeeze(-1)
+    grasp_width = torch.clamp(grasp_width, min=0., max=GRASP_MAX_WIDTH)
+    return pack_grasp_preds(grasp_score, grasp_width.float(), grasp_score_inds, end_points['grasp_top_rot_inds'],
+                            grasp_center, to_numpy)
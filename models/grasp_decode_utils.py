@@ -0,0 +1,198 @@
+""" Batched grasp decoding for the IGNet / GSNet models.
+    pred_decode in models/IGNet_v0_*.py and models/GSNet.py loops over the batch, tiles the template
+    rotations (and depths / angles) per seed only to gather one entry, and returns a list of (Ns,17)
+    arrays. pred_decode_batched decodes the whole batch at once, gathers rotations by index from the
+    template buffer of models/grasp_label_utils.py and returns one packed (N,17) tensor with
+    per-sample offsets, moved to numpy only at the end if asked for.
+
+    The rotation / approach heads of the same models select their eval-time top template by index
+    from a registered buffer as well; --heads compares that with the former per-seed template copies.
+
+    The __main__ checks assert that the batched output equals the per-sample pred_decode for every
+    sample (and the indexed head templates equal the expand+gather ones), then benchmark both;
+    --skip_benchmark runs the checks only.
+
+    python models/grasp_decode_utils.py --model IGNet_v0_8 --batch_sizes 1 4 16 --device cuda
+    python models/grasp_decode_utils.py --model IGNet_v0_8 --heads --device cuda
+"""
+
+import os
+import sys
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from models.grasp_label_utils import get_label_templates
+
+_DEPTHS = {}
+
+
+def get_depth_templates(device):
+    """ Grasp depths of the D depth bins, (D,), built once per device. """
+    device = torch.device(device)
+    if device not in _DEPTHS:
+        _DEPTHS[device] = torch.linspace(0.01, 0.04, 4).to(device)
+    return _DEPTHS[device]
+
+
+def pack_grasp_preds(grasp_score, grasp_width, depth_inds, rot_inds, grasp_center, to_numpy=False):
+    """ Pack decoded grasps of a batch into GraspGroup rows.
+
+        Input:
+            grasp_score: [torch.FloatTensor, (B,Ns)]
+            grasp_width: [torch.FloatTensor, (B,Ns)]
+            depth_inds: [torch.LongTensor, (B,Ns)]
+            rot_inds: [torch.LongTensor, (B,Ns)]
+                flat template (view, angle)
+            grasp_center: [torch.FloatTensor, (B,Ns,3)]
+            to_numpy: [bool]
+                return numpy arrays instead of tensors on the input device
+
+        Output:
+            grasp_preds: [torch.FloatTensor, (B*Ns,17)]
+                score, width, height, depth, rotation (9), center (3), object id
+            offsets: [torch.LongTensor, (B+1,)]
+                rows of sample i are grasp_preds[offsets[i]:offsets[i+1]]
+    """
+    batch_size, num_samples = grasp_score.size()
+    device = grasp_score.device
+    grasp_rots = get_label_templates(device)['rots'][rot_inds].view(batch_size, num_samples, 9)
+    grasp_depth = get_depth_templates(device)[depth_inds]
+    grasp_height = 0.02 * torch.ones_like(grasp_score)
+    obj_ids = -1 * torch.ones_like(grasp_score)
+    grasp_preds = torch.cat([grasp_score.unsqueeze(-1), grasp_width.unsqueeze(-1), grasp_height.unsqueeze(-1),
+                             grasp_depth.unsqueeze(-1), grasp_rots, grasp_center, obj_ids.unsqueeze(-1)], dim=-1)
+    grasp_preds = grasp_preds.view(batch_size * num_samples, 17)
+    offsets = torch.arange(batch_size + 1, device=device) * num_samples
+    if to_numpy:
+        return grasp_preds.detach().cpu().numpy(), offsets.cpu().numpy()
+    return grasp_preds, offsets
+
+
+def split_grasp_preds(grasp_preds, offsets):
+    """ Packed grasps -> list of per-sample rows, as returned by pred_decode. """
+    return [grasp_preds[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+if __name__ == '__main__':
+    # Parity (asserted) and latency of pred_decode_batched against the per-sample pred_decode of a
+    # model on random predictions, at realistic seed counts
+    import time
+    import argparse
+    import importlib
+    import numpy as np
+    from utils.loss_utils import NUM_VIEW, NUM_ANGLE, NUM_DEPTH, M_POINT
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='IGNet_v0_8', help='Model file under models/ (IGNet_v0_7/8, GSNet) [default: IGNet_v0_8]')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16], help='Batch sizes to compare [default: 1 4 16]')
+    parser.add_argument('--num_seed', type=int, default=1024, help='Seeds per sample, M_POINT for GSNet [default: 1024]')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='Device [default: cuda if available]')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs [default: 5]')
+    parser.add_argument('--heads', action='store_true', help='Check the top template selection of the heads instead [default: False]')
+    parser.add_argument('--skip_benchmark', action='store_true', help='Only run the parity checks [default: False]')
+    cfgs = parser.parse_args()
+    model = importlib.import_module('models.' + cfgs.model)
+    device = torch.device(cfgs.device)
+    num_seed = M_POINT if cfgs.model == 'GSNet' else cfgs.num_seed
+    ROT_COLUMNS = list(range(4, 13))
+    # GSNet pred_decode rebuilds the rotations from the approach vector and angle instead of taking
+    # the template, which differs in the last float bit
+    rot_atol = 1e-6 if cfgs.model == 'GSNet' else 0
+
+    def timed(func, *args, **kwargs):
+        timings = []
+        for _ in range(cfgs.repeat + 1):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            tic = time.time()
+            out = func(*args, **kwargs)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            timings.append(time.time() - tic)
+        return out, 1000 * sorted(timings[1:])[cfgs.repeat // 2]
+
+    def expand_gather_templates(templates, top_inds):
+        # former eval path of the heads: a contiguous (B,Ns,K,...) copy of the templates, then gather
+        B, num_seed = top_inds.size()
+        item_shape = templates.shape[1:]
+        templates = templates.view((1, 1) + templates.shape).expand((B, num_seed) + templates.shape).contiguous()
+        top_inds_ = top_inds.view((B, num_seed, 1) + (1,) * len(item_shape)).expand((-1, -1, -1) + item_shape)
+        return torch.gather(templates, 2, top_inds_).squeeze(2)
+
+    def peak_bytes(func, *args):
+        if device.type != 'cuda':
+            return float('nan')
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        func(*args)
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(device) - base
+
+    if cfgs.heads:
+        if cfgs.model == 'IGNet_v0_8':
+            heads = [model.RotationScoringNet(NUM_VIEW, NUM_ANGLE, NUM_DEPTH, 512, is_training=False),
+                     model.RotationGraspableNet(NUM_VIEW, NUM_ANGLE, NUM_DEPTH, 512, is_training=False)]
+            buffers, out_keys = ['template_rots'], ['grasp_top_rot']
+        elif cfgs.model == 'IGNet_v0_7':
+            heads = [model.ApproachNet(NUM_VIEW, NUM_ANGLE, NUM_DEPTH, 512, is_training=False)]
+            buffers, out_keys = ['template_views', 'template_view_rots'], ['grasp_top_view_xyz', 'grasp_top_view_rot']
+        else:
+            heads = [model.ApproachNet(NUM_VIEW, 512, is_training=False)]
+            buffers, out_keys = ['template_views', 'template_view_rots'], ['grasp_top_view_xyz', 'grasp_top_view_rot']
+        for head in heads:
+            head = head.to(device).eval()
+            inds_key = 'grasp_top_rot_inds' if cfgs.model == 'IGNet_v0_8' else 'grasp_top_view_inds'
+            for B in cfgs.batch_sizes:
+                with torch.no_grad():
+                    end_points, _ = head(torch.rand(B, 512, num_seed, device=device), {})
+                top_inds = end_points[inds_key]
+                for buffer_name, out_key in zip(buffers, out_keys):
+                    templates = getattr(head, buffer_name)
+                    assert torch.equal(expand_gather_templates(templates, top_inds), end_points[out_key]), \
+                        '{} {}: indexed templates differ from expand+gather'.format(type(head).__name__, out_key)
+                    print('{} {} batch {} x {} seeds: indexed templates equal expand+gather'.format(
+                        type(head).__name__, buffer_name, B, num_seed))
+                    if cfgs.skip_benchmark:
+                        continue
+                    _, expand_ms = timed(expand_gather_templates, templates, top_inds)
+                    _, index_ms = timed(lambda: templates[top_inds])
+                    copy_mb = B * num_seed * templates.numel() * templates.element_size() / (1 << 20)
+                    print('  expand+gather {:.2f} ms ({:.1f} MB copy, peak {:.1f} MB), index {:.3f} ms (peak {:.2f} MB)'.format(
+                        expand_ms, copy_mb, peak_bytes(expand_gather_templates, templates, top_inds) / (1 << 20), index_ms,
+                        peak_bytes(lambda: templates[top_inds]) / (1 << 20)))
+        sys.exit(0)
+
+    for B in cfgs.batch_sizes:
+        xyz = torch.rand(B, num_seed, 3, device=device)
+        if cfgs.model == 'IGNet_v0_8':
+            end_points = {'point_clouds': xyz,
+                          'grasp_score_pred': torch.rand(B, num_seed, NUM_DEPTH, device=device),
+                          'grasp_width_pred': torch.rand(B, num_seed, NUM_DEPTH, device=device),
+                          'grasp_top_rot_inds': torch.randint(NUM_VIEW * NUM_ANGLE, (B, num_seed), device=device)}
+        else:
+            view_inds = torch.randint(NUM_VIEW, (B, num_seed), device=device)
+            end_points = {'point_clouds': xyz, 'xyz_graspable': xyz,
+                          'grasp_score_pred': torch.rand(B, num_seed, NUM_ANGLE, NUM_DEPTH, device=device),
+                          'grasp_width_pred': torch.rand(B, num_seed, NUM_ANGLE, NUM_DEPTH, device=device),
+                          'grasp_top_view_inds': view_inds,
+                          'grasp_top_view_xyz': get_label_templates(device)['views'][view_inds]}
+        loop_preds = [torch.as_tensor(p).cpu().numpy() for p in model.pred_decode(end_points)]
+        packed, offsets = model.pred_decode_batched(end_points)
+        packed_np, offsets_np = model.pred_decode_batched(end_points, to_numpy=True)
+        assert np.array_equal(packed.cpu().numpy(), packed_np) and np.array_equal(offsets.cpu().numpy(), offsets_np)
+        for i, (loop_pred, batched_pred) in enumerate(zip(loop_preds, split_grasp_preds(packed_np, offsets_np))):
+            assert loop_pred.shape == batched_pred.shape, 'sample {}: {} rows, loop {}'.format(i, len(batched_pred), len(loop_pred))
+            assert np.array_equal(np.delete(loop_pred, ROT_COLUMNS, 1), np.delete(batched_pred, ROT_COLUMNS, 1)), \
+                'sample {}: batched grasps differ from the loop'.format(i)
+            rot_diff = np.abs(loop_pred[:, ROT_COLUMNS] - batched_pred[:, ROT_COLUMNS]).max()
+            assert rot_diff <= rot_atol, 'sample {}: rotations differ from the loop by {:.3g}'.format(i, rot_diff)
+        print('batch {} x {} seeds: batched grasps equal the loop for every sample'.format(B, num_seed))
+        if cfgs.skip_benchmark:
+            continue
+
+        _, loop_ms = timed(model.pred_decode, end_points)
+        _, batched_ms = timed(model.pred_decode_batched, end_points)
+        _, numpy_ms = timed(model.pred_decode_batched, end_points, to_numpy=True)
+        print('  loop {:.2f} ms, batched {:.2f} ms, batched + numpy {:.2f} ms'.format(loop_ms, batched_ms, numpy_ms))
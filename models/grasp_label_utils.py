@@ -0,0 +1,472 @@
+""" Batched grasp label assignment for the IGNet models.
+    process_grasp_labels in models/IGNet_v0_*.py loops over the batch and, for every sample, rebuilds
+    the grasp views and the key points of all V*A template rotations. Here the templates are device
+    buffers built once, and a whole batch is assigned with a few batched kNN and gather ops.
+
+    The batched labels are lazy: instead of (B,Ns,V,A,3,3) rotations and (B,Ns,V,A,D) scores and
+    widths per seed, they keep the labels per grasp point with the object pose and the seed and
+    template indices, and match_grasp_view_and_label materializes only the predicted template.
+
+    The __main__ check asserts that the lazy labels and indices reproduce process_grasp_labels exactly,
+    then benchmarks both; --skip_benchmark runs the check only.
+
+    python models/grasp_label_utils.py --model IGNet_v0_8 --batch_sizes 1 2 4 8 --device cuda
+"""
+
+import os
+import sys
+import torch
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+
+from pytorch3d.ops.knn import knn_points
+from utils.loss_utils import generate_grasp_views, batch_viewpoint_params_to_matrix, batch_get_key_points, \
+                             GRASP_MAX_WIDTH, NUM_VIEW, NUM_ANGLE, NUM_DEPTH
+
+_LABEL_TEMPLATES = {}
+
+
+def get_label_templates(device):
+    """ Template views, rotations and rotation key points, built once per device.
+
+        Output:
+            templates: [dict]
+                views: [torch.FloatTensor, (V,3)]
+                rots: [torch.FloatTensor, (V*A,3,3)]
+                    view-major, same as grasp_rot in the model files
+                view_rots: [torch.FloatTensor, (V,3,3)]
+                    in-plane angle 0
+                key_points: [torch.FloatTensor, (V,A,12)]
+                    key points of rots at width 0.02 and depth 0.02, as in align_angle_index
+    """
+    device = torch.device(device)
+    if device not in _LABEL_TEMPLATES:
+        views = generate_grasp_views(NUM_VIEW)
+        angles = torch.tensor([3.141592653589793 / NUM_ANGLE * i for i in range(NUM_ANGLE)])
+        rots = batch_viewpoint_params_to_matrix(-views.repeat_interleave(NUM_ANGLE, dim=0), angles.tile(NUM_VIEW))
+        view_rots = batch_viewpoint_params_to_matrix(-views, torch.zeros(NUM_VIEW))
+        views, rots, view_rots = views.to(device), rots.to(device), view_rots.to(device)
+        key_points, _ = rotation_key_points(rots)
+        _LABEL_TEMPLATES[device] = {'views': views, 'rots': rots, 'view_rots': view_rots,
+                                    'key_points': key_points.view(NUM_VIEW, NUM_ANGLE, -1)}
+    return _LABEL_TEMPLATES[device]
+
+
+def rotation_key_points(rots):
+    """ Gripper key points and their symmetric version of rotations at the origin, (N,12) each. """
+    num_rots = rots.size(0)
+    widths = 0.02 * torch.ones(num_rots, device=rots.device)
+    depths = 0.02 * torch.ones(num_rots, device=rots.device)
+    centers = torch.zeros((num_rots, 3), device=rots.device)
+    key_points, key_points_sym = batch_get_key_points(centers, rots, widths, depths)
+    return key_points.contiguous().view(num_rots, -1), key_points_sym.contiguous().view(num_rots, -1)
+
+
+def batch_assign_views(object_rots, templates):
+    """ For every template view, the label view it is closest to after the object rotation.
+
+        Input:
+            object_rots: [torch.FloatTensor, (B,3,3)]
+
+        Output:
+            view_inds: [torch.LongTensor, (B,V)]
+    """
+    batch_size = object_rots.size(0)
+    views = templates['views'].unsqueeze(0).expand(batch_size, -1, -1).contiguous()
+    views_trans = torch.matmul(views, object_rots.transpose(1, 2))
+    _, view_inds, _ = knn_points(views, views_trans.contiguous(), K=1)
+    return view_inds.squeeze(-1)
+
+
+def batch_align_angles(rots_trans, templates):
+    """ For every template (view, angle), the angle of the view-assigned label rotations whose key
+        points (or their symmetric version) are closest, as align_angle_index.
+
+        Input:
+            rots_trans: [torch.FloatTensor, (B,V,A,3,3)]
+                object-rotated label rotations after view assignment
+
+        Output:
+            angle_inds: [torch.LongTensor, (B,V,A)]
+    """
+    batch_size, num_view, num_angle = rots_trans.shape[:3]
+    key_points, key_points_sym = rotation_key_points(rots_trans.reshape(-1, 3, 3))
+    key_points = key_points.view(batch_size * num_view, num_angle, -1)
+    key_points_sym = key_points_sym.view(batch_size * num_view, num_angle, -1)
+    template_key_points = templates['key_points'].repeat(batch_size, 1, 1)
+    dis, inds, _ = knn_points(template_key_points, key_points, K=1)
+    dis_sym, inds_sym, _ = knn_points(template_key_points, key_points_sym, K=1)
+    angle_inds = torch.where(dis < dis_sym, inds, inds_sym)
+    return angle_inds.view(batch_size, num_view, num_angle)
+
+
+def batch_label_alignment(object_rots, align_angles=True):
+    """ Label (view, angle) of every template (view, angle) for a batch of object rotations.
+
+        Input:
+            object_rots: [torch.FloatTensor, (B,3,3)]
+            align_angles: [bool]
+                also permute in-plane angles to the template angles (v0.6/v0.8), otherwise only views (v0.7)
+
+        Output:
+            label_inds: [torch.LongTensor, (B,V*A)]
+                flat label (view, angle) of every template (view, angle)
+    """
+    templates = get_label_templates(object_rots.device)
+    batch_size = object_rots.size(0)
+    V, A = NUM_VIEW, NUM_ANGLE
+    view_inds = batch_assign_views(object_rots, templates)  # (B, V)
+    if align_angles:
+        rots_trans = torch.matmul(object_rots.unsqueeze(1), templates['rots'].unsqueeze(0))  # (B, V*A, 3, 3)
+        rots_trans = rots_trans.view(batch_size, V, A, 3, 3)
+        rots_trans = torch.gather(rots_trans, 1, view_inds.view(batch_size, V, 1, 1, 1).expand(-1, -1, A, 3, 3))
+        angle_inds = batch_align_angles(rots_trans, templates)  # (B, V, A)
+    else:
+        angle_inds = torch.arange(A, device=object_rots.device).view(1, 1, A).expand(batch_size, V, -1)
+    return (view_inds.unsqueeze(-1) * A + angle_inds).view(batch_size, V * A)
+
+
+def batch_assign_labels(object_poses, grasp_points, seed_xyz, align_angles=True, label_inds=None, nn_inds=None):
+    """ Assign object grasp labels to seeds for a whole batch, as indices.
+
+        Input:
+            object_poses: [torch.FloatTensor, (B,3,4)]
+            grasp_points: [torch.FloatTensor, (B,Np,3)]
+                object-frame grasp points
+            seed_xyz: [torch.FloatTensor, (B,Ns,3)]
+            align_angles: [bool]
+                see batch_label_alignment
+            label_inds: [torch.LongTensor, (B,V*A)]
+                precomputed alignment (dataset/generate_alignment_lut.py), rows starting with -1 are computed
+            nn_inds: [torch.LongTensor, (B,Ns)]
+                precomputed nearest grasp points (dataset/label_assignment.py)
+
+        Output:
+            grasp_points_trans: [torch.FloatTensor, (B,Ns,3)]
+                nearest grasp point of every seed
+            nn_inds: [torch.LongTensor, (B,Ns)]
+                index of the nearest grasp point of every seed
+            label_inds: [torch.LongTensor, (B,V*A)]
+                flat label (view, angle) of every template (view, angle)
+    """
+    object_rots = object_poses[:, :, :3]
+    if label_inds is None:
+        label_inds = batch_label_alignment(object_rots, align_angles)
+    else:
+        miss_mask = label_inds[:, 0] < 0
+        if miss_mask.any():
+            label_inds = label_inds.clone()
+            label_inds[miss_mask] = batch_label_alignment(object_rots[miss_mask], align_angles)
+
+    grasp_points_trans = torch.matmul(grasp_points, object_rots.transpose(1, 2)) + object_poses[:, :, 3].unsqueeze(1)
+    if nn_inds is None:
+        _, nn_inds, _ = knn_points(seed_xyz, grasp_points_trans, K=1)
+        nn_inds = nn_inds.squeeze(-1)  # (B, Ns)
+    grasp_points_trans = torch.gather(grasp_points_trans, 1, nn_inds.unsqueeze(-1).expand(-1, -1, 3))
+    return grasp_points_trans, nn_inds, label_inds
+
+
+def label_graspness(graspness, nn_inds, inds):
+    """ Normalized fraction of grasps with 0 < score <= 0.6 per template of every seed, computed on
+        the grasp points and gathered to the seeds afterwards (normalization is per seed and point).
+
+        Input:
+            graspness: [torch.FloatTensor, (B,Np,K)]
+                fraction of the C grasps of each of K labels (rotations or views), point_graspness
+            nn_inds: [torch.LongTensor, (B,Ns)]
+            inds: [torch.LongTensor, (B,K)]
+                label of every template
+
+        Output:
+            graspness: [torch.FloatTensor, (B,Ns,K)]
+    """
+    batch_size, num_grasp_points, K = graspness.size()
+    graspness = torch.gather(graspness, 2, inds.unsqueeze(1).expand(-1, num_grasp_points, -1))
+    graspness = normalize_tensor(graspness)
+    return torch.gather(graspness, 1, nn_inds.unsqueeze(-1).expand(-1, -1, K))
+
+
+def point_graspness(grasp_scores):
+    """ (B,Np,K,C) scores -> (B,Np,K) fraction of 0 < score <= 0.6 """
+    return ((grasp_scores <= 0.6) & (grasp_scores > 0)).float().mean(dim=-1)
+
+
+def gather_point_labels(labels, nn_inds, inds):
+    """ Labels of one template per seed.
+
+        Input:
+            labels: [torch.FloatTensor, (B,Np,K,C)]
+            nn_inds: [torch.LongTensor, (B,Ns)]
+            inds: [torch.LongTensor, (B,Ns)]
+                label (in 0..K-1) of every seed
+
+        Output:
+            labels: [torch.FloatTensor, (B,Ns,C)]
+    """
+    batch_size, _, K, C = labels.size()
+    flat_inds = nn_inds * K + inds
+    return torch.gather(labels.reshape(batch_size, -1, C), 1, flat_inds.unsqueeze(-1).expand(-1, -1, C))
+
+
+def normalize_tensor(tensor, eps=1e-8):
+    max_val = torch.amax(tensor, dim=-1, keepdim=True)
+    min_val = torch.amin(tensor, dim=-1, keepdim=True)
+    return (tensor - min_val) / (max_val - min_val + eps)
+
+
+def process_lazy_grasp_labels(end_points, densify_fn=None, align_angles=True):
+    """ Lazy grasp labels of a batch: instead of (B,Ns,V,A,3,3) rotations and (B,Ns,V,A,D) scores
+        and widths per seed, keep the labels per grasp point with the seed and template indices, and
+        materialize them only for the template chosen per seed (gather_lazy_grasp_labels).
+
+        Output end_points keys:
+            batch_grasp_point: [torch.FloatTensor, (B,Ns,3)]
+            batch_grasp_nn_inds: [torch.LongTensor, (B,Ns)]
+            batch_grasp_label_inds: [torch.LongTensor, (B,V*A)]
+                taken from grasp_label_align where the dataset found it in the alignment table
+            batch_grasp_point_score: [torch.FloatTensor, (B,Np,V,A,D)]
+            batch_grasp_point_width: [torch.FloatTensor, (B,Np,V,A,D)]
+            batch_grasp_rot_graspness: [torch.FloatTensor, (B,Ns,V*A)]
+                if align_angles, otherwise batch_grasp_view_graspness (B,Ns,V)
+            count/label_align_lut_hit: [torch.FloatTensor, ()]
+                fraction of samples whose alignment came with the batch (table or worker)
+
+        Precomputed inputs used if present (dataset/label_assignment.py, worker_labels=True):
+            grasp_label_align: [torch.ShortTensor, (B,V*A)]
+            grasp_nn_inds: [torch.LongTensor, (B,Ns)]
+            grasp_point_graspness_count: [torch.ByteTensor, (B,Np,V*A)]
+    """
+    grasp_points, grasp_scores, grasp_widths = stack_grasp_labels(end_points, densify_fn)
+    batch_size, num_grasp_points, V, A, D = grasp_scores.size()
+    label_inds = None
+    if align_angles and 'grasp_label_align' in end_points:
+        label_inds = end_points['grasp_label_align'].long()
+        end_points['count/label_align_lut_hit'] = (label_inds[:, 0] >= 0).float().mean()
+    batch_grasp_points, nn_inds, label_inds = batch_assign_labels(end_points['object_pose'], grasp_points,
+                                                                  end_points['point_clouds'], align_angles, label_inds,
+                                                                  end_points.get('grasp_nn_inds'))
+    if align_angles:
+        if 'grasp_point_graspness_count' in end_points:
+            graspness = end_points['grasp_point_graspness_count'].float() / D
+        else:
+            graspness = point_graspness(grasp_scores.view(batch_size, num_grasp_points, V * A, D))
+        end_points['batch_grasp_rot_graspness'] = label_graspness(graspness, nn_inds, label_inds)
+    else:
+        view_inds = label_inds.view(batch_size, V, A)[:, :, 0] // A
+        graspness = point_graspness(grasp_scores.view(batch_size, num_grasp_points, V, A * D))
+        end_points['batch_grasp_view_graspness'] = label_graspness(graspness, nn_inds, view_inds)
+    end_points['batch_grasp_point'] = batch_grasp_points
+    end_points['batch_grasp_nn_inds'] = nn_inds
+    end_points['batch_grasp_label_inds'] = label_inds
+    end_points['batch_grasp_point_score'] = grasp_scores
+    end_points['batch_grasp_point_width'] = grasp_widths
+    return end_points
+
+
+def gather_lazy_grasp_labels(end_points, top_inds, view_only=False):
+    """ Materialize the lazy labels of the template chosen for every seed.
+
+        Input:
+            top_inds: [torch.LongTensor, (B,Ns)]
+                flat template (view, angle), or template view if view_only
+
+        Output:
+            top_rots: [torch.FloatTensor, (B,Ns,3,3)]
+                object-rotated label rotation (angle 0 if view_only)
+            top_scores: [torch.FloatTensor, (B,Ns,D)], or (B,Ns,A,D) if view_only
+                zero where the label width exceeds GRASP_MAX_WIDTH
+            top_widths: [torch.FloatTensor, (B,Ns,D)], or (B,Ns,A,D) if view_only
+    """
+    templates = get_label_templates(top_inds.device)
+    grasp_scores = end_points['batch_grasp_point_score']
+    grasp_widths = end_points['batch_grasp_point_width']
+    nn_inds = end_points['batch_grasp_nn_inds']
+    label_inds = end_points['batch_grasp_label_inds']
+    batch_size, num_grasp_points, V, A, D = grasp_scores.size()
+    object_rots = end_points['object_pose'][:, :, :3].unsqueeze(1)  # (B, 1, 3, 3)
+    if view_only:
+        inds = torch.gather(label_inds.view(batch_size, V, A)[:, :, 0] // A, 1, top_inds)  # (B, Ns)
+        top_rots = torch.matmul(object_rots, templates['view_rots'][inds])
+        label_shape = (batch_size, num_grasp_points, V, A * D)
+    else:
+        inds = torch.gather(label_inds, 1, top_inds)  # (B, Ns)
+        top_rots = torch.matmul(object_rots, templates['rots'][inds])
+        label_shape = (batch_size, num_grasp_points, V * A, D)
+    top_scores = gather_point_labels(grasp_scores.view(label_shape), nn_inds, inds)
+    top_widths = gather_point_labels(grasp_widths.view(label_shape), nn_inds, inds)
+    top_scores[~((top_scores > 0) & (top_widths <= GRASP_MAX_WIDTH))] = 0
+    if view_only:
+        top_scores, top_widths = top_scores.view(batch_size, -1, A, D), top_widths.view(batch_size, -1, A, D)
+    return top_rots, top_scores, top_widths
+
+
+def densify_grasp_labels(end_points, batch_idx, num_grasp_points, label_offsets=None):
+    """ Scatter the sparse labels of one sample into dense (Np, V, A, D) scores and widths,
+        entries not transported are zero.
+
+        Input:
+            label_offsets: [list]
+                grasp_label_offsets read once for the batch, every read of the tensor syncs the GPU,
+                default: None (read the two offsets of this sample)
+    """
+    if label_offsets is None:
+        label_offsets = end_points['grasp_label_offsets'][batch_idx:batch_idx+2].tolist()
+        start, end = label_offsets
+    else:
+        start, end = label_offsets[batch_idx], label_offsets[batch_idx + 1]
+    label_inds = end_points['grasp_label_inds'][start:end].long()
+    grasp_scores = end_points['grasp_label_scores'].new_zeros(num_grasp_points * NUM_VIEW * NUM_ANGLE * NUM_DEPTH)
+    grasp_widths = torch.zeros_like(grasp_scores)
+    grasp_scores[label_inds] = end_points['grasp_label_scores'][start:end]
+    grasp_widths[label_inds] = end_points['grasp_label_widths'][start:end]
+    grasp_scores = grasp_scores.view(num_grasp_points, NUM_VIEW, NUM_ANGLE, NUM_DEPTH)
+    grasp_widths = grasp_widths.view(num_grasp_points, NUM_VIEW, NUM_ANGLE, NUM_DEPTH)
+    return grasp_scores, grasp_widths
+
+
+def stack_grasp_labels(end_points, densify_fn=None):
+    """ Batch label tensors of end_points, densifying sparse labels per sample with densify_fn
+        (default densify_grasp_labels).
+    """
+    if densify_fn is None:
+        densify_fn = densify_grasp_labels
+    grasp_points = end_points['grasp_points']
+    if 'grasp_label_inds' in end_points:
+        label_offsets = end_points['grasp_label_offsets'].tolist()
+        labels = [densify_fn(end_points, i, grasp_points.size(1), label_offsets) for i in range(grasp_points.size(0))]
+        return grasp_points, torch.stack([l[0] for l in labels], 0), torch.stack([l[1] for l in labels], 0)
+    return grasp_points, end_points['grasp_labels'], end_points['grasp_offsets']
+
+
+def tensor_bytes(tensors):
+    """ Bytes of the distinct storages behind tensors, expanded views counted once. """
+    storages = {}
+    for tensor in tensors:
+        if torch.is_tensor(tensor):
+            storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+    return sum(storages.values())
+
+
+if __name__ == '__main__':
+    # Parity of the lazy batched labels with the per-sample process_grasp_labels of a model on random
+    # labels (asserted, dense and sparse input), then timing and memory of both through
+    # match_grasp_view_and_label with random predicted templates
+    import time
+    import argparse
+    import importlib
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='IGNet_v0_8', help='Model file under models/ (IGNet_v0_6/7/8) [default: IGNet_v0_8]')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4], help='Batch sizes to compare [default: 1 2 4]')
+    parser.add_argument('--num_seed', type=int, default=1024, help='Seeds per sample [default: 1024]')
+    parser.add_argument('--grasp_num', type=int, default=350, help='Grasp points per sample [default: 350]')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='Device [default: cuda if available]')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs [default: 3]')
+    parser.add_argument('--skip_benchmark', action='store_true', help='Only run the parity check [default: False]')
+    cfgs = parser.parse_args()
+    model = importlib.import_module('models.' + cfgs.model)
+    view_only = cfgs.model == 'IGNet_v0_7'
+    device = torch.device(cfgs.device)
+
+    def random_end_points(B, Ns, Np):
+        w, x, y, z = torch.nn.functional.normalize(torch.randn(B, 4), dim=1).unbind(1)
+        rots = torch.stack([1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w),
+                            2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w),
+                            2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)], 1).view(B, 3, 3)
+        trans = 0.5 * torch.rand(B, 1, 3)
+        grasp_labels = torch.rand(B, Np, NUM_VIEW, NUM_ANGLE, NUM_DEPTH) * 1.2 - 0.2
+        grasp_labels[grasp_labels < 0] = 0
+        end_points = {
+            'object_pose': torch.cat([rots, trans.transpose(1, 2)], 2).to(device),
+            'grasp_points': (0.05 * torch.randn(B, Np, 3)).to(device),
+            'point_clouds': (torch.matmul(0.05 * torch.randn(B, Ns, 3), rots.transpose(1, 2)) + trans).to(device),
+            'grasp_labels': grasp_labels.to(device),
+            'grasp_offsets': (torch.rand(B, Np, NUM_VIEW, NUM_ANGLE, NUM_DEPTH) * 0.12 * (grasp_labels > 0)).to(device),
+        }
+        if view_only:
+            end_points['grasp_top_view_inds'] = torch.randint(NUM_VIEW, (B, Ns), device=device)
+        else:
+            end_points['grasp_top_rot_inds'] = torch.randint(NUM_VIEW * NUM_ANGLE, (B, Ns), device=device)
+        return end_points
+
+    def sparsify(end_points):
+        # the sparse labels of dataset/ignet_multi_dataset.py (sparse_labels=True) for the same grasps
+        end_points = dict(end_points)
+        scores, widths = end_points.pop('grasp_labels'), end_points.pop('grasp_offsets')
+        label_inds = [torch.nonzero(score.reshape(-1)).squeeze(1) for score in scores]
+        end_points['grasp_label_inds'] = torch.cat(label_inds).int()
+        end_points['grasp_label_scores'] = torch.cat([s.reshape(-1)[i] for s, i in zip(scores, label_inds)])
+        end_points['grasp_label_widths'] = torch.cat([w.reshape(-1)[i] for w, i in zip(widths, label_inds)])
+        label_nums = torch.tensor([len(i) for i in label_inds])
+        end_points['grasp_label_offsets'] = torch.cat([label_nums.new_zeros(1), torch.cumsum(label_nums, 0)]).to(device)
+        return end_points
+
+    def expand_lazy_labels(end_points):
+        # per-seed labels of all templates from the lazy labels and indices, masked as in process_grasp_labels
+        grasp_scores = end_points['batch_grasp_point_score']
+        grasp_widths = end_points['batch_grasp_point_width']
+        nn_inds, label_inds = end_points['batch_grasp_nn_inds'], end_points['batch_grasp_label_inds']
+        B, Np, V, A, D = grasp_scores.size()
+        Ns = nn_inds.size(1)
+        object_rots = end_points['object_pose'][:, :, :3].view(B, 1, 1, 3, 3)
+        if view_only:
+            inds = label_inds.view(B, V, A)[:, :, 0] // A
+            rots = torch.matmul(object_rots, get_label_templates(device)['view_rots'][inds].unsqueeze(1))
+            label_shape = (B, Np, V, A * D)
+        else:
+            inds = label_inds
+            rots = torch.matmul(object_rots, get_label_templates(device)['rots'][inds].unsqueeze(1)).view(B, 1, V, A, 3, 3)
+            label_shape = (B, Np, V * A, D)
+        batch_inds = torch.arange(B, device=device).view(B, 1, 1)
+        expand = lambda labels: labels.view(label_shape)[batch_inds, nn_inds.unsqueeze(-1), inds.unsqueeze(1)].view(B, Ns, V, A, D)
+        scores, widths = expand(grasp_scores), expand(grasp_widths)
+        scores[~((scores > 0) & (widths <= GRASP_MAX_WIDTH))] = 0
+        return rots.expand((B, Ns) + rots.shape[2:]), scores, widths
+
+    def check_parity(end_points):
+        loop = model.process_grasp_labels(dict(end_points))
+        rot_key, graspness_key = ('batch_grasp_view_rot', 'batch_grasp_view_graspness') if view_only else \
+                                 ('batch_grasp_rot', 'batch_grasp_rot_graspness')
+        for input_name, inputs in [('dense', end_points), ('sparse', sparsify(end_points))]:
+            lazy = model.process_grasp_labels_batched(dict(inputs))
+            rots, scores, widths = expand_lazy_labels(lazy)
+            for key, lazy_value in [('batch_grasp_point', lazy['batch_grasp_point']), (graspness_key, lazy[graspness_key]),
+                                    (rot_key, rots), ('batch_grasp_score', scores), ('batch_grasp_width', widths)]:
+                assert torch.equal(loop[key], lazy_value), '{} labels: {} differs from the loop'.format(input_name, key)
+            loop_top_rots, loop_matched = model.match_grasp_view_and_label(dict(loop))
+            lazy_top_rots, lazy_matched = model.match_grasp_view_and_label(lazy)
+            assert torch.equal(loop_top_rots, lazy_top_rots), '{} labels: top_rots differ from the loop'.format(input_name)
+            for key in ['batch_grasp_score', 'batch_grasp_width']:
+                assert torch.equal(loop_matched[key], lazy_matched[key]), \
+                    '{} labels: matched {} differs from the loop'.format(input_name, key)
+
+    def run_labels(func, end_points):
+        end_points = func(dict(end_points))
+        label_bytes = tensor_bytes(end_points.values())
+        top_rots, end_points = model.match_grasp_view_and_label(end_points)
+        return end_points, label_bytes
+
+    for B in cfgs.batch_sizes:
+        end_points = random_end_points(B, cfgs.num_seed, cfgs.grasp_num)
+        check_parity(end_points)
+        print('batch {}: lazy labels and indices equal the loop labels (dense and sparse input)'.format(B))
+        if cfgs.skip_benchmark:
+            continue
+
+        input_bytes = tensor_bytes(end_points.values())
+        for name, func in [('loop', model.process_grasp_labels), ('lazy', model.process_grasp_labels_batched)]:
+            timings = []
+            for _ in range(cfgs.repeat + 1):
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats(device)
+                tic = time.time()
+                _, label_bytes = run_labels(func, end_points)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                timings.append(time.time() - tic)
+            message = 'batch {} {}: label tensors {:.1f} MB, median {:.1f} ms'.format(
+                B, name, (label_bytes - input_bytes) / (1 << 20), 1000 * sorted(timings[1:])[cfgs.repeat // 2])
+            if device.type == 'cuda':
+                message += ', peak {:.1f} MB'.format(torch.cuda.max_memory_allocated(device) / (1 << 20))
+            print(message)
@@ -9,6 +9,7 @@ import argparse
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import MinkowskiEngine as ME
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
@@ -43,6 +44,7 @@ sys.path.append(os.path.join(ROOT_DIR, 'pointnet2'))
 from models.GSNet import GraspNet
 from models.GSNet_loss import get_loss
 from dataset.graspnet_dataset import GraspNetDataset, collate_fn, minkowski_collate_fn, load_grasp_labels
+from utils.augment_utils import batch_augmentation_matrices, batch_augment_data
 
 
 parser = argparse.ArgumentParser()
@@ -62,6 +64,11 @@ parser.add_argument('--voxel_size', type=float, default=0.005, help='Voxel Size
 # parser.add_argument('--bn_decay_rate', type=float, default=0.5, help='Decay rate for BN decay [default: 0.5]')
 parser.add_argument('--lr_decay_steps', default='8,12,16', help='When to decay the learning rate (in epochs) [default: 8,12,16]')
 parser.add_argument('--lr_decay_rates', default='0.1,0.1,0.1', help='Decay rates for lr decay [default: 0.1,0.1,0.1]')
+parser.add_argument('--batch_augment', action='store_true', default=False, help='Augment collated batches on the training device instead of in the dataloader workers [default: False]')
+parser.add_argument('--aug_seed', type=int, default=0, help='Seed of the on-device augmentation generator [default: 0]')
+parser.add_argument('--scene_graspness', action='store_true', default=False, help='Read graspness from the consolidated float16 per-scene files of generate_graspness.py --consolidate [default: False]')
+parser.add_argument('--scene_normals', action='store_true', default=False, help='Read normals from the consolidated float16 per-scene files of generate_normals.py --consolidate [default: False]')
+parser.add_argument('--pack_labels', action='store_true', default=False, help='Collate object labels as packed tensors with offsets instead of per-object lists [default: False]')
 cfgs = parser.parse_args()
 
 # ------------------------------------------------------------------------- GLOBAL CONFIG BEG
@@ -90,19 +97,22 @@ def my_worker_init_fn(worker_id):
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 torch.cuda.set_device(device)
+aug_generator = torch.Generator(device=device)
+aug_generator.manual_seed(cfgs.aug_seed)
 
 # Create Dataset and Dataloader
 valid_obj_idxs, grasp_labels = load_grasp_labels(cfgs.dataset_root)
-TRAIN_DATASET = GraspNetDataset(cfgs.dataset_root, valid_obj_idxs, grasp_labels, camera=cfgs.camera, split='train', num_points=cfgs.num_point, voxel_size=cfgs.voxel_size, remove_outlier=True, augment=True)
-TEST_DATASET = GraspNetDataset(cfgs.dataset_root, valid_obj_idxs, grasp_labels, camera=cfgs.camera, split='test_seen', num_points=cfgs.num_point, voxel_size=cfgs.voxel_size, remove_outlier=True, augment=False)
+TRAIN_DATASET = GraspNetDataset(cfgs.dataset_root, valid_obj_idxs, grasp_labels, camera=cfgs.camera, split='train', num_points=cfgs.num_point, voxel_size=cfgs.voxel_size, remove_outlier=True, augment=not cfgs.batch_augment, pack_labels=cfgs.pack_labels, scene_graspness=cfgs.scene_graspness, scene_normals=cfgs.scene_normals)
+TEST_DATASET = GraspNetDataset(cfgs.dataset_root, valid_obj_idxs, grasp_labels, camera=cfgs.camera, split='test_seen', num_points=cfgs.num_point, voxel_size=cfgs.voxel_size, remove_outlier=True, augment=False, pack_labels=cfgs.pack_labels, scene_graspness=cfgs.scene_graspness, scene_normals=cfgs.scene_normals)
 
 print(len(TRAIN_DATASET), len(TEST_DATASET))
 # TRAIN_DATALOADER = DataLoader(TRAIN_DATASET, batch_size=cfgs.batch_size, shuffle=True,
 #     num_workers=4, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn)
 # TEST_DATALOADER = DataLoader(TEST_DATASET, batch_size=cfgs.batch_size, shuffle=False,
 #     num_workers=4, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn)
+# with batch augmentation the clouds are rotated after collation, quantization is done on device
 TRAIN_DATALOADER = DataLoader(TRAIN_DATASET, batch_size=cfgs.batch_size, shuffle=True,
-    num_workers=8, worker_init_fn=my_worker_init_fn, collate_fn=minkowski_collate_fn)
+    num_workers=8, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn if cfgs.batch_augment else minkowski_collate_fn)
 TEST_DATALOADER = DataLoader(TEST_DATASET, batch_size=cfgs.batch_size, shuffle=False,
     num_workers=8, worker_init_fn=my_worker_init_fn, collate_fn=minkowski_collate_fn)
 print(len(TRAIN_DATALOADER), len(TEST_DATALOADER))
@@ -136,6 +146,18 @@ def adjust_learning_rate(optimizer, epoch):
         param_group['lr'] = lr
 
 
+def minkowski_quantize(batch_data_label):
+    """ Same outputs as minkowski_collate_fn, computed from dense on-device coors. """
+    coordinates_batch, features_batch = ME.utils.sparse_collate([c for c in batch_data_label['coors']],
+                                                                [f for f in batch_data_label['feats']], dtype=torch.float32)
+    coordinates_batch, features_batch, _, quantize2original = ME.utils.sparse_quantize(
+        coordinates_batch, features_batch, return_index=True, return_inverse=True, device=device)
+    batch_data_label['coors'] = coordinates_batch
+    batch_data_label['feats'] = features_batch
+    batch_data_label['quantize2original'] = quantize2original
+    return batch_data_label
+
+
 def train_one_epoch():
     stat_dict = {}  # collect statistics
     adjust_learning_rate(optimizer, EPOCH_CNT)
@@ -149,6 +171,10 @@ def train_one_epoch():
                         batch_data_label[key][i][j] = batch_data_label[key][i][j].to(device)
             else:
                 batch_data_label[key] = batch_data_label[key].to(device)
+        if cfgs.batch_augment:
+            aug_mats = batch_augmentation_matrices(batch_data_label['point_clouds'].size(0), aug_generator, device)
+            batch_data_label = batch_augment_data(batch_data_label, aug_mats, voxel_size=cfgs.voxel_size)
+            batch_data_label = minkowski_quantize(batch_data_label)
 
         end_points = net(batch_data_label)
         loss, end_points = get_loss(end_points)
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import time
 # os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:512"
 # os.environ['OMP_NUM_THREADS'] = '18'
@@ -63,7 +64,13 @@ setup_seed(0)
 # from models.IGNet_loss_v0_7 import get_loss
 from models.IGNet_v0_8 import IGNet
 from models.IGNet_loss_v0_8 import get_loss
-from dataset.ignet_multi_dataset import GraspNetDataset, minkowski_collate_fn, collate_fn, load_grasp_labels
+from dataset.ignet_multi_dataset import GraspNetDataset, minkowski_collate_fn, collate_fn, load_grasp_labels, \
+                                        unpack_compact_batch, batch_nbytes
+from dataset.scene_sampler import SceneAffinitySampler
+from dataset.data_echoing import DataEchoing
+from dataset.point_curriculum import PointBudgetCurriculum
+from utils.augment_utils import batch_augmentation_matrices, batch_augment_data, batch_subsample_points, \
+                                batch_subsample_grasp_points
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset_root', default='/media/gpuadmin/rcao/dataset/graspnet', help='Dataset root')
@@ -89,6 +96,25 @@ parser.add_argument('--weight_decay', type=float, default=0.001, help='Optimizat
 parser.add_argument('--inst_denoise', default=False, action='store_true', help='Denoise instance points during training and testing [default: False]')
 parser.add_argument('--pin_memory', action='store_true', help='Set pin_memory for faster training [default: False]')
 parser.add_argument('--multi_scale_grouping', action='store_true', help='Multi-scale grouping [default: False]')
+parser.add_argument('--batch_augment', action='store_true', help='Augment collated batches on the training device [default: False]')
+parser.add_argument('--packed_index', action='store_true', help='Store dataset paths in packed numpy buffers to avoid copy-on-write growth in workers [default: False]')
+parser.add_argument('--persistent_workers', action='store_true', help='Keep dataloader workers alive across epochs [default: False]')
+parser.add_argument('--compact_transfer', action='store_true', help='Send float16 clouds and uint8 images without coors/feats, unpacked on device [default: False]')
+parser.add_argument('--fps_grasp_order', action='store_true', help='Take grasp points from precomputed farthest point orderings (dataset/generate_fps_order.py) [default: False]')
+parser.add_argument('--loop_labels', action='store_true', help='Assign grasp labels sample by sample instead of batched (reference path) [default: False]')
+parser.add_argument('--label_align_lut', action='store_true', help='Look up the grasp label alignment in label_align_lut/ (dataset/generate_alignment_lut.py) [default: False]')
+parser.add_argument('--worker_labels', action='store_true', help='Compute label assignment indices in the DataLoader workers (dataset/label_assignment.py) [default: False]')
+parser.add_argument('--sparse_labels', action='store_true', help='Transport positive grasp labels as sparse COO entries, densified on device [default: False]')
+parser.add_argument('--scene_window', type=int, default=0, help='Shuffle training samples within windows of this many scenes, 0 for a global shuffle [default: 0]')
+parser.add_argument('--echo_factor', type=int, default=1, help='Emit every loaded batch this many times with fresh augmentation [default: 1]')
+parser.add_argument('--echo_buffer_size', type=int, default=8, help='Shuffle buffer size of echoed batches [default: 8]')
+parser.add_argument('--echo_oversample', type=float, default=1.0, help='Load num_point times this ratio points so every echo draws a fresh point subset [default: 1.0]')
+parser.add_argument('--echo_grasp_num', type=int, default=0, help='Draw this many of the loaded grasp points for every step, 0 keeps all [default: 0]')
+parser.add_argument('--target_loss', type=float, default=None, help='Log wall-clock time when the mean training loss first reaches this value [default: None]')
+parser.add_argument('--grasp_point_num', type=int, default=350, help='Grasp points sampled per instance [default: 350]')
+parser.add_argument('--curriculum', type=str, default='', help='Point budget schedule as start_epoch:ratio stages, e.g. 0:0.25,4:0.5,8:1.0, scaling num_point, grasp_point_num and inversely the batch size [default: full budget]')
+parser.add_argument('--curriculum_max_batch_size', type=int, default=0, help='Upper bound of the curriculum batch size, 0 for no bound [default: 0]')
+parser.add_argument('--aug_seed', type=int, default=0, help='Seed of the on-device augmentation generator [default: 0]')
 # parser.add_argument('--bn_decay_step', type=int, default=2, help='Period of BN decay (in epochs) [default: 2]')
 # parser.add_argument('--bn_decay_rate', type=float, default=0.5, help='Decay rate for BN decay [default: 0.5]')
 # parser.add_argument('--lr_decay_steps', default='8,12,16', help='When to decay the learning rate (in epochs) [default: 8,12,16]')
@@ -102,6 +128,8 @@ os.makedirs(cfgs.ckpt_dir, exist_ok=True)
 os.makedirs(cfgs.log_dir, exist_ok=True)
 
 EPOCH_CNT = 0
+TRAIN_START_TIME = time.time()
+TARGET_LOSS_REACHED = False
 DEFAULT_CHECKPOINT_PATH = os.path.join(cfgs.ckpt_dir, 'checkpoint.tar')
 CHECKPOINT_PATH = cfgs.resume_checkpoint if cfgs.resume_checkpoint is not None \
     else DEFAULT_CHECKPOINT_PATH
@@ -120,13 +148,19 @@ def my_worker_init_fn(worker_id):
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 torch.cuda.set_device(device)
+aug_generator = torch.Generator(device=device)
+aug_generator.manual_seed(cfgs.aug_seed)
 
 # Create Dataset and Dataloader
 valid_obj_idxs, grasp_labels = load_grasp_labels(cfgs.dataset_root)
 TRAIN_DATASET = GraspNetDataset(cfgs.dataset_root, valid_obj_idxs, grasp_labels, camera=cfgs.camera, split='train', 
-                                num_points=cfgs.num_point, remove_outlier=False, augment=False, denoise=cfgs.inst_denoise, real_data=True, syn_data=True, visib_threshold=cfgs.visib_threshold, voxel_size=cfgs.voxel_size)
+                                num_points=int(cfgs.num_point * cfgs.echo_oversample), grasp_num=cfgs.grasp_point_num, remove_outlier=False, augment=False, denoise=cfgs.inst_denoise, real_data=True, syn_data=True, visib_threshold=cfgs.visib_threshold, voxel_size=cfgs.voxel_size, compact_transfer=cfgs.compact_transfer,
+                                packed_index=cfgs.packed_index, sparse_labels=cfgs.sparse_labels, fps_grasp_order=cfgs.fps_grasp_order,
+                                label_align_lut=cfgs.label_align_lut, worker_labels=cfgs.worker_labels)
 TEST_DATASET = GraspNetDataset(cfgs.dataset_root, valid_obj_idxs, grasp_labels, camera=cfgs.camera, split='test_seen', 
-                               num_points=cfgs.num_point, remove_outlier=False, augment=False, denoise=cfgs.inst_denoise, real_data=True, syn_data=False, visib_threshold=cfgs.visib_threshold, voxel_size=cfgs.voxel_size)
+                               num_points=cfgs.num_point, grasp_num=cfgs.grasp_point_num, remove_outlier=False, augment=False, denoise=cfgs.inst_denoise, real_data=True, syn_data=False, visib_threshold=cfgs.visib_threshold, voxel_size=cfgs.voxel_size, compact_transfer=cfgs.compact_transfer,
+                               packed_index=cfgs.packed_index, sparse_labels=cfgs.sparse_labels, fps_grasp_order=cfgs.fps_grasp_order,
+                               label_align_lut=cfgs.label_align_lut, worker_labels=cfgs.worker_labels)
 
 print(len(TRAIN_DATASET), len(TEST_DATASET))
 # TRAIN_DATALOADER = DataLoader(TRAIN_DATASET, batch_size=cfgs.batch_size, shuffle=True,
@@ -134,10 +168,26 @@ print(len(TRAIN_DATASET), len(TEST_DATASET))
 # TEST_DATALOADER = DataLoader(TEST_DATASET, batch_size=cfgs.batch_size, shuffle=False,
 #     num_workers=cfgs.worker_num, worker_init_fn=my_worker_init_fn, collate_fn=minkowski_collate_fn)
 
-TRAIN_DATALOADER = DataLoader(TRAIN_DATASET, batch_size=cfgs.batch_size, shuffle=True,
-    num_workers=cfgs.worker_num, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn, pin_memory=cfgs.pin_memory)
+TRAIN_SAMPLER = SceneAffinitySampler(TRAIN_DATASET.scene_list(), window_size=cfgs.scene_window) if cfgs.scene_window > 0 else None
+CURRICULUM = PointBudgetCurriculum(cfgs.curriculum, cfgs.num_point, cfgs.grasp_point_num, cfgs.batch_size,
+                                   max_batch_size=cfgs.curriculum_max_batch_size)
+
+
+def build_train_dataloader(budget):
+    """ Point/grasp budget and batch size of the training pipeline for a curriculum stage. """
+    TRAIN_DATASET.set_point_budget(int(budget['num_points'] * cfgs.echo_oversample), budget['grasp_num'])
+    dataloader = DataLoader(TRAIN_DATASET, batch_size=budget['batch_size'], shuffle=TRAIN_SAMPLER is None, sampler=TRAIN_SAMPLER,
+        num_workers=cfgs.worker_num, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn, pin_memory=cfgs.pin_memory,
+        persistent_workers=cfgs.persistent_workers and cfgs.worker_num > 0)
+    echo = DataEchoing(dataloader, echo_factor=cfgs.echo_factor, buffer_size=cfgs.echo_buffer_size, seed=cfgs.aug_seed)
+    return dataloader, echo
+
+
+CURRENT_BUDGET = CURRICULUM.budget(0)
+TRAIN_DATALOADER, TRAIN_ECHO = build_train_dataloader(CURRENT_BUDGET)
 TEST_DATALOADER = DataLoader(TEST_DATASET, batch_size=cfgs.batch_size, shuffle=False,
-    num_workers=cfgs.worker_num, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn, pin_memory=cfgs.pin_memory)
+    num_workers=cfgs.worker_num, worker_init_fn=my_worker_init_fn, collate_fn=collate_fn, pin_memory=cfgs.pin_memory,
+    persistent_workers=cfgs.persistent_workers and cfgs.worker_num > 0)
 
 print(len(TRAIN_DATALOADER), len(TEST_DATALOADER))
 
@@ -148,7 +198,8 @@ print(len(TRAIN_DATALOADER), len(TEST_DATALOADER))
 # net = IGNet(num_view=cfgs.num_view, seed_feat_dim=cfgs.seed_feat_dim, is_training=True)
 # net.to(device)
 net = IGNet(num_view=cfgs.num_view, seed_feat_dim=cfgs.seed_feat_dim, img_feat_dim=cfgs.img_feat_dim, 
-            is_training=True, multi_scale_grouping=cfgs.multi_scale_grouping)
+            is_training=True, multi_scale_grouping=cfgs.multi_scale_grouping,
+            batched_labels=not cfgs.loop_labels)
 net.to(device)
 
 # Load the Adam optimizer
@@ -199,10 +250,14 @@ def train_one_epoch():
     # adjust_learning_rate(optimizer, EPOCH_CNT)
     # bnm_scheduler.step() # decay BN momentum
     # set model to training mode
+    global TARGET_LOSS_REACHED
     net.train()
     overall_loss = 0
+    epoch_tic = time.time()
     
-    for batch_idx, batch_data_label in enumerate(TRAIN_DATALOADER):
+    for batch_idx, (batch_data_label, echo_idx) in enumerate(TRAIN_ECHO):
+        if batch_idx == 0:
+            log_string('batch transfer size: %.2f MB' % (batch_nbytes(batch_data_label) / 1024 ** 2))
         for key in batch_data_label:
             if 'list' in key:
                 for i in range(len(batch_data_label[key])):
@@ -210,6 +265,15 @@ def train_one_epoch():
                         batch_data_label[key][i][j] = batch_data_label[key][i][j].cuda(non_blocking=cfgs.pin_memory)
             else:
                 batch_data_label[key] = batch_data_label[key].cuda(non_blocking=cfgs.pin_memory)
+        batch_data_label = unpack_compact_batch(batch_data_label, cfgs.voxel_size)
+        # echoed batches get a fresh point/grasp subset and augmentation
+        if TRAIN_DATASET.num_points > CURRENT_BUDGET['num_points']:
+            batch_data_label = batch_subsample_points(batch_data_label, CURRENT_BUDGET['num_points'], aug_generator)
+        if 0 < cfgs.echo_grasp_num < CURRENT_BUDGET['grasp_num']:
+            batch_data_label = batch_subsample_grasp_points(batch_data_label, cfgs.echo_grasp_num, aug_generator)
+        if cfgs.batch_augment or echo_idx > 0:
+            aug_mats = batch_augmentation_matrices(batch_data_label['point_clouds'].size(0), aug_generator, device)
+            batch_data_label = batch_augment_data(batch_data_label, aug_mats, voxel_size=cfgs.voxel_size)
         # Forward pass
         end_points = net(batch_data_label)
         
@@ -230,12 +294,19 @@ def train_one_epoch():
         batch_interval = 10
         if (batch_idx+1) % batch_interval == 0:
             log_string(' ---- batch: %03d ----' % (batch_idx+1))
+            if cfgs.target_loss is not None and not TARGET_LOSS_REACHED \
+                    and stat_dict['loss/overall_loss']/batch_interval <= cfgs.target_loss:
+                TARGET_LOSS_REACHED = True
+                log_string('reached target loss %f after %.1fs, %d loaded batches, %d steps' % (cfgs.target_loss,
+                           time.time() - TRAIN_START_TIME, TRAIN_ECHO.num_loaded, TRAIN_ECHO.num_emitted))
             for key in sorted(stat_dict.keys()):
-                log_writer.add_scalar('train_' + key, stat_dict[key]/batch_interval, (EPOCH_CNT*len(TRAIN_DATALOADER)+batch_idx)*cfgs.batch_size)
+                log_writer.add_scalar('train_' + key, stat_dict[key]/batch_interval, (EPOCH_CNT*len(TRAIN_ECHO)+batch_idx)*CURRENT_BUDGET['batch_size'])
                 log_string('mean %s: %f'%(key, stat_dict[key]/batch_interval))
                 stat_dict[key] = 0
         
     log_string('overall loss:{}, batch num:{}'.format(overall_loss, batch_idx+1))
+    log_string('effective echo factor: {:.2f}, epoch time: {:.1f}s'.format(TRAIN_ECHO.effective_echo_factor(),
+                                                                          time.time() - epoch_tic))
     mean_loss = overall_loss/float(batch_idx+1)
     return mean_loss
 
@@ -254,6 +325,7 @@ def evaluate_one_epoch():
                         batch_data_label[key][i][j] = batch_data_label[key][i][j].cuda(non_blocking=cfgs.pin_memory)
             else:
                 batch_data_label[key] = batch_data_label[key].cuda(non_blocking=cfgs.pin_memory)
+        batch_data_label = unpack_compact_batch(batch_data_label, cfgs.voxel_size)
         # Forward pass
         with torch.no_grad():
             end_points = net(batch_data_label)
@@ -270,7 +342,7 @@ def evaluate_one_epoch():
         overall_loss += stat_dict['loss/overall_loss']
         
     for key in sorted(stat_dict.keys()):
-        log_writer.add_scalar('test_' + key, stat_dict[key]/float(batch_idx+1), (EPOCH_CNT+1)*len(TRAIN_DATALOADER)*cfgs.batch_size)
+        log_writer.add_scalar('test_' + key, stat_dict[key]/float(batch_idx+1), (EPOCH_CNT+1)*len(TRAIN_DATALOADER)*CURRENT_BUDGET['batch_size'])
         log_string('eval mean %s: %f'%(key, stat_dict[key]/(float(batch_idx+1))))
 
     log_string('overall loss:{}, batch num:{}'.format(overall_loss, batch_idx+1))
@@ -279,13 +351,22 @@ def evaluate_one_epoch():
 
 
 def train(start_epoch):
-    global EPOCH_CNT 
+    global EPOCH_CNT, CURRENT_BUDGET, TRAIN_DATALOADER, TRAIN_ECHO
     min_loss = np.inf
     loss = 0
     best_epoch = 0
+    stage_tic = time.time()
     for epoch in range(start_epoch, cfgs.max_epoch):
         EPOCH_CNT = epoch
         log_string('**** EPOCH %03d ****' % (epoch))
+        budget = CURRICULUM.budget(epoch)
+        if budget != CURRENT_BUDGET:
+            # drop the old workers before forking new ones with the new budget
+            del TRAIN_DATALOADER, TRAIN_ECHO
+            CURRENT_BUDGET = budget
+            TRAIN_DATALOADER, TRAIN_ECHO = build_train_dataloader(CURRENT_BUDGET)
+        log_string('Curriculum stage %d: %d points, %d grasp points, batch size %d' % (CURRENT_BUDGET['stage'],
+                   CURRENT_BUDGET['num_points'], CURRENT_BUDGET['grasp_num'], CURRENT_BUDGET['batch_size']))
         current_lr = optimizer.param_groups[0]['lr']
         log_string('Current learning rate: %f' % (current_lr))
         # log_string('Current BN decay momentum: %f'%(bnm_scheduler.lmbd(bnm_scheduler.last_epoch)))
@@ -293,10 +374,17 @@ def train(start_epoch):
         # Reset numpy seed.
         # REF: https://github.com/pytorch/pytorch/issues/5059
         np.random.seed()
+        if TRAIN_SAMPLER is not None:
+            TRAIN_SAMPLER.set_epoch(epoch)
         train_loss = train_one_epoch()
         log_writer.add_scalar('training/learning_rate', current_lr, epoch)
+        log_writer.add_scalar('training/num_points', CURRENT_BUDGET['num_points'], epoch)
         
         eval_loss = evaluate_one_epoch()
+        if CURRICULUM.is_stage_end(epoch) or epoch == cfgs.max_epoch - 1:
+            log_string('Curriculum stage %d done at epoch %d: eval loss %f, stage time %.1fs, total time %.1fs' % (
+                       CURRENT_BUDGET['stage'], epoch, eval_loss, time.time() - stage_tic, time.time() - TRAIN_START_TIME))
+            stage_tic = time.time()
         # Save checkpoint
         save_dict = {'epoch': epoch+1, # after training one epoch, the start_epoch should be epoch+1
                     'optimizer_state_dict': optimizer.state_dict()}
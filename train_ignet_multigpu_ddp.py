@@ -59,6 +59,7 @@ from IGNet_loss import get_loss
 # from pytorch_utils import BNMomentumScheduler
 # from graspnet_dataset import GraspNetDataset, collate_fn, minkowski_collate_fn, load_grasp_labels
 from ignet_dataset import GraspNetDataset, collate_fn, minkowski_collate_fn, load_grasp_labels
+from scene_sampler import SceneAffinitySampler
 from label_generation import process_grasp_labels
 
 
@@ -74,6 +75,7 @@ parser.add_argument('--max_epoch', type=int, default=61, help='Epoch to run [def
 parser.add_argument('--batch_size', type=int, default=18, help='Batch Size during training [default: 2]')
 parser.add_argument('--worker_num', type=int, default=3, help='Worker number for dataloader [default: 4]')
 parser.add_argument('--learning_rate', type=float, default=0.001, help='Initial learning rate [default: 0.001]')
+parser.add_argument('--scene_window', type=int, default=0, help='Give each rank disjoint scenes and shuffle within windows of this many scenes, 0 for DistributedSampler [default: 0]')
 # parser.add_argument('--weight_decay', type=float, default=0, help='Optimization L2 weight decay [default: 0]')
 # parser.add_argument('--bn_decay_step', type=int, default=2, help='Period of BN decay (in epochs) [default: 2]')
 # parser.add_argument('--bn_decay_rate', type=float, default=0.5, help='Decay rate for BN decay [default: 0.5]')
@@ -211,7 +213,10 @@ def main_worker(gpu, ngpus_per_node, args):
                                 syn_data=False)
 
     log_string("{}, {}".format(len(train_dataset), len(test_dataset)))
-    train_sampler = DistributedSampler(train_dataset)
+    if cfgs.scene_window > 0:
+        train_sampler = SceneAffinitySampler(train_dataset.scene_list(), window_size=cfgs.scene_window)
+    else:
+        train_sampler = DistributedSampler(train_dataset)
     test_sampler = DistributedSampler(test_dataset, shuffle=False)
 
     # real batch_size = batch_size * world_size
@@ -258,6 +263,7 @@ def main_worker(gpu, ngpus_per_node, args):
         # # REF: https://github.com/pytorch/pytorch/issues/5059
         # np.random.seed()
 
+        train_sampler.set_epoch(epoch)
         train_one_epoch()
         lr_scheduler.step()
         
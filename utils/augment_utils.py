@@ -0,0 +1,132 @@
+""" Batched data augmentation and resampling on the training device.
+    Replaces the per-sample numpy augment_data() of the datasets, it runs after collation
+    and transfer, so the workers only load and sample data.
+"""
+
+import numpy as np
+import torch
+
+from utils.loss_utils import NUM_VIEW, NUM_ANGLE, NUM_DEPTH
+
+
+def batch_augmentation_matrices(batch_size, generator, device, flip=True, max_rot_angle=np.pi/6):
+    """ Draw one random augmentation rotation per sample, same distribution as augment_data():
+        a flip along the YZ plane with probability 0.5, followed by a rotation around the X axis
+        in [-max_rot_angle, max_rot_angle].
+
+        Input:
+            batch_size: [int]
+            generator: [torch.Generator]
+                seeded generator living on device
+            device: [torch.device]
+
+        Output:
+            aug_mats: [torch.FloatTensor, (B,3,3)]
+    """
+    aug_mats = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+    if flip:
+        flip_mask = torch.rand(batch_size, generator=generator, device=device) > 0.5
+        aug_mats[flip_mask, 0, 0] = -1
+
+    rot_angle = (torch.rand(batch_size, generator=generator, device=device) * 2 - 1) * max_rot_angle
+    c, s = torch.cos(rot_angle), torch.sin(rot_angle)
+    ones = torch.ones_like(c)
+    zeros = torch.zeros_like(c)
+    rot_mats = torch.stack([ones, zeros, zeros,
+                            zeros, c, -s,
+                            zeros, s, c], dim=-1).view(batch_size, 3, 3)
+    aug_mats = torch.bmm(rot_mats, aug_mats)
+    return aug_mats
+
+
+def batch_augment_data(end_points, aug_mats, voxel_size=None):
+    """ Apply per-sample augmentation rotations to a collated batch in place.
+
+        Input:
+            end_points: [dict]
+                clouds ('point_clouds', 'cloud_normals') of shape (B,N,3) are rotated, object poses
+                are left-multiplied: 'object_pose' (B,3,4), 'packed_object_poses' (No,3,4) with
+                'packed_object_offsets', or 'object_poses_list'. Grasp points stay in object frame,
+                'grasp_label_align' is dropped.
+            aug_mats: [torch.FloatTensor, (B,3,3)]
+            voxel_size: [float]
+                if given, dense 'coors' (B,N,3) are recomputed from the rotated clouds
+
+        Output:
+            end_points: [dict]
+    """
+    for key in ['point_clouds', 'cloud_normals']:
+        if key in end_points:
+            end_points[key] = torch.bmm(end_points[key], aug_mats.transpose(1, 2))
+
+    if 'object_pose' in end_points:
+        end_points['object_pose'] = torch.bmm(aug_mats, end_points['object_pose'])
+    if 'packed_object_poses' in end_points:
+        object_offsets = end_points['packed_object_offsets']
+        object_batch_ids = torch.repeat_interleave(torch.arange(aug_mats.size(0), device=aug_mats.device),
+                                                   object_offsets[1:] - object_offsets[:-1])
+        end_points['packed_object_poses'] = torch.matmul(aug_mats[object_batch_ids], end_points['packed_object_poses'])
+    if 'object_poses_list' in end_points:
+        for i, poses in enumerate(end_points['object_poses_list']):
+            end_points['object_poses_list'][i] = [torch.matmul(aug_mats[i], pose) for pose in poses]
+
+    # the label alignment of the dataset table belongs to the un-augmented pose
+    end_points.pop('grasp_label_align', None)
+
+    if voxel_size is not None and 'coors' in end_points and end_points['coors'].dim() == 3:
+        end_points['coors'] = end_points['point_clouds'] / voxel_size
+    return end_points
+
+
+POINT_KEYS = ['point_clouds', 'cloud_colors', 'cloud_normals', 'coors', 'feats', 'img_idxs', 'grasp_nn_inds']
+
+
+def batch_subsample_points(end_points, num_points, generator):
+    """ Draw a fresh random subset of num_points points per sample, all per-point
+        entries (POINT_KEYS, shape (B,N,...)) are indexed jointly.
+    """
+    batch_size, point_num, _ = end_points['point_clouds'].size()
+    device = end_points['point_clouds'].device
+    idxs = torch.rand((batch_size, point_num), generator=generator, device=device).argsort(dim=1)[:, :num_points]
+    batch_idxs = torch.arange(batch_size, device=device).unsqueeze(-1)
+    for key in POINT_KEYS:
+        if key in end_points and end_points[key].dim() >= 2 and end_points[key].size(1) == point_num:
+            end_points[key] = end_points[key][batch_idxs, idxs]
+    return end_points
+
+
+def batch_subsample_grasp_points(end_points, num_grasp_points, generator):
+    """ Keep a fresh random subset of num_grasp_points grasp points per sample, for dense
+        labels ('grasp_labels'/'grasp_offsets', (B,Np,V,A,D)) and sparse labels
+        ('grasp_label_inds' flat over (Np,V,A,D) with 'grasp_label_offsets').
+    """
+    grasp_points = end_points['grasp_points']  # (B, Np, 3)
+    batch_size, grasp_point_num, _ = grasp_points.size()
+    device = grasp_points.device
+    idxs = torch.rand((batch_size, grasp_point_num), generator=generator, device=device).argsort(dim=1)
+    idxs = idxs[:, :num_grasp_points].sort(dim=1)[0]
+    batch_idxs = torch.arange(batch_size, device=device).unsqueeze(-1)
+    end_points['grasp_points'] = grasp_points[batch_idxs, idxs]
+    for key in ['grasp_labels', 'grasp_offsets', 'grasp_point_graspness_count']:
+        if key in end_points:
+            end_points[key] = end_points[key][batch_idxs, idxs]
+    # nearest grasp points of the seeds refer to the full set, the step searches the subset again
+    end_points.pop('grasp_nn_inds', None)
+
+    if 'grasp_label_inds' in end_points:
+        label_size = NUM_VIEW * NUM_ANGLE * NUM_DEPTH
+        # old grasp point index -> new index, -1 for dropped points
+        new_point_idxs = torch.full((batch_size, grasp_point_num), -1, dtype=torch.int64, device=device)
+        new_point_idxs[batch_idxs, idxs] = torch.arange(num_grasp_points, device=device).unsqueeze(0)
+        label_offsets = end_points['grasp_label_offsets']
+        label_batch_idxs = torch.repeat_interleave(torch.arange(batch_size, device=device),
+                                                   label_offsets[1:] - label_offsets[:-1])
+        label_inds = end_points['grasp_label_inds'].long()
+        label_point_idxs = new_point_idxs[label_batch_idxs, label_inds // label_size]
+        keep_mask = label_point_idxs >= 0
+        end_points['grasp_label_inds'] = (label_point_idxs * label_size + label_inds % label_size)[keep_mask].int()
+        end_points['grasp_label_scores'] = end_points['grasp_label_scores'][keep_mask]
+        end_points['grasp_label_widths'] = end_points['grasp_label_widths'][keep_mask]
+        label_nums = torch.bincount(label_batch_idxs[keep_mask], minlength=batch_size)
+        end_points['grasp_label_offsets'] = torch.cat([label_nums.new_zeros(1), torch.cumsum(label_nums, 0)])
+    return end_points
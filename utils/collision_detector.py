@@ -127,3 +127,181 @@ class ModelFreeCollisionDetector():
             shifting_iou = shifting_mask.sum(axis=1) / (shifting_volume+1e-6)
             ret_value.append([global_iou, left_iou, right_iou, bottom_iou, shifting_iou])
         return ret_value
+
+
+class VoxelCollisionDetector():
+    """ Collision detection of many grasps against a voxelized scene, used to generate collision labels.
+        The gripper regions of ModelFreeCollisionDetector (fingers, bottom and shifting space) are
+        represented by sample points on a voxel_size lattice, so checking a grasp costs a fixed number
+        of occupancy lookups instead of a pass over all scene points. With collision_thresh=0 grasps
+        are first checked on a coarse lattice: a grasp whose coarse samples are all far enough from
+        occupied voxels (distance transform) is free, since no fine sample can then lie in an occupied
+        voxel; all other grasps are checked on the fine lattice, so the result equals the fine check.
+
+        Input:
+                scene_points: [numpy.ndarray, (N,3), numpy.float32]
+                    the scene points (object models in the scene frame) to voxelize
+                voxel_size: [float]
+                    occupancy grid resolution and gripper sample spacing
+                table_trans: [numpy.ndarray, (4,4), numpy.float32]
+                    transformation from the scene frame to the table frame, where the table top is
+                    the plane z=0 and objects lie at z>0, default: None (no table)
+                max_width: [float]
+                    grasps wider than max_width are marked as collision
+                finger_width, finger_length, height, approach_dist: [float]
+                    gripper geometry, approach_dist is the shifting space as in ModelFreeCollisionDetector
+                coarse_factor: [int]
+                    coarse lattice spacing in voxels
+
+        Example usage:
+            vcdetector = VoxelCollisionDetector(scene_points, voxel_size=0.005, table_trans=align_mat)
+            collision_mask = vcdetector.detect(centers, rotations, depths, widths, collision_thresh=0.0)
+    """
+    def __init__(self, scene_points, voxel_size=0.005, table_trans=None, max_width=0.1,
+                 finger_width=0.01, finger_length=0.06, height=0.02, approach_dist=0.05, coarse_factor=3):
+        from scipy.ndimage import distance_transform_edt
+        self.voxel_size = voxel_size
+        self.max_width = max_width
+        self.finger_width = finger_width
+        self.finger_length = finger_length
+        self.height = height
+        self.approach_dist = max(approach_dist, finger_width)
+        self.table_trans = None if table_trans is None else np.asarray(table_trans, dtype=np.float32)
+        self.template, _ = self._gripper_template(voxel_size)
+        self.coarse_template, coarse_radius = self._gripper_template(voxel_size * coarse_factor)
+        self.coarse_radius = coarse_radius + voxel_size * np.sqrt(3)
+
+        # the grid margin keeps coarse samples outside the grid farther than coarse_radius from occupied voxels
+        margin = int(np.ceil(self.coarse_radius / voxel_size)) + 1
+        scene_points = np.asarray(scene_points, dtype=np.float64)
+        self.origin = scene_points.min(axis=0) - margin * voxel_size
+        voxel_inds = np.floor((scene_points - self.origin) / voxel_size).astype(np.int64)
+        self.grid_shape = voxel_inds.max(axis=0) + margin + 1
+        occupancy = np.zeros(self.grid_shape, dtype=bool)
+        occupancy[voxel_inds[:, 0], voxel_inds[:, 1], voxel_inds[:, 2]] = True
+        self.occupancy = occupancy.reshape(-1)
+        self.distance = (distance_transform_edt(~occupancy) * voxel_size).astype(np.float32).reshape(-1)
+
+    def _gripper_template(self, step):
+        """ Gripper sample points in the grasp frame, width-independent form.
+
+            Input:
+                step: [float]
+                    sample spacing
+
+            Output:
+                template: [numpy.ndarray, (4,S), numpy.float32]
+                    rows x0, y0, y1, z: a sample of a grasp with depth d and width w lies at
+                    (d + x0, y0 + y1 * w, z)
+                radius: [float]
+                    largest half diagonal of the lattice cell around a sample, at width max_width
+        """
+        def lattice(lo, hi):
+            n = max(int(np.ceil((hi - lo) / step - 1e-6)), 1)
+            return lo + (np.arange(n) + 0.5) * (hi - lo) / n, (hi - lo) / n / 2
+
+        fw, fl = self.finger_width, self.finger_length
+        zs, hz = lattice(-self.height / 2, self.height / 2)
+        # fingers: y = -(w/2 + t) and y = w/2 + t, t in (0, finger_width)
+        ts, ht = lattice(0, fw)
+        # bottom and shifting space: y = s * (w/2 + finger_width), s in (-1, 1)
+        half_span = self.max_width / 2 + fw
+        ss, hs = lattice(-half_span, half_span)
+        ss = ss / half_span
+        parts = [(lattice(-fl, 0), -ts, -0.5 * np.ones_like(ts), ht),
+                 (lattice(-fl, 0), ts, 0.5 * np.ones_like(ts), ht),
+                 (lattice(-fl - fw, -fl), ss * fw, ss / 2, hs),
+                 (lattice(-fl - fw - self.approach_dist, -fl - fw), ss * fw, ss / 2, hs)]
+        template, radius = [], 0
+        for (xs, hx), y0s, y1s, hy in parts:
+            x, y, z = np.meshgrid(xs, np.arange(len(y0s)), zs, indexing='ij')
+            x, y, z = x.reshape(-1), y.reshape(-1), z.reshape(-1)
+            template.append(np.stack([x, y0s[y], y1s[y], z]))
+            radius = max(radius, np.sqrt(hx ** 2 + hy ** 2 + hz ** 2))
+        return np.concatenate(template, axis=1).astype(np.float32), radius
+
+    def _locate(self, template, centers, rotations, depths, widths):
+        """ Grid indices and table heights of the samples of a batch of grasps.
+
+            Output:
+                flat_inds: [numpy.ndarray, (B,S), numpy.int64]
+                    flattened voxel index, 0 outside the grid
+                inside: [numpy.ndarray, (B,S), numpy.bool]
+                table_z: [numpy.ndarray, (B,S), numpy.float32]
+                    None without table
+        """
+        x0, y0, y1, z = template
+        xs = depths[:, np.newaxis].astype(np.float32) + x0
+        ys = y0 + widths[:, np.newaxis].astype(np.float32) * y1
+        R = rotations.astype(np.float32)
+        t = (centers - self.origin).astype(np.float32)
+        inside, flat_inds = None, None
+        for axis in range(3):
+            coord = t[:, axis:axis + 1] + xs * R[:, axis, 0:1] + ys * R[:, axis, 1:2] + z * R[:, axis, 2:3]
+            inds = np.floor(coord / self.voxel_size).astype(np.int64)
+            axis_inside = (inds >= 0) & (inds < self.grid_shape[axis])
+            inside = axis_inside if inside is None else (inside & axis_inside)
+            flat_inds = inds if flat_inds is None else (flat_inds * self.grid_shape[axis] + inds)
+        flat_inds[~inside] = 0
+
+        table_z = None
+        if self.table_trans is not None:
+            normal = self.table_trans[2, :3]
+            table_z = (centers.astype(np.float32) @ normal + self.table_trans[2, 3])[:, np.newaxis] \
+                      + xs * (R[:, :, 0] @ normal)[:, np.newaxis] + ys * (R[:, :, 1] @ normal)[:, np.newaxis] \
+                      + z * (R[:, :, 2] @ normal)[:, np.newaxis]
+        return flat_inds, inside, table_z
+
+    def _occupied_fraction(self, template, centers, rotations, depths, widths):
+        flat_inds, inside, table_z = self._locate(template, centers, rotations, depths, widths)
+        occupied = inside & self.occupancy[flat_inds]
+        if table_z is not None:
+            occupied |= (table_z < 0)
+        return occupied.mean(axis=1)
+
+    def detect(self, centers, rotations, depths, widths, collision_thresh=0.0, batch_size=2048, return_ious=False):
+        """ Detect collision of grasps.
+
+            Input:
+                centers: [numpy.ndarray, (M,3), numpy.float32]
+                    grasp centers in the scene frame
+                rotations: [numpy.ndarray, (M,3,3), numpy.float32]
+                    grasp rotations, columns are the approach, width and height directions
+                depths: [numpy.ndarray, (M,), numpy.float32]
+                widths: [numpy.ndarray, (M,), numpy.float32]
+                collision_thresh: [float]
+                    if the fraction of gripper samples in occupied voxels (or under the table) is
+                    greater than this threshold, a collision is detected
+                batch_size: [int]
+                    grasps checked together, bounds the memory of the sample points
+                return_ious: [bool]
+                    if True, also return the occupied fraction of every grasp (disables the coarse pass)
+
+            Output:
+                collision_mask: [numpy.ndarray, (M,), numpy.bool]
+                    True implies collision
+                [optional] iou_list: [numpy.ndarray, (M,), numpy.float32]
+        """
+        num_grasps = len(centers)
+        collision_mask = (widths > self.max_width)
+        ious = np.zeros(num_grasps, dtype=np.float32)
+        for start in range(0, num_grasps, batch_size):
+            inds = np.arange(start, min(start + batch_size, num_grasps))
+            if collision_thresh == 0 and not return_ious:
+                # a coarse sample in an occupied voxel does not imply a fine one, so coarse hits are
+                # rechecked on the fine lattice and only the free shortcut is taken
+                flat_inds, inside, table_z = self._locate(self.coarse_template, centers[inds], rotations[inds],
+                                                          depths[inds], widths[inds])
+                clearance = np.where(inside, self.distance[flat_inds], np.inf)
+                if table_z is not None:
+                    clearance = np.minimum(clearance, table_z + self.voxel_size * np.sqrt(3))
+                free = (clearance > self.coarse_radius).all(axis=1)
+                inds = inds[~free]
+                if len(inds) == 0:
+                    continue
+            ious[inds] = self._occupied_fraction(self.template, centers[inds], rotations[inds], depths[inds], widths[inds])
+            collision_mask[inds] |= (ious[inds] > collision_thresh)
+
+        if return_ious:
+            return collision_mask, ious
+        return collision_mask
@@ -2,6 +2,7 @@
     Author: chenxi-wang
 """
 
+import os
 import numpy as np
 import open3d as o3d
 
@@ -160,6 +161,90 @@ def sample_points(points_len, sample_num):
     return idxs
 
 
+def farthest_point_order(points, start_idx=None):
+    """ Farthest point ordering of a point set, every prefix of length K is a K-point FPS subset.
+
+        Input:
+            points: [np.ndarray, (N,3), np.float32]
+            start_idx: [int]
+                first point, default: the point farthest from the centroid
+
+        Output:
+            order: [np.ndarray, (N,), np.int32]
+                permutation of range(N)
+    """
+    points = points.astype(np.float64)
+    num_points = len(points)
+    if start_idx is None:
+        start_idx = int(np.argmax(np.sum((points - points.mean(axis=0)) ** 2, axis=1)))
+    order = np.empty(num_points, dtype=np.int32)
+    min_dists = np.full(num_points, np.inf)
+    idx = start_idx
+    for i in range(num_points):
+        order[i] = idx
+        np.minimum(min_dists, np.sum((points - points[idx]) ** 2, axis=1), out=min_dists)
+        # chosen points stay below every distance, duplicates of them are picked after the rest
+        min_dists[idx] = -1
+        idx = int(np.argmax(min_dists))
+    return order
+
+
+def save_atomic(path, array):
+    """ np.save through a temporary file, an interrupted job never leaves a truncated .npy behind. """
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def load_label_scores(label):
+    """ Friction scores of a simplified grasp label file as float32. Quantized files
+        (dataset/generate_simplified_label.py --quantize) store them as int8 tenths in scores_x10,
+        which decode to exactly the float32 scores, so thresholds such as score <= 0.6 are kept.
+    """
+    if 'scores_x10' in label.files:
+        return decode_quantized_scores(label['scores_x10'])
+    return label['scores'].astype(np.float32)
+
+
+def decode_quantized_scores(scores_x10):
+    return scores_x10.astype(np.float32) / np.float32(10)
+
+
+def get_scene_array_paths(root, name, scene, camera):
+    """ Consolidated per-scene frame labels (name is 'graspness' or 'normals'): float16 values of
+        all frames concatenated along the first axis and int64 frame offsets.
+    """
+    scene_dir = os.path.join(root, name, scene)
+    return os.path.join(scene_dir, '{}_{}.npy'.format(camera, name)), \
+           os.path.join(scene_dir, '{}_{}_offsets.npy'.format(camera, name))
+
+
+def consolidate_scene_frames(frame_paths, values_path, offsets_path):
+    """ Merge per-frame .npy files of a scene into the consolidated float16 values/offsets pair.
+        The offsets file is written last and marks a finished scene.
+    """
+    frames = [np.load(path).astype(np.float16) for path in frame_paths]
+    offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    np.cumsum([len(f) for f in frames], out=offsets[1:])
+    save_atomic(values_path, np.concatenate(frames, axis=0))
+    save_atomic(offsets_path, offsets)
+
+
+def load_scene_frame(values, offsets, frame_id):
+    """ One frame from consolidated (memory-mapped) per-scene arrays.
+
+        Input:
+            values: [np.ndarray, (N_all,...), np.float16]
+            offsets: [np.ndarray, (257,), np.int64]
+            frame_id: [int]
+
+        Output:
+            frame: [np.ndarray, (N,...), np.float32]
+                same as the per-frame file
+    """
+    return np.asarray(values[offsets[frame_id]:offsets[frame_id + 1]], dtype=np.float32)
+
+
 # def points_denoise(points, pre_sample_num):
 #     sampled_idxs = sample_points(len(points), pre_sample_num)
 #     sampled_pcd = o3d.geometry.PointCloud()
@@ -0,0 +1,179 @@
+""" Batched point cloud normal estimation.
+    Same algorithm as open3d estimate_normals + orient_normals_to_align_with_direction +
+    normalize_normals: covariance of the radius (or hybrid radius/kNN) neighborhood and its smallest
+    eigenvector. Neighborhood moments of all points come from one sparse matmul per chunk and the
+    eigen problems of all frames in a call are solved in one batched eigh.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+def neighborhood_moments(cloud, radius, max_nn=None, chunk_size=20000):
+    """ Point count, coordinate sums and second moments of every point neighborhood.
+
+        Input:
+            cloud: [np.ndarray, (N,3)]
+            radius: [float]
+                neighbors are points with distance <= radius, the point itself included
+            max_nn: [int]
+                if given, only the max_nn nearest of them (open3d KDTreeSearchParamHybrid)
+            chunk_size: [int]
+                query points per chunk, bounds the memory of the neighbor pairs
+
+        Output:
+            moments: [np.ndarray, (N,10), np.float64]
+                count, sum x/y/z, sum xx/xy/xz/yy/yz/zz
+    """
+    cloud = cloud.astype(np.float64)
+    num_points = len(cloud)
+    x, y, z = cloud[:, 0], cloud[:, 1], cloud[:, 2]
+    features = np.stack([np.ones(num_points), x, y, z, x * x, x * y, x * z, y * y, y * z, z * z], axis=1)
+    tree = cKDTree(cloud)
+    moments = np.zeros([num_points, 10], dtype=np.float64)
+    for start in range(0, num_points, chunk_size):
+        end = min(start + chunk_size, num_points)
+        if max_nn is None:
+            pairs = cKDTree(cloud[start:end]).sparse_distance_matrix(tree, radius, output_type='ndarray')
+            rows, cols = pairs['i'], pairs['j']
+        else:
+            _, nn_inds = tree.query(cloud[start:end], k=max_nn, distance_upper_bound=radius)
+            nn_inds = nn_inds.reshape(end - start, max_nn)
+            rows, cols = np.nonzero(nn_inds < num_points)
+            cols = nn_inds[rows, cols]
+        adjacency = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(end - start, num_points))
+        moments[start:end] = adjacency @ features
+    return moments
+
+
+def normals_from_moments(moments, orientation=(0., 0., -1.)):
+    """ Batched smallest-eigenvector normals, oriented and normalized like open3d.
+
+        Input:
+            moments: [np.ndarray, (N,10), np.float64]
+            orientation: [tuple of float]
+                normals are flipped to have a non-negative dot product with this direction
+
+        Output:
+            normals: [np.ndarray, (N,3), np.float64]
+    """
+    count = moments[:, 0]
+    mean = moments[:, 1:4] / count[:, np.newaxis]
+    xx, xy, xz, yy, yz, zz = [moments[:, i] / count for i in range(4, 10)]
+    cov = np.stack([xx, xy, xz, xy, yy, yz, xz, yz, zz], axis=1).reshape(-1, 3, 3)
+    cov -= mean[:, :, np.newaxis] * mean[:, np.newaxis, :]
+    _, eigvecs = np.linalg.eigh(cov)
+    normals = eigvecs[:, :, 0]
+
+    # open3d leaves (0, 0, 1) for neighborhoods with less than 3 points
+    normals[count < 3] = np.array([0., 0., 1.])
+    orientation = np.array(orientation, dtype=np.float64)
+    normals[np.linalg.norm(normals, axis=1) == 0] = orientation
+    normals[np.dot(normals, orientation) < 0] *= -1
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return normals
+
+
+def estimate_normals(clouds, radius=0.015, max_nn=None, orientation=(0., 0., -1.), chunk_size=20000):
+    """ Normals of several point clouds in one call.
+
+        Input:
+            clouds: [list of np.ndarray, (Ni,3)]
+            radius, max_nn: neighborhood, see neighborhood_moments()
+            orientation: [tuple of float]
+
+        Output:
+            normals: [list of np.ndarray, (Ni,3), np.float32]
+    """
+    moments = [neighborhood_moments(cloud, radius, max_nn, chunk_size) for cloud in clouds]
+    offsets = np.cumsum([0] + [len(m) for m in moments])
+    normals = normals_from_moments(np.concatenate(moments, axis=0), orientation).astype(np.float32)
+    return [normals[offsets[i]:offsets[i + 1]] for i in range(len(clouds))]
+
+
+def open3d_normals(cloud, radius=0.015, max_nn=None, orientation=(0., 0., -1.)):
+    """ Reference normals of the original per-frame open3d pipeline. """
+    import open3d as o3d
+    scene = o3d.geometry.PointCloud()
+    scene.points = o3d.utility.Vector3dVector(cloud.reshape(-1, 3))
+    if max_nn is None:
+        search_param = o3d.geometry.KDTreeSearchParamRadius(radius)
+    else:
+        search_param = o3d.geometry.KDTreeSearchParamHybrid(radius, max_nn)
+    scene.estimate_normals(search_param, fast_normal_computation=True)
+    scene.orient_normals_to_align_with_direction(np.array(orientation))
+    scene.normalize_normals()
+    return np.asarray(scene.normals)
+
+
+def normal_parity(normals, ref_normals, cos_thresh=0.999):
+    """ Fraction of normals within acos(cos_thresh) of the reference, and the median angle in degrees. """
+    cos = np.clip(np.sum(normals * ref_normals, axis=1), -1, 1)
+    return np.mean(cos >= cos_thresh), np.degrees(np.median(np.arccos(cos)))
+
+
+if __name__ == '__main__':
+    # Parity and speed check on synthetic depth frames: a tilted table plane with a half sphere
+    # seen by a 640x360 camera. Fails if fewer than --min_parity of the normals are within 2.6 deg
+    # of open3d. Without open3d, open3d parity is NOT verified: the check falls back to a per-point
+    # numpy reference of the same algorithm on a subset of points (or fails with --require_open3d).
+    import sys
+    import time
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_frames', type=int, default=4, help='Synthetic frames per call [default: 4]')
+    parser.add_argument('--max_nn', type=int, default=None, help='Hybrid search neighbor bound [default: None]')
+    parser.add_argument('--min_parity', type=float, default=0.999, help='Minimal fraction of normals within 2.6 deg of the reference [default: 0.999]')
+    parser.add_argument('--require_open3d', action='store_true', help='Fail instead of falling back to the numpy reference [default: False]')
+    cfgs = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    clouds = []
+    for _ in range(cfgs.num_frames):
+        u, v = np.meshgrid(np.arange(640), np.arange(360))
+        xs, ys = (u - 320) / 450., (v - 180) / 450.
+        depth = 0.6 + 0.2 * ys + rng.uniform(-0.05, 0.05)
+        center = np.array([rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05), 0.55])
+        # ray/sphere intersection for a sphere of radius 5cm
+        rays = np.stack([xs, ys, np.ones_like(xs)], axis=-1)
+        b = rays @ center
+        rr = np.sum(rays * rays, axis=-1)
+        disc = b ** 2 - rr * (center @ center - 0.05 ** 2)
+        t_sphere = np.where(disc > 0, (b - np.sqrt(np.maximum(disc, 0))) / rr, np.inf)
+        depth = np.minimum(depth, t_sphere) + rng.normal(0, 0.0005, depth.shape)
+        clouds.append((rays * depth[..., np.newaxis]).reshape(-1, 3).astype(np.float32))
+
+    tic = time.time()
+    normals = estimate_normals(clouds, radius=0.015, max_nn=cfgs.max_nn)
+    print('batched: {} frames of {} points, {:.2f}s'.format(len(clouds), len(clouds[0]), time.time() - tic))
+
+    try:
+        tic = time.time()
+        ref = [open3d_normals(cloud, radius=0.015, max_nn=cfgs.max_nn) for cloud in clouds]
+        print('open3d: {:.2f}s'.format(time.time() - tic))
+        parities = [normal_parity(n, r) for n, r in zip(normals, ref)]
+        reference = 'open3d'
+    except ImportError:
+        if cfgs.require_open3d:
+            sys.exit('open3d is not installed, open3d parity cannot be checked')
+        print('open3d not installed: open3d parity NOT verified, checking against a numpy reference of the same algorithm')
+        cloud = clouds[0].astype(np.float64)
+        tree = cKDTree(cloud)
+        check_idxs = rng.choice(len(cloud), 2000, replace=False)
+        ref = []
+        for i in check_idxs:
+            if cfgs.max_nn is None:
+                nbrs = cloud[tree.query_ball_point(cloud[i], 0.015)]
+            else:
+                dists, nn_inds = tree.query(cloud[i], k=cfgs.max_nn, distance_upper_bound=0.015)
+                nbrs = cloud[nn_inds[nn_inds < len(cloud)]]
+            w, vecs = np.linalg.eigh(np.cov(nbrs.T, bias=True))
+            n = vecs[:, 0] * (1 if vecs[2, 0] <= 0 else -1)
+            ref.append(n / np.linalg.norm(n))
+        parities = [normal_parity(normals[0][check_idxs], np.array(ref))]
+        reference = 'numpy reference'
+
+    for frame_idx, (parity, median_angle) in enumerate(parities):
+        print('frame {} {} parity: {:.6f} within 2.6 deg, median angle {:.4f} deg'.format(frame_idx, reference, parity, median_angle))
+        assert parity >= cfgs.min_parity, 'frame {}: {} parity {:.6f} below {}'.format(frame_idx, reference, parity, cfgs.min_parity)
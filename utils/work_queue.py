@@ -0,0 +1,276 @@
+""" Lock-file work queue on a shared filesystem for the offline generators.
+    Any number of worker processes on any number of hosts pointed at the same queue directory
+    claim units (scenes / objects) one at a time. A claim is a file per attempt created with
+    O_CREAT|O_EXCL and carries a lease that the worker renews while the unit runs; the claim of a
+    crashed worker expires and is taken over by creating the claim of the next attempt, which only
+    one worker can do. Failed units are retried up to max_attempts.
+    Leases compare wall clocks, hosts are assumed to be roughly synchronized (NTP).
+
+    python utils/work_queue.py --queue_dir /data/graspnet/queues/graspness_realsense
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+import multiprocessing
+
+
+class FileWorkQueue():
+    """ Queue state is kept in files per unit in queue_dir: <unit>.claim.<n> while attempt n is
+        claimed (the highest n is the current claim, only its owner writes it), <unit>.done and
+        <unit>.failed once finished. units.json lists all units and is written by the first worker.
+
+        Input:
+                queue_dir: [str]
+                    directory on the shared filesystem
+                lease: [float]
+                    seconds a claim stays valid without renewal
+                max_attempts: [int]
+                    a unit is marked failed after this many failed or expired attempts
+
+        Example usage:
+            queue = FileWorkQueue('/data/queues/graspness', lease=600)
+            queue.register(['scene_0000', 'scene_0001'])
+            queue.run({'scene_0000': (0, cfgs), 'scene_0001': (1, cfgs)}, generate_scene)
+            print(queue.summary())
+    """
+    def __init__(self, queue_dir, lease=600, max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _path(self, unit, kind):
+        return os.path.join(self.queue_dir, '{}.{}'.format(unit, kind))
+
+    def _write_json(self, path, data):
+        tmp_path = '{}.{}.tmp'.format(path, self.worker_id.replace(':', '_'))
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            # missing, or caught between create and write by another worker
+            return None
+
+    def register(self, units):
+        """ Record the unit list once, later workers keep the first list. """
+        path = os.path.join(self.queue_dir, 'units.json')
+        if not os.path.exists(path):
+            self._write_json(path, list(units))
+
+    def units(self):
+        return self._read_json(os.path.join(self.queue_dir, 'units.json')) or []
+
+    def _claim_path(self, unit, attempt):
+        return self._path(unit, 'claim.{}'.format(attempt))
+
+    def _current_claim(self, unit):
+        """ Highest claimed attempt of a unit (0 if unclaimed) and its claim, None while being written. """
+        attempt = 0
+        for n in range(1, self.max_attempts + 1):
+            if os.path.exists(self._claim_path(unit, n)):
+                attempt = n
+        if attempt == 0:
+            return 0, None
+        return attempt, self._read_json(self._claim_path(unit, attempt))
+
+    def _create_claim(self, unit, attempt):
+        try:
+            fd = os.open(self._claim_path(unit, attempt), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker_id, 'attempt': attempt, 'expires': time.time() + self.lease,
+                       'claimed': time.time()}, f)
+        return True
+
+    def claim(self, unit):
+        """ Try to claim a unit.
+
+            Output:
+                attempt: [int]
+                    attempt number of the new claim, None if the unit is done, failed or held
+        """
+        if os.path.exists(self._path(unit, 'done')) or os.path.exists(self._path(unit, 'failed')):
+            return None
+        current, info = self._current_claim(unit)
+        if current == 0:
+            return 1 if self._create_claim(unit, 1) else None
+        if info is None or info['expires'] > time.time():
+            return None
+        # expired lease: the O_EXCL claim of the next attempt admits exactly one worker
+        attempt = current + 1
+        if attempt > self.max_attempts:
+            self._write_json(self._path(unit, 'failed'), {'attempts': current, 'error': info.get('error', 'lease expired')})
+            return None
+        if not self._create_claim(unit, attempt):
+            return None
+        self._remove_claims(unit, current)
+        return attempt
+
+    def _remove_claims(self, unit, last_attempt):
+        for n in range(1, last_attempt + 1):
+            try:
+                os.remove(self._claim_path(unit, n))
+            except FileNotFoundError:
+                pass
+
+    def _owns(self, unit, attempt):
+        """ True if the worker's claim of this attempt is still the current claim of the unit. """
+        if os.path.exists(self._claim_path(unit, attempt + 1)):
+            return False
+        info = self._read_json(self._claim_path(unit, attempt))
+        return info is not None and info['worker'] == self.worker_id
+
+    def renew(self, unit, attempt):
+        # a claim file is only ever written by its owner, a takeover creates the next attempt instead
+        if not self._owns(unit, attempt):
+            return False
+        info = self._read_json(self._claim_path(unit, attempt))
+        info['expires'] = time.time() + self.lease
+        self._write_json(self._claim_path(unit, attempt), info)
+        return True
+
+    def complete(self, unit, attempt, result=None):
+        self._write_json(self._path(unit, 'done'), {'worker': self.worker_id, 'attempt': attempt, 'finished': time.time(),
+                                                    'result': repr(result)})
+        if self._owns(unit, attempt):
+            self._remove_claims(unit, attempt)
+
+    def release(self, unit, attempt, error):
+        """ Give a failed unit back: its claim expires now and keeps the attempt count for the retry. """
+        if not self._owns(unit, attempt):
+            return
+        info = self._read_json(self._claim_path(unit, attempt))
+        info.update({'expires': 0, 'error': error})
+        self._write_json(self._claim_path(unit, attempt), info)
+
+    def run(self, unit_args, func, poll_interval=0):
+        """ Claim and process units until none is left to claim.
+
+            Input:
+                unit_args: [dict]
+                    unit name -> arguments of func
+                func: [callable]
+                poll_interval: [float]
+                    if > 0, keep polling units held by other workers, to take over expired leases,
+                    until every unit is done or failed
+
+            Output:
+                num_processed: [int]
+        """
+        names = sorted(unit_args)
+        # start at a worker dependent offset to spread the first claims
+        offset = hash(self.worker_id) % max(len(names), 1)
+        names = names[offset:] + names[:offset]
+        num_processed = 0
+        while True:
+            claimed_any = False
+            for unit in names:
+                attempt = self.claim(unit)
+                if attempt is None:
+                    continue
+                claimed_any = True
+                stop_renew = threading.Event()
+                renew_thread = threading.Thread(target=self._renew_loop, args=(unit, attempt, stop_renew), daemon=True)
+                renew_thread.start()
+                try:
+                    result = func(*unit_args[unit])
+                except Exception:
+                    stop_renew.set()
+                    renew_thread.join()
+                    self.release(unit, attempt, traceback.format_exc(limit=3))
+                    print('{} attempt {} failed'.format(unit, attempt))
+                    continue
+                stop_renew.set()
+                renew_thread.join()
+                self.complete(unit, attempt, result)
+                num_processed += 1
+                print('{} done: {}'.format(unit, result))
+            if claimed_any:
+                continue
+            pending = [unit for unit in names if not (os.path.exists(self._path(unit, 'done')) or
+                                                      os.path.exists(self._path(unit, 'failed')))]
+            if poll_interval <= 0 or len(pending) == 0:
+                return num_processed
+            time.sleep(poll_interval)
+
+    def _renew_loop(self, unit, attempt, stop_event):
+        while not stop_event.wait(self.lease / 3):
+            if not self.renew(unit, attempt):
+                return
+
+    def summary(self):
+        """ Unit counts by state, failed units and a completion estimate from the finish times. """
+        units = self.units()
+        now = time.time()
+        counts = {'total': len(units), 'done': 0, 'running': 0, 'expired': 0, 'retrying': 0, 'failed': 0, 'pending': 0}
+        failed, finish_times = [], []
+        for unit in units:
+            done = self._read_json(self._path(unit, 'done'))
+            if done is not None:
+                counts['done'] += 1
+                finish_times.append(done['finished'])
+                continue
+            if os.path.exists(self._path(unit, 'failed')):
+                counts['failed'] += 1
+                failed.append(unit)
+                continue
+            current, claim = self._current_claim(unit)
+            if current == 0:
+                counts['pending'] += 1
+            elif claim is None:
+                counts['running'] += 1
+            elif claim['expires'] > now:
+                counts['running'] += 1
+            elif 'error' in claim:
+                counts['retrying'] += 1
+            else:
+                counts['expired'] += 1
+        counts['failed_units'] = failed
+        if len(finish_times) >= 2:
+            rate = (len(finish_times) - 1) / max(max(finish_times) - min(finish_times), 1e-6)
+            counts['units_per_hour'] = round(rate * 3600, 2)
+            counts['eta_hours'] = round((counts['total'] - counts['done'] - counts['failed']) / rate / 3600, 2)
+        return counts
+
+
+def _queue_worker(args):
+    queue_dir, lease, max_attempts, unit_args, func, poll_interval = args
+    return FileWorkQueue(queue_dir, lease, max_attempts).run(unit_args, func, poll_interval)
+
+
+def run_queue_workers(queue_dir, unit_args, func, num_workers=1, lease=600, max_attempts=3, poll_interval=0):
+    """ Register the units and process them with num_workers local processes; run the same command
+        on other hosts to add workers.
+    """
+    queue = FileWorkQueue(queue_dir, lease, max_attempts)
+    queue.register(sorted(unit_args))
+    ctx_in_main = multiprocessing.get_context('forkserver')
+    with ctx_in_main.Pool(processes = num_workers) as p:
+        p.map(_queue_worker, [(queue_dir, lease, max_attempts, unit_args, func, poll_interval)] * num_workers)
+    print('queue summary: {}'.format(queue.summary()))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue_dir', required=True, help='Queue directory')
+    parser.add_argument('--reset_failed', action='store_true', help='Remove failed markers so the units are retried [default: False]')
+    cfgs = parser.parse_args()
+
+    queue = FileWorkQueue(cfgs.queue_dir)
+    if cfgs.reset_failed:
+        for unit in queue.units():
+            if os.path.exists(queue._path(unit, 'failed')):
+                os.remove(queue._path(unit, 'failed'))
+    print(json.dumps(queue.summary(), indent=1))